@@ -1,118 +1,211 @@
 #!/usr/bin/env python
-# CW3E Field Team 
+# CW3E Field Team
 # Adolfo Lopez Miranda
 
 # import modules
-import requests, os, time, pandas as pd, csv, numpy as np, logging
+import os, time, pandas as pd, csv, numpy as np, logging
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
-from HOBOlink_parse import convert_time, csv_timestamp, parse_stream, parse_precip
+from HOBOlink_parse import convert_time, csv_timestamp, plan_chunks
+from HOBOlink_client import HOBOlinkClient, API_URL
+from HOBOlink_cache import cache_from_env
+from HOBOlink_state import site_state_path
+from HOBOlink_metrics import metrics
+from HOBOlink_sensors import use_registry
+from HOBOlink_plugins import parser_for, register_parser, PrecipMetParser
+from HOBOlink_journal import recover
 
 # load .env file - the .env file is the best place to store sensitive info such as the user ID, and token information
 load_dotenv(find_dotenv())
 
-# load path where data will be stored - 
+# load path where data will be stored -
 #base_dir = "/data/CW3E_data/CW3E_PrecipMet_Archive/"
-base_dir = "/data/CW3E_data/CW3E_Streamflow_Archive/"
+# HOBOLINK_BASE_DIR overrides the default (e.g. when running against benchmarks/mock_api.py)
+base_dir = os.environ.get("HOBOLINK_BASE_DIR", "/data/CW3E_data/CW3E_Streamflow_Archive/")
 base_dir_path = Path(base_dir)
 # Note base_dir will need to be indicated in the parse fucntion - the default is None (data will be stored in the same place as where the script is running)
 
 # SHEF Output Toggle
 shef = True
 
-site_type = 'S' #S = streams and P = Precip
-# load site metadata CSV into DataFrame
-if site_type == 'S' or site_type == 's':
-    df_sites = pd.read_csv('Streams_Metadata.csv').set_index('site_ID')
-elif site_type == 'P' or site_type == 'p':
-    # load site metadata CSV into DataFrame
-    df_sites = pd.read_csv('PrecipMet_Metadata.csv').set_index('site_ID')
+# Parquet archive toggle - also write the data to {site}/Archive, partitioned by year-month (requires pyarrow)
+archive = False
+
+# State file toggle - when True the last timestamp is read from {site}_state.json instead of the MasterTable
+use_state_file = True
+
+# Concurrency settings
+# max_workers - number of loggers pulled at the same time (set to 1 to pull the sites one at a time)
+# max_requests_per_second - request rate allowed for the whole account, shared by every worker
+max_workers = int(os.environ.get("MAX_WORKERS", 4))
+max_requests_per_second = float(os.environ.get("MAX_REQUESTS_PER_SECOND", 1))
+
+# Stage timings (fetch, decode, transform, discharge, csv_write, daily_write, shef_write, journal_commit) are written at
+# the end of the run to {metrics_dir}/hobolink_metrics.prom and hobolink_metrics.json - see HOBOlink_metrics.py
+metrics_dir = os.environ.get("METRICS_DIR", "./")
+
+# Sensor registry - SENSOR_REGISTRY points at a YAML/JSON file describing the sensors, their SI/US units and the
+# derived channels (see HOBOlink_sensors.py). The built in registry is used when it isn't set
+sensor_registry = os.environ.get("SENSOR_REGISTRY")
+
+# Precip intervals - PRECIP_RESAMPLE=15min also sums the precip pulses into {site}_Precip_15min.csv. The interval still
+# being filled at the end of a pull is kept in the site's state file until the next pull completes it
+precip_resample = os.environ.get("PRECIP_RESAMPLE")
+
+site_type = 'S' #S = streams and P = Precip - the parser of each site type is in HOBOlink_plugins.py
+# number of values a logger reports per timestamp (used to size each request under the 100,000 point limit) is set by
+# the parser of the site type - can be set per site with an optional n_channels column in the metadata csv
+# a site_type column in the metadata csv overrides the site type for a single site
 
 # HOBOlink API Token
 token = os.environ.get("TOKEN") # user ID found on HOBOlink
 
-# loop through each site in the DataFrame
-for site_id, row in df_sites.iterrows():
-    try:
-        print(f'Pulling data for {site_id}.')
-        logger = str(row['logger_SN'])
-        cdec_id = row['CDEC_ID']
-        
-        # if cdec_id is not included set it to None
-        if cdec_id == 'NaN' or cdec_id == '':
-            cdec_id = None
-    
-        # Convert DataFrame's 'start_time' to string format as needed by your API URL
-        initial_start_time = row['start_time'] # Adjust format as necessary
-        logging_int = row['logging_int']
-        
-        #site_log_file = base_dir + site_id + "/" + site_id + ".log"
-        site_log_file = site_id + ".log"
-        # create multiple log files:
-        site_logger = logging.getLogger(site_id + '_Logger')
-        site_logger.setLevel(logging.DEBUG)
+def pull_site(client, site_id, row, site_type=site_type):
+    """
+    Pulls all new data for a single site and records it to the site's csv files.
+
+    Parameters:
+    - client: HOBOlinkClient, shared by every worker
+    - site_id: str, the site ID from the metadata csv
+    - row: pandas Series, the metadata row for the site
+    - site_type: str, 'S' for streams or 'P' for precip (see HOBOlink_plugins.py)
+    """
+    print(f'Pulling data for {site_id}.')
+    if 'site_type' in row.index and pd.notna(row['site_type']):
+        site_type = row['site_type']
+    parser = parser_for(site_type)
+    # every stage recorded on this worker thread is labelled with the site
+    metrics.set_site(site_id)
+    logger = str(row['logger_SN'])
+    cdec_id = row['CDEC_ID']
+
+    # if cdec_id is not included set it to None
+    if pd.isna(cdec_id) or cdec_id == 'NaN' or cdec_id == '':
+        cdec_id = None
+
+    # Convert DataFrame's 'start_time' to string format as needed by your API URL
+    initial_start_time = row['start_time'] # Adjust format as necessary
+    logging_int = row['logging_int']
+
+    #site_log_file = base_dir + site_id + "/" + site_id + ".log"
+    site_log_file = site_id + ".log"
+    # create multiple log files:
+    site_logger = logging.getLogger(site_id + '_Logger')
+    site_logger.setLevel(logging.DEBUG)
+    if not site_logger.handlers:
         site_handler = logging.FileHandler(site_log_file, mode='a')
         site_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S%z')
         site_handler.setFormatter(site_formatter)
         site_logger.addHandler(site_handler)
-        
-        # file name of long running file
-        # need to provide path to where this is located at to check timestamp of last successful log
-        file_csv = site_id + "_MasterTable_Raw.csv"
-        # full path to the site csv file
-        file_csv_path = base_dir_path / site_id / "Raw" / file_csv
-    
-        # check if file exists
-        file_exists = os.path.isfile(file_csv_path)
-        # file exists
-        if file_exists == True:
-            start_time, start_dt = csv_timestamp(file_csv_path, logging_int) # read last entry in file and use last timestamp as the start time for the data pulled
-        #file does not exist  
-        elif file_exists == False:
-            start_dt, start_time = convert_time(initial_start_time, target_format="start") # use start time found in metadata csv - Uses the true start time from deployment
-        
-        # end time isn't specified, the script will pull all new data regardless of what time it is ran
-        # This method can only be ran once per account as Time Frame Querying is tracked on the backend
-        # Alternative method is to use end_time = "&end_date_time=YYYY-MM-DD+HH%3Amm%3ASS" in UTC format
-        end_str = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + 'Z'
-        end_dt, end_time = convert_time(end_str,target_format="end")
-        #end_dt, end_time = start_time_offset(initial_start_time, 180, target_format="end") #useful if need to run tests
-        #end_time = "&only_new_data=true"
-         
-        # HOBOlink url to get data from file endpoints
-        hobolink_api_url = "https://api.hobolink.licor.cloud/v1/data?loggers=" + logger + start_time + end_time
-    
-        while True:
-            #  send data request using token
-            api_call_headers = {
-                'accept': 'application/json',
-                'Authorization': 'Bearer ' + token} # HTTP Authentication required for HOBOlink
-            api_call_response = requests.get(hobolink_api_url, headers=api_call_headers, verify=True) # requests a representation of the specified resource
-            if api_call_response.status_code == 200: 
-                # Convert data to dict
-                data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
+
+    # file name of long running file
+    # need to provide path to where this is located at to check timestamp of last successful log
+    file_csv = site_id + "_MasterTable_Raw.csv"
+    # full path to the site csv file
+    file_csv_path = base_dir_path / site_id / "Raw" / file_csv
+
+    # check if file exists
+    file_exists = os.path.isfile(file_csv_path)
+    # file exists
+    if file_exists == True:
+        state_path = site_state_path(base_dir_path, site_id) if use_state_file else None
+        start_time, start_dt = csv_timestamp(file_csv_path, logging_int, state_path=state_path) # read last entry in file and use last timestamp as the start time for the data pulled
+    #file does not exist
+    elif file_exists == False:
+        start_dt, start_time = convert_time(initial_start_time, target_format="start") # use start time found in metadata csv - Uses the true start time from deployment
+
+    # end time isn't specified, the script will pull all new data regardless of what time it is ran
+    # This method can only be ran once per account as Time Frame Querying is tracked on the backend
+    # Alternative method is to use end_time = "&end_date_time=YYYY-MM-DD+HH%3Amm%3ASS" in UTC format
+    end_str = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + 'Z'
+    end_dt, end_time = convert_time(end_str,target_format="end")
+    #end_dt, end_time = start_time_offset(initial_start_time, 180, target_format="end") #useful if need to run tests
+    #end_time = "&only_new_data=true"
+
+    # split the pull into windows that stay under the API's 100,000 data point limit
+    n_channels = row['n_channels'] if 'n_channels' in row.index and pd.notna(row['n_channels']) else parser.default_channels
+    windows = plan_chunks(start_dt, end_dt, logging_int, n_channels)
+
+    for window_start, window_end in windows:
+        #  send data request using token - 509 and 5xx responses are retried, truncated windows are split by the client
+        for _, _, api_call_response, data in client.get_window(logger, window_start, window_end, logging_int):
+            if api_call_response.status_code == 200:
+                # data from HOBOlink will be in JSON JavaScript Object Notation
                 if len(data["data"]) > 0 :
                     #print(data['observation_list'])
                     #parse data based off site type
-                    if site_type == 'S' or site_type == 's':
-                        data_int = parse_stream(data, site_id, cdec_id, base_path=base_dir, shef_toggle=shef)
-                    elif site_type == 'P' or site_type == 'p':
-                        data_int = parse_precip(data, site_id, base_path=None, append_to_single_file=True, shef_toggle=False)
+                    data_int = parser.parse(data, site_id, cdec_id, base_path=base_dir, shef_toggle=shef, archive_toggle=archive, live=True,
+                                             logging_interval_minutes=logging_int)
                     site_logger.info('Data found and recorded to csv file.')
-                elif len(data["observation_list"]) == 0:
-                    site_logger.warning('No new data since the last recorded timestamp.')            
-                break
-            elif api_call_response.status_code == 400 or api_call_response.status_code == 500 or api_call_response.status_code == 509: 
+                elif len(data["data"]) == 0:
+                    site_logger.warning('No new data since the last recorded timestamp.')
+            elif api_call_response.status_code == 400 or api_call_response.status_code == 500 or api_call_response.status_code == 509:
                 # Failures have occured - Record error code and error description in log file
-                data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
                 site_logger.error('error: %s\nmessage: %s\nerror_description: %s' %(data["error"], data["message"], data["error_description"]))
+                # stop here - the next run resumes from the last recorded timestamp
+                return
             else:
                 # record status code and response in log file
-                data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
                 site_logger.error('Unexpected status code: %s\n Unexpected Response: %s' %(api_call_response.status_code, data))
-            break
-    except Exception as e:
-        print(f"An error occurred for {site_id}: {e}")
+                return
+
+def main(site_type=site_type, site_ids=None):
+    """
+    Pulls all new data for every site in the metadata csv.
+
+    Parameters:
+    - site_type: str, 'S' for streams (Streams_Metadata.csv) or 'P' for precip (PrecipMet_Metadata.csv)
+    - site_ids: list of str or None, only pull these sites
+    """
+    # load site metadata CSV into DataFrame
+    df_sites = pd.read_csv(parser_for(site_type).metadata_csv).set_index('site_ID')
+    if site_ids:
+        df_sites = df_sites.loc[site_ids]
+    # a site listed twice would be pulled by two workers writing the same files - keep its first row
+    duplicated = df_sites.index.duplicated(keep='first')
+    if duplicated.any():
+        print(f"Site IDs listed more than once, using the first row: {', '.join(sorted(set(df_sites.index[duplicated])))}")
+        df_sites = df_sites[~duplicated]
+    if sensor_registry:
+        use_registry(sensor_registry)
+    if precip_resample:
+        register_parser(PrecipMetParser(resample_freq=precip_resample))
+
+    # finish the last batch of any site whose run was killed while writing it (see HOBOlink_journal.py) - only a
+    # check for each site's journal file when the last run finished cleanly
+    for site_id in df_sites.index:
+        if recover(base_dir, site_id):
+            print(f'Recovered the last batch for {site_id} from its journal.')
+
+    # Raw response cache - set RESPONSE_CACHE_DIR to keep every response so it can be re-parsed without the API
+    # (see HOBOlink_cache.py). RESPONSE_CACHE_MAX_GB sets the size of the cache
+    response_cache = cache_from_env()
+
+    # one client for every worker - pooled keep-alive connections, retries and the account-wide rate limit
+    # HOBOLINK_API_URL points the script at another server, e.g. the local mock in benchmarks/mock_api.py
+    client = HOBOlinkClient(token, base_url=os.environ.get("HOBOLINK_API_URL", API_URL), requests_per_second=max_requests_per_second,
+                            pool_size=max(1, max_workers), cache=response_cache)
+
+    # pull the sites concurrently - each site is handled by a single worker from start to finish
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(pull_site, client, site_id, row, site_type): site_id for site_id, row in df_sites.iterrows()}
+        for future in as_completed(futures):
+            site_id = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"An error occurred for {site_id}: {e}")
+            # time spent in each stage for this site
+            logging.getLogger(site_id + '_Logger').info(metrics.site_summary(site_id))
+
+    client.close()
+
+    # export the stage timings for the whole run
+    metrics.write(metrics_dir)
+
+if __name__ == '__main__':
+    main()
 
 #End of script
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Optional columnar archive that is written alongside the csv MasterTables
+# Data is stored as Parquet files partitioned by site and year-month:
+#   {base_path}/{site}/Archive/{table}/year_month=YYYY-MM/part-<write time>-<id>.parquet
+# Reads only open the months that overlap the requested time range and only load the requested columns.
+# Batches are only ever added, so a timestamp that was written again (a backfill or a re-pull) is in more than one
+# file - reads keep the row of the most recent file for each timestamp, and compact_archive merges a table's files.
+# Requires pyarrow (pip install pyarrow)
+
+# import modules
+import time, uuid, pandas as pd
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:  # the archive is optional - the csv MasterTables don't need pyarrow
+    pa = None
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("The Parquet archive requires pyarrow. Install it with: pip install pyarrow")
+
+def archive_path(base_path, site_name, table):
+    """
+    Returns the directory of an archive table, e.g. archive_path(base, 'WHT', 'Raw') -> {base}/WHT/Archive/Raw
+    """
+    return Path(base_path if base_path else './') / site_name / 'Archive' / table
+
+def partitioning():
+    # year_month is kept as a string so it can be compared with 'YYYY-MM' values
+    return ds.partitioning(pa.schema([('year_month', pa.string())]), flavor='hive')
+
+def write_archive(df, base_path, site_name, table):
+    """
+    Appends a batch of rows to an archive table. Each batch adds one Parquet file per year-month it covers,
+    so existing files are never rewritten. The file names start with the write time, so rows written later replace
+    rows with the same timestamp when the table is read.
+
+    Parameters:
+    - df: DataFrame with a 'timestamp_UTC' column (datetimes or strings formatted as 'YYYY-MM-DD HH:MM:SSZ')
+    - base_path: str or None, the base path where files are saved
+    - site_name: str, the name of the site
+    - table: str, name of the table, e.g. 'Raw' or 'Processed'
+
+    Returns:
+    - The number of rows written.
+    """
+    require_pyarrow()
+    if df.empty:
+        return 0
+
+    df = df.copy()
+    df['timestamp_UTC'] = pd.to_datetime(df['timestamp_UTC'], utc=True, format='mixed')
+    year_month = df['timestamp_UTC'].dt.strftime('%Y-%m')
+    table_path = archive_path(base_path, site_name, table)
+    batch_id = f'{time.time_ns():020d}-{uuid.uuid4().hex}'
+
+    for month, group in df.groupby(year_month, sort=True):
+        partition_path = table_path / f'year_month={month}'
+        partition_path.mkdir(parents=True, exist_ok=True)
+        arrow_table = pa.Table.from_pandas(group.reset_index(drop=True), preserve_index=False)
+        pq.write_table(arrow_table, partition_path / f'part-{batch_id}.parquet', compression='zstd')
+    return df.shape[0]
+
+def read_archive(base_path, site_name, table, columns=None, start=None, end=None):
+    """
+    Reads rows from an archive table.
+
+    Parameters:
+    - base_path: str or None, the base path where files are saved
+    - site_name: str, the name of the site
+    - table: str, name of the table, e.g. 'Raw' or 'Processed'
+    - columns: list or None, columns to load ('timestamp_UTC' is always included). Defaults to every column
+    - start: datetime/str or None, first timestamp to load (inclusive)
+    - end: datetime/str or None, last timestamp to load (inclusive)
+
+    Returns:
+    - DataFrame sorted by timestamp with one row per timestamp - the row of the most recently written file.
+      The months outside [start, end] are never opened.
+    """
+    require_pyarrow()
+    table_path = archive_path(base_path, site_name, table)
+    if not table_path.exists():
+        return pd.DataFrame(columns=['timestamp_UTC'] + list(columns or []))
+
+    dataset = ds.dataset(table_path, format='parquet', partitioning=partitioning())
+
+    # The partition filter prunes whole months, the timestamp filter is pushed down to the row groups
+    predicate = None
+    for bound, op in ((start, 'ge'), (end, 'le')):
+        if bound is None:
+            continue
+        bound = pd.Timestamp(bound)
+        bound = bound.tz_localize('UTC') if bound.tzinfo is None else bound.tz_convert('UTC')
+        month = bound.strftime('%Y-%m')
+        if op == 'ge':
+            condition = (ds.field('year_month') >= month) & (ds.field('timestamp_UTC') >= pa.scalar(bound.to_pydatetime(), pa.timestamp('ns', 'UTC')))
+        else:
+            condition = (ds.field('year_month') <= month) & (ds.field('timestamp_UTC') <= pa.scalar(bound.to_pydatetime(), pa.timestamp('ns', 'UTC')))
+        predicate = condition if predicate is None else predicate & condition
+
+    if columns is not None:
+        columns = ['timestamp_UTC'] + [col for col in columns if col != 'timestamp_UTC']
+    else:
+        columns = [name for name in dataset.schema.names if name != 'year_month']
+
+    # read the files in write order, so the last row of each timestamp is the most recent one
+    tables = [fragment.to_table(columns=columns, filter=predicate, schema=dataset.schema)
+              for fragment in sorted(dataset.get_fragments(filter=predicate), key=lambda fragment: Path(fragment.path).name)]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    df = pa.concat_tables(tables).to_pandas()
+    df = df.drop_duplicates('timestamp_UTC', keep='last')
+    return df.sort_values('timestamp_UTC', kind='mergesort').reset_index(drop=True)
+
+def compact_archive(base_path, site_name, table):
+    """
+    Rewrites every month of an archive table as a single file with one row per timestamp (see read_archive).
+
+    Returns:
+    - The number of rows left in the table.
+    """
+    require_pyarrow()
+    table_path = archive_path(base_path, site_name, table)
+    rows = 0
+    for partition_path in sorted(table_path.glob('year_month=*')):
+        parts = sorted(partition_path.glob('part-*.parquet'))
+        month = partition_path.name.split('=', 1)[1]
+        month_start = pd.Timestamp(f'{month}-01', tz='UTC')
+        df = read_archive(base_path, site_name, table, start=month_start, end=month_start + pd.offsets.MonthBegin(1) - pd.Timedelta(seconds=1))
+        rows += df.shape[0]
+        if len(parts) < 2:
+            continue
+        # the merged file sorts after every part it replaces, so a failure before the deletes only leaves duplicates
+        write_archive(df, base_path, site_name, table)
+        for part in parts:
+            part.unlink()
+    return rows
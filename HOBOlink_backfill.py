@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Bulk reprocessing of PrecipMet sites
+# Re-pulls a date range in API sized windows, merges it into the site's MasterTable and recomputes the
+# accumulated precipitation of the water years the range falls in, in one pass. The accumulation restarts every
+# October 1st, so the water years before and after the range keep their values.
+# Each table is rewritten once with an atomic write, so a failed pull never leaves a half updated file.
+#
+# Usage: python HOBOlink_backfill.py <site_ID> <start YYYY-MM-DD HH:MM:SSZ> <end YYYY-MM-DD HH:MM:SSZ> [base_dir]
+
+# import modules
+import os, sys, pandas as pd
+from datetime import datetime
+from pathlib import Path
+from HOBOlink_parse import plan_chunks, precipitation_frame, accumulate_precip, water_year, atomic_write_csv
+from HOBOlink_state import site_state_path, update_state, commit_timestamp
+
+def pull_precip(client, logger, start_dt, end_dt, logging_interval_minutes, n_channels):
+    """
+    Pulls the tipping bucket records of a logger for a date range.
+
+    Parameters:
+    - client: HOBOlinkClient
+    - logger: str, logger serial number
+    - start_dt, end_dt: datetime, range to pull (both inclusive)
+    - logging_interval_minutes: int, logging interval of the site
+    - n_channels: int, number of values the logger reports per timestamp - used to size the windows
+
+    Returns:
+    - DataFrame with 'timestamp_UTC' and 'precipitation_mm', sorted by time without duplicates.
+    """
+    frames = []
+    for window_start, window_end in plan_chunks(start_dt, end_dt, logging_interval_minutes, n_channels):
+        for _, _, response, data in client.get_window(logger, window_start, window_end, logging_interval_minutes):
+            if response.status_code != 200:
+                # nothing has been written yet - stop so the MasterTable is left untouched
+                raise RuntimeError(f"HOBOlink returned {response.status_code} for {window_start} - {window_end}: {data}")
+            frames.append(precipitation_frame(data))
+
+    if not frames:
+        return precipitation_frame({"data": []})
+    pulled = pd.concat(frames, ignore_index=True)
+    pulled = pulled.drop_duplicates('timestamp_UTC', keep='last')
+    return pulled.sort_values('timestamp_UTC', kind='mergesort').reset_index(drop=True)
+
+def rebuild_precip_table(existing, pulled, start_dt, end_dt):
+    """
+    Merges pulled records into a precip table and recomputes the accumulated precipitation of the affected water years.
+
+    Parameters:
+    - existing: DataFrame, the current table (may be empty)
+    - pulled: DataFrame, records from pull_precip. Pulled rows replace existing rows with the same timestamp
+    - start_dt, end_dt: datetime, the reprocessed range - the water years from the one holding start_dt to the one
+      holding end_dt are recomputed, including their rows outside the range
+
+    Returns:
+    - The merged DataFrame sorted by time, with 'timestamp_UTC' as UTC datetimes.
+    """
+    columns = ['timestamp_UTC', 'precipitation_mm', 'accumulated_precipitation_mm']
+    existing = existing.reindex(columns=columns).copy()
+    existing['timestamp_UTC'] = pd.to_datetime(existing['timestamp_UTC'], utc=True, format='mixed')
+
+    merged = pd.concat([existing, pulled.reindex(columns=columns)], ignore_index=True)
+    merged = merged.drop_duplicates('timestamp_UTC', keep='last')
+    merged = merged.sort_values('timestamp_UTC', kind='mergesort').reset_index(drop=True)
+
+    # Each affected water year restarts from 0, the rows of the other water years keep their values
+    first_year, last_year = water_year(pd.Series([pd.Timestamp(start_dt), pd.Timestamp(end_dt)]))
+    affected = water_year(merged['timestamp_UTC']).between(first_year, last_year).to_numpy()
+    merged.loc[affected, 'accumulated_precipitation_mm'] = accumulate_precip(
+        merged.loc[affected, 'timestamp_UTC'], merged.loc[affected, 'precipitation_mm']).round(2).to_numpy()
+    return merged
+
+def reprocess_precip(client, logger, site_name, start_dt, end_dt, logging_interval_minutes=2, n_channels=8, base_path=None):
+    """
+    Re-pulls a date range for a PrecipMet site and rewrites its tables with the recomputed accumulated precipitation.
+    {site}_MasterTable_Raw.csv is always rewritten, {site}.csv is rewritten when it exists.
+
+    Parameters:
+    - client: HOBOlinkClient
+    - logger: str, logger serial number
+    - site_name: str, site ID
+    - start_dt, end_dt: datetime, range to reprocess (both inclusive, timezone aware)
+    - logging_interval_minutes: int, logging interval of the site
+    - n_channels: int, number of values the logger reports per timestamp
+    - base_path: str or None, the base path where files are saved
+
+    Returns:
+    - The number of records pulled.
+    """
+    pulled = pull_precip(client, logger, start_dt, end_dt, logging_interval_minutes, n_channels)
+    if pulled.empty:
+        return 0
+
+    raw_path = Path(base_path if base_path else './') / site_name / "Raw"
+    master_table_raw = raw_path / f"{site_name}_MasterTable_Raw.csv"
+    site_csv_path = raw_path / f"{site_name}.csv"
+
+    existing = pd.read_csv(master_table_raw) if master_table_raw.exists() else pd.DataFrame()
+    merged = rebuild_precip_table(existing, pulled, start_dt, end_dt)
+    atomic_write_csv(merged, master_table_raw, permissions=0o644)
+
+    if site_csv_path.exists():
+        site_table = rebuild_precip_table(pd.read_csv(site_csv_path), pulled, start_dt, end_dt)
+        # the long running file stores timestamps as 'YYYY-MM-DD HH:MM:SSZ'
+        site_table['timestamp_UTC'] = site_table['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%S') + 'Z'
+        atomic_write_csv(site_table, site_csv_path, permissions=0o644)
+
+    # Point the accumulator used by parse_precip at the new end of the MasterTable
+    state_path = site_state_path(base_path, site_name)
+    last = merged.iloc[-1]
+    last_timestamp = last['timestamp_UTC'].strftime('%Y-%m-%d %H:%M:%S') + 'Z'
+    update_state(state_path, precip_accumulator={
+        'last_timestamp': last_timestamp,
+        'total': 0.0 if pd.isna(last['accumulated_precipitation_mm']) else float(last['accumulated_precipitation_mm']),
+        'water_year': int(last['timestamp_UTC'].year + (last['timestamp_UTC'].month >= 10))})
+    commit_timestamp(state_path, last_timestamp)
+    return pulled.shape[0]
+
+def backfill_site(site_id, start_dt, end_dt, base_path=None, metadata_csv='PrecipMet_Metadata.csv'):
+    """
+    Reprocesses a date range for a site in the PrecipMet metadata csv, using the TOKEN from the environment (.env).
+
+    Returns:
+    - int, number of records in the date range
+    """
+    from dotenv import load_dotenv, find_dotenv
+    from HOBOlink_client import HOBOlinkClient, API_URL
+    load_dotenv(find_dotenv())
+
+    row = pd.read_csv(metadata_csv).set_index('site_ID').loc[site_id]
+    n_channels = row['n_channels'] if 'n_channels' in row.index and pd.notna(row['n_channels']) else 8
+
+    client = HOBOlinkClient(os.environ.get("TOKEN"), base_url=os.environ.get("HOBOLINK_API_URL", API_URL),
+                            requests_per_second=float(os.environ.get("MAX_REQUESTS_PER_SECOND", 1)))
+    try:
+        return reprocess_precip(client, str(row['logger_SN']), site_id, start_dt, end_dt,
+                                int(row['logging_int']), n_channels, base_path=base_path)
+    finally:
+        client.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5):
+        print("Usage: python HOBOlink_backfill.py <site_ID> <start YYYY-MM-DD HH:MM:SSZ> <end YYYY-MM-DD HH:MM:SSZ> [base_dir]")
+        sys.exit(1)
+
+    site_id = sys.argv[1]
+    start_dt = datetime.strptime(sys.argv[2], '%Y-%m-%d %H:%M:%S%z')
+    end_dt = datetime.strptime(sys.argv[3], '%Y-%m-%d %H:%M:%S%z')
+    base_dir = sys.argv[4] if len(sys.argv) == 5 else None
+
+    records = backfill_site(site_id, start_dt, end_dt, base_path=base_dir)
+    print(f"Reprocessed {records} records for {site_id}.")
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# On-disk cache of raw HOBOlink API responses
+# Successful responses are stored gzip compressed, keyed by (logger, start, end):
+#   {cache_dir}/{logger}/{start YYYYmmddTHHMMSS}_{end YYYYmmddTHHMMSS}.json.gz
+# The client checks the cache before making a request, and replay re-parses cached responses without the network.
+# When the cache grows past max_bytes the least recently used responses are deleted.
+# Loggers upload their records some time after they are logged, so a response is only cached when it was fetched at
+# least upload_grace after the end of its window - earlier responses may be missing late uploads. Live pulls of the
+# latest data are therefore not cached; quick-pulls of older ranges are.
+#
+# Usage: python HOBOlink_cache.py replay <cache_dir> <S|P> <base_dir>
+# Replays every cached response into a new base_dir. The parse functions append, so replay refuses a base_dir that
+# already holds a site's MasterTables, and skips the records of overlapping windows that were already replayed.
+
+# import modules
+import os, sys, gzip, json, tempfile, threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# 2 GB
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+KEY_FORMAT = '%Y%m%dT%H%M%S'
+
+# time a logger may take to upload the records of a window
+DEFAULT_UPLOAD_GRACE = timedelta(hours=6)
+
+class CachedResponse:
+    """
+    Stands in for a requests.Response when the data comes from the cache.
+    """
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+class ResponseCache:
+    """
+    gzip compressed JSON cache of API responses with size based LRU eviction. Safe to share between threads.
+
+    Parameters:
+    - directory: str or Path, directory holding the cache
+    - max_bytes: int, size of the cache on disk before the least recently used responses are deleted
+    - upload_grace: timedelta, a response is only cached when it was fetched this long after the end of its window
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, upload_grace=DEFAULT_UPLOAD_GRACE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.upload_grace = upload_grace
+        self.lock = threading.Lock()
+        self.total_bytes = sum(path.stat().st_size for path in self.directory.glob('*/*.json.gz'))
+
+    def path(self, logger, start_dt, end_dt):
+        return self.directory / str(logger) / f"{start_dt.strftime(KEY_FORMAT)}_{end_dt.strftime(KEY_FORMAT)}.json.gz"
+
+    def get(self, logger, start_dt, end_dt):
+        """
+        Returns the cached response data for a window, or None if it isn't cached.
+        Responses fetched before the window ended plus upload_grace (stored by older versions of put) are treated as
+        missing, since the logger may have uploaded more data for the window since.
+        """
+        path = self.path(logger, start_dt, end_dt)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if datetime.fromisoformat(entry['fetched']) < end_dt + self.upload_grace:
+            return None
+        # reading a response makes it the most recently used
+        os.utime(path)
+        return entry['response']
+
+    def put(self, logger, start_dt, end_dt, data):
+        """
+        Stores the response data for a window, then evicts the least recently used responses if the cache is full.
+        Windows that ended less than upload_grace ago are not stored - the logger may still upload records for them.
+
+        Returns:
+        - bool, True if the response was stored
+        """
+        fetched = datetime.now(timezone.utc)
+        if fetched < end_dt + self.upload_grace:
+            return False
+        path = self.path(logger, start_dt, end_dt)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {'logger': str(logger), 'start': start_dt.isoformat(), 'end': end_dt.isoformat(),
+                 'fetched': fetched.isoformat(), 'response': data}
+
+        # write to a temporary file and rename it, so readers never see a partial response
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as file:
+                file.write(json.dumps(entry, separators=(',', ':')).encode('utf-8'))
+            with self.lock:
+                old_size = path.stat().st_size if path.exists() else 0
+                os.replace(tmp_path, path)
+                self.total_bytes += path.stat().st_size - old_size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Deletes the least recently used responses until the cache is under max_bytes.
+        """
+        with self.lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            files = sorted(((path.stat().st_mtime, path.stat().st_size, path) for path in self.directory.glob('*/*.json.gz')))
+            for _, size, path in files:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                self.total_bytes -= size
+
+    def entries(self, logger=None):
+        """
+        Yields (logger, start_dt, end_dt, data) for every cached response, in time order for each logger.
+        """
+        loggers = [self.directory / str(logger)] if logger is not None else sorted(p for p in self.directory.iterdir() if p.is_dir())
+        for logger_path in loggers:
+            for path in sorted(logger_path.glob('*.json.gz')):
+                try:
+                    with gzip.open(path, 'rt', encoding='utf-8') as file:
+                        entry = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                yield (entry['logger'], datetime.fromisoformat(entry['start']), datetime.fromisoformat(entry['end']),
+                       entry['response'])
+
+def cache_from_env():
+    """
+    Returns the ResponseCache configured in the environment (.env), or None when caching is off.
+    - RESPONSE_CACHE_DIR: directory of the cache - caching is off when it isn't set
+    - RESPONSE_CACHE_MAX_GB: size of the cache in GB (default 2)
+    - RESPONSE_CACHE_GRACE_HOURS: hours a logger may take to upload a window (default 6), see ResponseCache.get
+    """
+    directory = os.environ.get("RESPONSE_CACHE_DIR")
+    if not directory:
+        return None
+    return ResponseCache(directory, max_bytes=int(float(os.environ.get("RESPONSE_CACHE_MAX_GB", 2)) * 1024 ** 3),
+                         upload_grace=timedelta(hours=float(os.environ.get("RESPONSE_CACHE_GRACE_HOURS", 6))))
+
+def replay(cache, df_sites, site_type, base_path=None):
+    """
+    Re-parses every cached response of the sites in df_sites, without making any API requests. The responses are
+    replayed in time order through the append path, so the records of a window that overlaps one already replayed
+    are skipped up to the last timestamp replayed - each record is written once.
+
+    Parameters:
+    - cache: ResponseCache
+    - df_sites: DataFrame, site metadata indexed by site_ID with 'logger_SN' and 'CDEC_ID' columns
+    - site_type: str, 'S' for streams or 'P' for precip
+    - base_path: str or None, the base path where files are saved
+
+    Returns:
+    - dict of {site ID: number of records parsed}
+
+    Raises:
+    - FileExistsError if a site already has MasterTables under base_path - replaying would append duplicate rows
+    """
+    import pandas as pd
+    from HOBOlink_plugins import parser_for
+
+    existing = [str(path) for site_id in df_sites.index
+                for path in (Path(base_path if base_path else './') / str(site_id)).glob('*/*_MasterTable_*.csv')]
+    if existing:
+        raise FileExistsError(f"Replay appends to the MasterTables, so it needs an empty base directory. "
+                              f"Found: {', '.join(existing)}")
+
+    records = {}
+    for site_id, row in df_sites.iterrows():
+        cdec_id = row.get('CDEC_ID')
+        cdec_id = None if pd.isna(cdec_id) or cdec_id == '' else cdec_id
+        parser = parser_for(row['site_type'] if pd.notna(row.get('site_type')) else site_type)
+        records[site_id] = 0
+        last_replayed = None
+        for _, _, _, data in cache.entries(row['logger_SN']):
+            if not data or len(data.get("data", [])) == 0:
+                continue
+            # drop the records an earlier, overlapping window already replayed
+            timestamps = pd.to_datetime([record['timestamp'] for record in data['data']], utc=True)
+            if last_replayed is not None:
+                new = timestamps > last_replayed
+                if not new.any():
+                    continue
+                data = {**data, 'data': [record for record, keep in zip(data['data'], new) if keep]}
+                timestamps = timestamps[new]
+            records[site_id] += parser.parse(data, site_id, cdec_id, base_path=base_path)
+            last_replayed = timestamps.max() if last_replayed is None else max(last_replayed, timestamps.max())
+    return records
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5 or sys.argv[1] != 'replay':
+        print("Usage: python HOBOlink_cache.py replay <cache_dir> <S|P> <base_dir>")
+        sys.exit(1)
+    import pandas as pd
+
+    site_type = sys.argv[3].upper()
+    from HOBOlink_plugins import parser_for
+    df_sites = pd.read_csv(parser_for(site_type).metadata_csv).set_index('site_ID')
+    print(replay(ResponseCache(sys.argv[2]), df_sites, site_type, base_path=sys.argv[4]))
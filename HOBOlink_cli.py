@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Single entry point for the HOBOlink scripts
+# Only argparse is imported at start up - pandas, requests and the HOBOlink modules are imported by the subcommand
+# that needs them, so `hobolink --help` and argument errors return right away.
+#
+# Usage:
+#   hobolink pull [--type S|P] [--sites WHT MCP]
+#   hobolink quick-pull <site_ID> <logger_SN> <start YYYY-MM-DD HH:MM:SSZ> <end YYYY-MM-DD HH:MM:SSZ> [--cdec WIC] [--interval 15]
+#   hobolink backfill <site_ID> <start YYYY-MM-DD HH:MM:SSZ> <end YYYY-MM-DD HH:MM:SSZ> [--base-dir DIR]
+#   hobolink reprocess <base_dir> [site_ID ...] [--shef]
+#   hobolink export <config.yml> <MasterTable.csv> <output.nc>
+#   hobolink replay <cache_dir> <S|P> <base_dir>
+# `python HOBOlink_cli.py ...` works the same without installing the package (pip install . adds `hobolink`).
+
+# import modules
+import sys, argparse
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S%z'
+
+def utc_time(value):
+    # argparse type for 'YYYY-MM-DD HH:MM:SSZ' timestamps
+    from datetime import datetime
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not in the format 'YYYY-MM-DD HH:MM:SSZ'")
+
+def pull(args):
+    import HOBOlink
+    HOBOlink.main(site_type=args.type, site_ids=args.sites)
+
+def quick_pull(args):
+    import HOBOlink_quick_pull
+    HOBOlink_quick_pull.main(site_id=args.site_id, logger_id=args.logger_sn, cdec=args.cdec, start_dt=args.start,
+                             end_dt=args.end, interval_minutes=args.interval, n_channels=args.n_channels)
+
+def backfill(args):
+    from HOBOlink_backfill import backfill_site
+    records = backfill_site(args.site_id, args.start, args.end, base_path=args.base_dir)
+    print(f"Reprocessed {records} records for {args.site_id}.")
+
+def reprocess(args):
+    from HOBOlink_reprocess import reprocess_sites, metadata_sites
+    reprocess_sites(metadata_sites(args.sites), base_path=args.base_dir, shef_toggle=args.shef)
+
+def export(args):
+    from HOBOlink_netcdf import export_netcdf
+    rows = export_netcdf(args.config, args.csv, args.nc)
+    print(f"Appended {rows} rows to {args.nc}")
+
+def replay(args):
+    import pandas as pd
+    from HOBOlink_cache import ResponseCache, replay as replay_cache
+    from HOBOlink_plugins import parser_for
+    df_sites = pd.read_csv(parser_for(args.type).metadata_csv).set_index('site_ID')
+    print(replay_cache(ResponseCache(args.cache_dir), df_sites, args.type, base_path=args.base_dir))
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='hobolink', description='Pull and process CW3E data from the HOBOlink API')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('pull', help='pull all new data for every site in the metadata csv (HOBOlink.py)')
+    command.add_argument('--type', default='S', type=str.upper, choices=['S', 'P'], help='S = streams, P = precip')
+    command.add_argument('--sites', nargs='+', help='only pull these site IDs')
+    command.set_defaults(func=pull)
+
+    command = commands.add_parser('quick-pull', help='pull one stream site for a time range and fill its gaps (HOBOlink_quick_pull.py)')
+    command.add_argument('site_id')
+    command.add_argument('logger_sn')
+    command.add_argument('start', type=utc_time)
+    command.add_argument('end', type=utc_time)
+    command.add_argument('--cdec', help='CDEC ID - SHEF files are only written when it is given')
+    command.add_argument('--interval', type=int, default=15, help='logging interval in minutes')
+    command.add_argument('--n-channels', type=int, default=6, help='values the logger reports per timestamp')
+    command.set_defaults(func=quick_pull)
+
+    command = commands.add_parser('backfill', help='re-pull a date range of a precip site (HOBOlink_backfill.py)')
+    command.add_argument('site_id')
+    command.add_argument('start', type=utc_time)
+    command.add_argument('end', type=utc_time)
+    command.add_argument('--base-dir')
+    command.set_defaults(func=backfill)
+
+    command = commands.add_parser('reprocess', help='rebuild the Processed outputs from the Raw tables (HOBOlink_reprocess.py)')
+    command.add_argument('base_dir')
+    command.add_argument('sites', nargs='*', help='site IDs, default every site in Streams_Metadata.csv')
+    command.add_argument('--shef', action='store_true', help='also rewrite the SHEF hourly files')
+    command.set_defaults(func=reprocess)
+
+    command = commands.add_parser('export', help='append a MasterTable to a NetCDF file (HOBOlink_netcdf.py)')
+    command.add_argument('config')
+    command.add_argument('csv')
+    command.add_argument('nc')
+    command.set_defaults(func=export)
+
+    command = commands.add_parser('replay', help='re-parse the cached API responses (HOBOlink_cache.py)')
+    command.add_argument('cache_dir')
+    command.add_argument('type', type=str.upper, choices=['S', 'P'])
+    command.add_argument('base_dir')
+    command.set_defaults(func=replay)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
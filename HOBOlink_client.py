@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# import modules
+import time, random, threading
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from HOBOlink_cache import CachedResponse
+from HOBOlink_metrics import metrics
+
+# HOBOlink "Get Data Endpoint"
+API_URL = "https://api.hobolink.licor.cloud/v1/data"
+
+# The API returns at most 100,000 data points per request - HOBOlink_parse.plan_chunks sizes its windows from it
+MAX_POINTS = 100000
+
+# status codes that are worth retrying - 509 is returned when the account goes over its request limit
+RETRY_STATUS = {500, 502, 503, 504, 509}
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by every thread that uses the same HOBOlink account.
+    Tokens refill continuously at `rate` per second up to `capacity`, so a long backfill runs at the
+    full allowed request rate instead of sleeping a fixed amount of time between requests.
+
+    Parameters:
+    - rate: float, number of requests allowed per second
+    - capacity: int or None, largest burst of requests allowed at once. Defaults to 1 (no bursts)
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity else 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # no limit when the rate is 0 or negative
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+def url_time(dt, target_format):
+    """
+    Formats a datetime as a url parameter, e.g. url_time(dt, 'start') -> "&start_date_time=2024-06-26+18%3A55%3A00"
+    """
+    return dt.strftime('&{}_date_time=%Y-%m-%d+%H:%M:%S'.format(target_format.lower())).replace(':', '%3A')
+
+def retry_after_seconds(response):
+    """
+    Returns the number of seconds requested by a Retry-After header, or None if the header is missing or invalid.
+    The header can either be a number of seconds or an HTTP date.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_dt.tzinfo is None:
+        retry_dt = retry_dt.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_dt - datetime.now(timezone.utc)).total_seconds())
+
+class HOBOlinkClient:
+    """
+    Reusable HOBOlink API client. Requests go through one pooled keep-alive `requests.Session`, are spaced out by a
+    token bucket and are retried with exponential backoff and jitter when the API returns 509 or a 5xx error.
+
+    Parameters:
+    - token: str, HOBOlink API token
+    - base_url: str, url of the "Get Data Endpoint"
+    - requests_per_second: float, request rate allowed for the account
+    - burst: int, largest burst of requests allowed at once
+    - max_retries: int, number of times a failed request is retried before the response is returned to the caller
+    - backoff_factor: float, base delay in seconds for the exponential backoff
+    - max_backoff: float, longest delay in seconds between retries
+    - pool_size: int, number of keep-alive connections kept open - should be at least the number of workers
+    - timeout: float, seconds to wait for the server before giving up on a request
+    - cache: HOBOlink_cache.ResponseCache or None, responses are read from and saved to the cache when one is given
+    """
+    def __init__(self, token, base_url=API_URL, requests_per_second=1.0, burst=1, max_retries=5,
+                 backoff_factor=1.0, max_backoff=60.0, pool_size=10, timeout=120, cache=None):
+        self.base_url = base_url
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.limiter = TokenBucket(requests_per_second, burst)
+
+        # requests is only imported when a client is made - HOBOlink_parse imports MAX_POINTS from this module
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.retry_errors = (requests.ConnectionError, requests.Timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'accept': 'application/json',
+            'Authorization': 'Bearer ' + (token or '')}) # HTTP Authentication required for HOBOlink
+
+    def backoff(self, attempt, response=None):
+        # honour Retry-After when the server sends it, otherwise use exponential backoff with full jitter
+        if response is not None:
+            retry_after = retry_after_seconds(response)
+            if retry_after is not None:
+                return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def get(self, url):
+        """
+        Sends a GET request, retrying on connection errors, 509 and 5xx responses.
+        Returns the last response received - the caller is responsible for checking the status code.
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout, verify=True)
+            except self.retry_errors:
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            if response.status_code in RETRY_STATUS and attempt < self.max_retries:
+                time.sleep(self.backoff(attempt, response))
+                attempt += 1
+                continue
+            return response
+
+    def get_data(self, logger, start_time, end_time):
+        """
+        Requests data for a logger from the "Get Data Endpoint".
+
+        Parameters:
+        - logger: str, logger serial number
+        - start_time: str, url encoded start time, e.g. "&start_date_time=2024-06-26+18%3A55%3A00"
+        - end_time: str, url encoded end time, e.g. "&end_date_time=2024-08-13+00%3A00%3A00"
+        """
+        return self.get(self.base_url + "?loggers=" + str(logger) + start_time + end_time)
+
+    def get_window(self, logger, start_dt, end_dt, logging_interval_minutes, max_points=MAX_POINTS):
+        """
+        Requests the data for one window (see HOBOlink_parse.plan_chunks). If the response holds max_points or more
+        observations it was probably truncated by the API, so the window is split in half and each half is requested
+        again until the responses fit. Windows found in the cache are not requested.
+
+        Parameters:
+        - logger: str, logger serial number
+        - start_dt, end_dt: datetime, first and last timestamp of the window (both inclusive)
+        - logging_interval_minutes: int, logging interval of the site - windows are split on whole intervals
+        - max_points: int, data point limit of the API
+
+        Yields:
+        - (start_dt, end_dt, response, data) for each window that was requested. data is the decoded JSON body,
+          or None if the body could not be decoded.
+        """
+        if self.cache is not None:
+            with metrics.stage('cache_read') as stage:
+                data = self.cache.get(logger, start_dt, end_dt)
+                stage.rows = len(data.get("data", [])) if isinstance(data, dict) else 0
+            if data is not None:
+                yield start_dt, end_dt, CachedResponse(data), data
+                return
+
+        with metrics.stage('fetch') as stage:
+            response = self.get_data(logger, url_time(start_dt, 'start'), url_time(end_dt, 'end'))
+            stage.bytes = len(response.content)
+        with metrics.stage('decode') as stage:
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            stage.rows = len(data.get("data", [])) if isinstance(data, dict) else 0
+
+        step = timedelta(minutes=int(logging_interval_minutes))
+        truncated = (response.status_code == 200 and isinstance(data, dict)
+                     and len(data.get("data", [])) >= max_points)
+        if truncated and end_dt - start_dt >= step:
+            # split on a whole logging interval and request both halves
+            middle = start_dt + ((end_dt - start_dt) // 2 // step) * step
+            yield from self.get_window(logger, start_dt, middle, logging_interval_minutes, max_points)
+            yield from self.get_window(logger, middle + step, end_dt, logging_interval_minutes, max_points)
+            return
+        if self.cache is not None and response.status_code == 200 and isinstance(data, dict):
+            self.cache.put(logger, start_dt, end_dt, data)
+        yield start_dt, end_dt, response, data
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Write-ahead journal for the files written by a batch of new data
+# parse_stream and backfill_stream write a batch to the Raw and Processed MasterTables, the daily files and the SHEF
+# files; parse_precip and parse_met write the precip and met tables, their daily files and the precip accumulator.
+# Instead of appending to each file in turn, the batch is staged in a journal: every write (file, size of the file before the
+# write, bytes to write) and the state file updates. The journal is written to a temporary file, fsynced and renamed
+# to {site}/{site}_journal - the rename is the commit point. The writes are then applied, each file is fsynced and the
+# journal is removed.
+#
+# If a run is killed:
+# - before the rename, no file was touched and the temporary file is deleted at the next start
+# - after the rename, recover() applies the journal again - every file is truncated back to its size before the
+#   batch and the batch is written again, so a partly applied batch is finished exactly once
+# Recovery only checks for the journal file of each site, so it costs nothing when the last run finished cleanly.
+#
+#   journal = Journal(journal_path(base_path, site))
+#   journal.append(path, text, 0o644)
+#   journal.commit_timestamp(state_path, last_timestamp)
+#   journal.commit()
+
+# import modules
+import os, json, tempfile
+from pathlib import Path
+from HOBOlink_state import update_state, commit_timestamp
+
+def journal_path(base_path, site_name):
+    """
+    Returns the path of the journal for a site: {base_path}/{site_name}/{site_name}_journal
+    """
+    return Path(base_path if base_path else './') / site_name / f"{site_name}_journal"
+
+def fsync_dir(path):
+    # make a rename, a new file or a removed file in a directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Journal:
+    """
+    Writes staged for one batch - see the module notes.
+
+    Parameters:
+    - path: path of the journal file (see journal_path)
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.files = {}    # resolved path -> {'path', 'size', 'permissions', 'data'}
+        self.state = []    # state file updates, applied after the files
+
+    def is_new(self, path):
+        # True when the file doesn't exist and nothing was staged for it yet - i.e. it needs a header
+        path = Path(path).resolve()
+        return path not in self.files and not path.exists()
+
+    def append(self, path, text, permissions, replace=False):
+        """
+        Stages text to append to a file (created if it doesn't exist).
+
+        Parameters:
+        - path: str or Path, file written
+        - text: str, text appended to the file
+        - permissions: int, file permissions set after the write
+        - replace: bool, replace the contents of the file instead of appending
+        """
+        path = Path(path).resolve()
+        entry = self.files.get(path)
+        if entry is None or replace:
+            size = 0 if replace else (path.stat().st_size if path.exists() else 0)
+            entry = self.files[path] = {'path': str(path), 'size': size, 'permissions': permissions, 'data': []}
+        entry['permissions'] = permissions
+        entry['data'].append(text.encode('utf-8'))
+
+    def update_state(self, state_path, **fields):
+        # see HOBOlink_state.update_state
+        self.state.append({'path': str(Path(state_path).resolve()), 'op': 'update', 'fields': fields})
+
+    def commit_timestamp(self, state_path, timestamp, key='last_timestamp'):
+        # see HOBOlink_state.commit_timestamp
+        self.state.append({'path': str(Path(state_path).resolve()), 'op': 'timestamp', 'timestamp': timestamp, 'key': key})
+
+    def staged_bytes(self):
+        return sum(len(chunk) for entry in self.files.values() for chunk in entry['data'])
+
+    def commit(self):
+        """
+        Writes the journal, applies it and removes it. Returns the number of bytes written to the data files.
+        """
+        if not self.files and not self.state:
+            return 0
+        entries, payload = [], []
+        for entry in self.files.values():
+            data = b''.join(entry['data'])
+            entries.append({'path': entry['path'], 'size': entry['size'], 'permissions': entry['permissions'], 'length': len(data)})
+            payload.append(data)
+        header = json.dumps({'files': entries, 'state': self.state}).encode('utf-8') + b'\n'
+
+        # the rename makes the batch durable - from here on it is applied, now or by recover()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(header)
+                for data in payload:
+                    file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        fsync_dir(self.path.parent)
+
+        apply_journal(self.path)
+        self.files, self.state = {}, []
+        return sum(entry['length'] for entry in entries)
+
+def apply_journal(path):
+    """
+    Applies a committed journal and removes it. Safe to repeat: each file is truncated back to its size before the
+    batch and the batch is written again.
+    """
+    path = Path(path)
+    with open(path, 'rb') as file:
+        record = json.loads(file.readline())
+        created_dirs = set()
+        for entry in record['files']:
+            data = file.read(entry['length'])
+            target = Path(entry['path'])
+            if not target.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(target.parent)
+            with open(target, 'ab') as out:
+                out.truncate(entry['size'])
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+            os.chmod(target, entry['permissions'])
+    for directory in created_dirs:
+        fsync_dir(directory)
+
+    for update in record['state']:
+        if update['op'] == 'timestamp':
+            commit_timestamp(update['path'], update['timestamp'], key=update['key'])
+        else:
+            update_state(update['path'], **update['fields'])
+
+    os.remove(path)
+    fsync_dir(path.parent)
+
+def recover(base_path, site_name):
+    """
+    Finishes the last batch of a site if the run writing it was killed. Called before a site is read or written.
+
+    Returns:
+    - bool, True when a journal was applied
+    """
+    path = journal_path(base_path, site_name)
+    # journals that were never committed - none of their writes were applied
+    if path.parent.exists():
+        for tmp_path in path.parent.glob(f"{path.name}*.tmp"):
+            tmp_path.unlink()
+    if not path.exists():
+        return False
+    apply_journal(path)
+    return True
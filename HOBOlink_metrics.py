@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Timing and counters for the stages of the pull pipeline
+# Stages: fetch, cache_read, decode, transform, discharge, csv_write, daily_write, shef_write, journal_commit
+# Every stage records its duration, rows and bytes for the site being pulled. At the end of a run the totals are
+# written as a Prometheus text file (e.g. for the node_exporter textfile collector) and a JSON summary.
+#
+#   stage = metrics.stage('transform')      # starts timing
+#   ...
+#   stage.stop(rows=len(df))
+#
+#   with metrics.stage('csv_write') as stage:
+#       ...
+#       stage.bytes = written
+
+# import modules
+import os, json, time, tempfile, threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+# order of the stages in the pipeline - used to order the summaries
+STAGES = ('cache_read', 'fetch', 'decode', 'transform', 'discharge', 'csv_write', 'daily_write', 'shef_write', 'journal_commit')
+
+def stage_order(stage):
+    return (STAGES.index(stage), stage) if stage in STAGES else (len(STAGES), stage)
+
+class Stage:
+    """
+    A running stage timer - see Metrics.stage. Can be stopped explicitly or used as a context manager.
+    """
+    def __init__(self, metrics, name, site, rows=0, nbytes=0):
+        self.metrics = metrics
+        self.name = name
+        self.site = site
+        self.rows = rows
+        self.bytes = nbytes
+        self.stopped = False
+        self.start = time.perf_counter()
+
+    def stop(self, rows=None, nbytes=None):
+        if self.stopped:
+            return
+        self.stopped = True
+        if rows is not None:
+            self.rows = rows
+        if nbytes is not None:
+            self.bytes = nbytes
+        self.metrics.add(self.name, time.perf_counter() - self.start, self.rows, self.bytes, self.site)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stop()
+        return False
+
+class Metrics:
+    """
+    Thread safe totals of seconds, calls, rows and bytes per (site, stage).
+    The site of a stage defaults to the site set on the current thread with set_site, so functions deep in the
+    pipeline don't need to be given the site name.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.totals = defaultdict(lambda: {'seconds': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0})
+
+    def set_site(self, site):
+        # label for every stage recorded on this thread from now on
+        self.local.site = site
+
+    def current_site(self):
+        return getattr(self.local, 'site', None) or 'all'
+
+    def stage(self, name, site=None, rows=0, nbytes=0):
+        """
+        Starts timing a stage and returns its Stage.
+        """
+        return Stage(self, name, site or self.current_site(), rows, nbytes)
+
+    def add(self, name, seconds, rows=0, nbytes=0, site=None):
+        with self.lock:
+            total = self.totals[(site or self.current_site(), name)]
+            total['seconds'] += seconds
+            total['calls'] += 1
+            total['rows'] += int(rows or 0)
+            total['bytes'] += int(nbytes or 0)
+
+    def summary(self):
+        """
+        Returns the totals as {'run': {...}, 'sites': {site: {stage: {...}}}, 'stages': {stage: {...}}}.
+        """
+        with self.lock:
+            items = [(site, stage, dict(total)) for (site, stage), total in self.totals.items()]
+        sites, stages = defaultdict(dict), defaultdict(lambda: {'seconds': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0})
+        for site, stage, total in sorted(items, key=lambda item: (item[0], stage_order(item[1]))):
+            total['seconds'] = round(total['seconds'], 6)
+            sites[site][stage] = total
+            for key in ('seconds', 'calls', 'rows', 'bytes'):
+                stages[stage][key] += total[key]
+        for total in stages.values():
+            total['seconds'] = round(total['seconds'], 6)
+        stages = {stage: stages[stage] for stage in sorted(stages, key=stage_order)}
+        return {
+            'run': {'started': datetime.fromtimestamp(self.started, timezone.utc).strftime('%Y-%m-%d %H:%M:%SZ'),
+                    'duration_seconds': round(time.time() - self.started, 3)},
+            'sites': dict(sites),
+            'stages': stages,
+        }
+
+    def site_summary(self, site):
+        """
+        Returns one line with the time spent in each stage for a site, e.g. for the site's log file.
+        """
+        stages = self.summary()['sites'].get(site, {})
+        return 'Stage times: ' + ', '.join(f"{stage} {total['seconds']:.2f}s ({total['rows']} rows)"
+                                           for stage, total in stages.items())
+
+    def prometheus(self):
+        """
+        Returns the totals in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        lines = []
+        for key, metric, help_text in (
+                ('seconds', 'hobolink_stage_seconds_total', 'Time spent in each pipeline stage'),
+                ('calls', 'hobolink_stage_calls_total', 'Number of times each pipeline stage ran'),
+                ('rows', 'hobolink_stage_rows_total', 'Rows handled by each pipeline stage'),
+                ('bytes', 'hobolink_stage_bytes_total', 'Bytes read or written by each pipeline stage')):
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for site, stages in summary['sites'].items():
+                for stage, total in stages.items():
+                    lines.append(f'{metric}{{site="{site}",stage="{stage}"}} {total[key]}')
+        lines.append('# HELP hobolink_run_duration_seconds Duration of the last run')
+        lines.append('# TYPE hobolink_run_duration_seconds gauge')
+        lines.append(f"hobolink_run_duration_seconds {summary['run']['duration_seconds']}")
+        lines.append('# HELP hobolink_run_timestamp_seconds Start time of the last run')
+        lines.append('# TYPE hobolink_run_timestamp_seconds gauge')
+        lines.append(f'hobolink_run_timestamp_seconds {self.started:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory, name='hobolink_metrics'):
+        """
+        Writes {name}.prom and {name}.json to a directory. Both files are replaced atomically so a collector never
+        reads a partial file, and the temporary file is removed if a write fails.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for path, text in ((directory / f'{name}.prom', self.prometheus()),
+                           (directory / f'{name}.json', json.dumps(self.summary(), indent=2) + '\n')):
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=path.name, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    file.write(text)
+                os.chmod(tmp_path, 0o664)
+                os.replace(tmp_path, path)
+            except BaseException:
+                # don't leave the temporary file behind for the collector directory to fill up with
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+def file_size(path):
+    # size of a file, 0 if it doesn't exist yet - used to count the bytes appended to a file
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+# Shared by the client, the parse functions and the pull scripts
+metrics = Metrics()
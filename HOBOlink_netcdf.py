@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Converts MasterTable csv files to NetCDF using the station configs (e.g. Russian_WHT.yml) and the
+# cdl templates (e.g. Russian_WHT_template.cdl)
+# The csv is read in chunks and appended along the unlimited time dimension, so a daily run only writes
+# the rows that are newer than the last time already in the file. Those rows are found by seeking back from the end
+# of the csv, so a daily run only parses the new rows instead of the whole MasterTable.
+# Requires netCDF4 and PyYAML (pip install netCDF4 pyyaml)
+#
+# Usage: python HOBOlink_netcdf.py <config.yml> <MasterTable.csv> <output.nc>
+
+# import modules
+import re, os, csv, sys, numpy as np, pandas as pd
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import netCDF4
+except ImportError:  # only needed for the NetCDF export
+    netCDF4 = None
+
+try:
+    import yaml
+except ImportError:  # only needed to read the station configs
+    yaml = None
+
+# Value written to the csv files for missing data
+SENTINEL = -9999.99
+
+# Units of the time variable in the cdl templates
+TIME_UNITS = "seconds since 1970-01-01 00:00:00 0:00"
+
+def require_netcdf4():
+    if netCDF4 is None:
+        raise ImportError("The NetCDF export requires netCDF4. Install it with: pip install netCDF4")
+
+def load_config(config_path):
+    """
+    Reads a station config file (e.g. Russian_WHT.yml) and returns it as a dict.
+    """
+    if yaml is None:
+        raise ImportError("The station configs require PyYAML. Install it with: pip install pyyaml")
+    with open(config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+def parse_cdl_value(value):
+    # "text" -> str, -7999.0f -> float, 1 -> int
+    value = value.strip()
+    if value.startswith('"'):
+        return value.strip('"')
+    try:
+        return float(value.rstrip('f')) if re.search(r'[.eE]|f$', value) else int(value)
+    except ValueError:
+        return value
+
+def cdl_attributes(template_path):
+    """
+    Reads the attributes out of a cdl template.
+
+    Parameters:
+    - template_path: str or Path, path of the cdl template
+
+    Returns:
+    - dict of {variable name: {attribute: value}}. Global attributes are stored under the '' key.
+    """
+    attributes = {'': {}}
+    pattern = re.compile(r'^\s*(\w*)\s*:\s*(\w+)\s*=\s*(.*?)\s*;\s*$')
+    with open(template_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            match = pattern.match(line)
+            if match:
+                variable, name, value = match.groups()
+                attributes.setdefault(variable, {})[name] = parse_cdl_value(value)
+    return attributes
+
+def default_template(config_path):
+    """
+    Returns the cdl template that goes with a config file (Russian_WHT.yml -> Russian_WHT_template.cdl), or None.
+    """
+    template_path = Path(config_path).with_name(Path(config_path).stem + '_template.cdl')
+    return template_path if template_path.exists() else None
+
+def match_columns(header, variable_config):
+    """
+    Finds the csv column of each variable in a datafile config. Variables are matched by name first, then by
+    name and units (e.g. barometric_pressure + psi -> barometric_pressure_psi). The 'first column' index of the config
+    is not used - the column order differs between the Raw and Processed MasterTables, so it would export another
+    column under the variable's name. Variables without a column are skipped with a warning.
+
+    Returns:
+    - dict of {variable name: csv column name}, only the variables that were found
+    """
+    columns = {}
+    for variable in variable_config:
+        name = variable['variable name']
+        units = (variable.get('netCDF attributes') or {}).get('units', '')
+        if name in header:
+            columns[name] = name
+        elif f"{name}_{units}" in header:
+            columns[name] = f"{name}_{units}"
+        else:
+            print(f"Warning: no csv column found for variable '{name}' - it is left as fill values")
+    return columns
+
+def parse_times(values, time_format):
+    # csv timestamps -> UTC datetimes, falling back to mixed formats when the config format doesn't match
+    try:
+        return pd.to_datetime(values, format=time_format, utc=True)
+    except (TypeError, ValueError):
+        return pd.to_datetime(values, format='mixed', utc=True, errors='coerce')
+
+def tail_offset(file, data_start, time_index, last_time, time_format, block_size=65536):
+    """
+    Finds where the rows newer than last_time start by seeking back from the end of the csv, the same way
+    HOBOlink_parse.read_last_row reads the last row, so only the end of the file is parsed.
+
+    Parameters:
+    - file: csv file opened in binary mode
+    - data_start: int, byte offset of the first data row (after the header)
+    - time_index: int, index of the time column
+    - last_time: float, last time already in the NetCDF file, in seconds since 1970
+    - time_format: str or None, format of the time column
+
+    Returns:
+    - int, byte offset of the row after the last row at or before last_time, or data_start if there is none
+    """
+    file.seek(0, os.SEEK_END)
+    end = file.tell()
+    while end > data_start:
+        start = max(data_start, end - block_size)
+        file.seek(start)
+        block = file.read(end - start)
+        # the first line in the block may be cut off unless the start of the data has been reached
+        if start > data_start:
+            newline = block.find(b'\n')
+            if newline == -1:
+                block_size *= 2
+                continue
+            start, block = start + newline + 1, block[newline + 1:]
+        lines = block.split(b'\n')
+        offsets = start + np.cumsum([0] + [len(line) + 1 for line in lines[:-1]])
+        fields = [row[time_index] if len(row) > time_index else ''
+                  for row in csv.reader(line.decode('utf-8', errors='replace') for line in lines)]
+        seconds = (parse_times(pd.Series(fields), time_format) - pd.Timestamp(0, tz='UTC')).dt.total_seconds().to_numpy()
+        older = np.flatnonzero(seconds <= last_time)
+        if older.size:
+            return int(offsets[older[-1]] + len(lines[older[-1]]) + 1)
+        end = start
+    return data_start
+
+def create_station(dataset, config, template):
+    # Station metadata stored in the root group - see the top of the cdl templates
+    site = config['Site Configuration']
+    for name, key in (('lat', 'Lat'), ('lon', 'Lon'), ('elev', 'Elev')):
+        dataset.createDimension(name, 1)
+        variable = dataset.createVariable(name, 'f4', (name,))
+        variable.setncatts(template.get(name, {}))
+        variable[:] = site[key]
+
+    station_info = dataset.createVariable('station_info', 'S1')
+    station_info.setncatts({key.lower(): str(value) for key, value in (site.get('netCDF attributes') or {}).items()})
+    dataset.setncatts(template.get('', {}))
+
+def create_group(dataset, group_name, variable_config, template, chunk_length, complevel):
+    """
+    Creates a data group with an unlimited time dimension and one compressed, chunked variable per config entry.
+    Returns the existing group if it is already in the file.
+    """
+    if group_name in dataset.groups:
+        return dataset.groups[group_name]
+
+    group = dataset.createGroup(group_name)
+    group.createDimension('time', None)
+    time = group.createVariable('time', 'f8', ('time',), zlib=True, complevel=complevel, chunksizes=(chunk_length,))
+    time.setncatts(template.get('time', {'units': TIME_UNITS}))
+
+    for variable in variable_config:
+        name = variable['variable name']
+        config_attributes = dict(variable.get('netCDF attributes') or {})
+        fill_value = config_attributes.get('missing_value', template.get(name, {}).get('_FillValue', -7999.0))
+        nc_variable = group.createVariable(name, 'f4', ('time',), zlib=True, complevel=complevel, shuffle=True,
+                                           chunksizes=(chunk_length,), fill_value=fill_value)
+        # template attributes first, the station config wins where both define an attribute
+        attributes = {key: value for key, value in template.get(name, {}).items() if key != '_FillValue'}
+        attributes.update(config_attributes)
+        # numeric attributes have to match the float variable type
+        nc_variable.setncatts({key: np.float32(value) if isinstance(value, (int, float)) else value
+                               for key, value in attributes.items()})
+    return group
+
+def export_netcdf(config_path, csv_path, nc_path, template_path=None, datafile=0, chunksize=50000,
+                  chunk_length=4096, complevel=4):
+    """
+    Appends the rows of a MasterTable csv to a NetCDF file. The file and its groups are created on the first run;
+    later runs only read and write the rows after the last row at or before the last time in the group (see tail_offset).
+
+    Parameters:
+    - config_path: str or Path, station config (e.g. Russian_WHT.yml)
+    - csv_path: str or Path, MasterTable csv file
+    - nc_path: str or Path, NetCDF file to create or extend
+    - template_path: str, Path or None, cdl template. Defaults to the template next to the config file
+    - datafile: int, index of the entry in 'Datafile Configuration' that describes the csv
+    - chunksize: int, number of csv rows read at a time
+    - chunk_length: int, length of the NetCDF chunks along the time dimension
+    - complevel: int, zlib compression level (1-9)
+
+    Returns:
+    - The number of rows appended.
+    """
+    require_netcdf4()
+    config = load_config(config_path)
+    file_config = config['Datafile Configuration'][datafile]
+    variable_config = file_config['Variable Configuration']
+    template_path = template_path or default_template(config_path)
+    template = cdl_attributes(template_path) if template_path else {'': {}}
+    time_format = (file_config.get('Datetime Col Formats') or [None])[0]
+    header_line = int(file_config.get('First Data Line', 2)) - 2
+
+    nc_path = Path(nc_path)
+    nc_path.parent.mkdir(parents=True, exist_ok=True)
+    new_file = not nc_path.exists()
+    dataset = netCDF4.Dataset(nc_path, 'w' if new_file else 'a', format='NETCDF4')
+    appended = 0
+    try:
+        if new_file:
+            create_station(dataset, config, template)
+        group = create_group(dataset, file_config['Group Name'], variable_config, template, chunk_length, complevel)
+        time = group['time']
+        last_time = float(time[-1]) if time.shape[0] else -np.inf
+
+        with open(csv_path, 'rb') as file:
+            for _ in range(header_line):
+                file.readline()
+            header = next(csv.reader([file.readline().decode('utf-8')]))
+            columns = match_columns(header, variable_config)
+            time_column = 'timestamp_UTC' if 'timestamp_UTC' in header else \
+                header[int(file_config.get('First Datetime Col', 1)) - 1]
+
+            # skip the rows already in the file without parsing them
+            file.seek(tail_offset(file, file.tell(), header.index(time_column), last_time, time_format))
+            chunks = pd.read_csv(file, header=None, names=header, chunksize=chunksize) if file.peek(1) else []
+            for chunk in chunks:
+                timestamps = parse_times(chunk[time_column], time_format)
+                seconds = (timestamps - pd.Timestamp(0, tz='UTC')).dt.total_seconds().to_numpy()
+
+                # Only append rows that are newer than the data already in the file and than the rows before them,
+                # so duplicated or out of order rows in the csv never break the time axis
+                keep = seconds > np.maximum.accumulate(np.r_[last_time, seconds])[:-1]
+                if not keep.any():
+                    continue
+                start, count = time.shape[0], int(keep.sum())
+                time[start:start + count] = seconds[keep]
+
+                for variable in variable_config:
+                    name = variable['variable name']
+                    nc_variable = group[name]
+                    if name not in columns:
+                        nc_variable[start:start + count] = np.full(count, nc_variable._FillValue)
+                        continue
+                    values = pd.to_numeric(chunk[columns[name]], errors='coerce').to_numpy(dtype='float64')[keep]
+                    values[np.isnan(values) | np.isclose(values, SENTINEL)] = nc_variable._FillValue
+                    nc_variable[start:start + count] = values
+
+                last_time = seconds[keep].max()
+                appended += count
+
+        if appended:
+            first_time = float(time[0])
+            dataset.setncatts({
+                'time_coverage_start': datetime.fromtimestamp(first_time, timezone.utc).strftime('%Y-%m-%d %H:%M:%SZ'),
+                'time_coverage_end': datetime.fromtimestamp(last_time, timezone.utc).strftime('%Y-%m-%d %H:%M:%SZ')})
+        if new_file:
+            dataset.setncattr('date_created', datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%SZ'))
+    finally:
+        dataset.close()
+    return appended
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print("Usage: python HOBOlink_netcdf.py <config.yml> <MasterTable.csv> <output.nc>")
+        sys.exit(1)
+    rows = export_netcdf(sys.argv[1], sys.argv[2], sys.argv[3])
+    print(f"Appended {rows} rows to {sys.argv[3]}")
@@ -4,19 +4,27 @@
 # Adolfo Lopez Miranda
 
 # import modules
-import sys, requests, json, urllib3, pandas as pd, os, csv, numpy as np, pytz
+import sys, json, pandas as pd, os, csv, numpy as np, pytz, threading, tempfile, logging
 from datetime import datetime, timedelta, timezone
 from collections import namedtuple
 from pathlib import Path
 from io import StringIO
-
-# disable warnings for Insecure Request Warning
-urllib3.disable_warnings() # warnings occur when obtaining a token
+from HOBOlink_state import site_state_path, load_state
+from HOBOlink_metrics import metrics
+import HOBOlink_sensors
+from HOBOlink_resample import IntervalResampler
+from HOBOlink_journal import Journal, journal_path, recover
+from HOBOlink_client import MAX_POINTS
 
 # Functions to be used when pulling data from HOBOlink
 
 # function to obtain a new OAuth 2.0 token from the authentication server
 def get_new_token(auth_server_url, client_id, client_secret):
+    # requests is only imported when a token is needed - it is slow to import and the parse functions don't use it
+    import requests, urllib3
+    # disable warnings for Insecure Request Warning
+    urllib3.disable_warnings() # warnings occur when obtaining a token
+
     token_req_payload = {'grant_type': 'client_credentials'}
 
     token_response = requests.post(auth_server_url,
@@ -39,35 +47,105 @@ def get_num_lines(fname):
             pass
     return i + 1
 
-import pandas as pd
-from datetime import datetime, timedelta
+def read_last_row(filename, block_size=8192):
+    """
+    Returns the fields of the last complete, non-empty row of a CSV file by seeking back from the end of the file,
+    so only the last few kilobytes are read no matter how large the file is.
+    A trailing line without a newline (e.g. a write that was interrupted) is not considered complete and is skipped.
 
-def csv_timestamp(filename, logging_interval_minutes):
+    Parameters:
+    - filename (str): Path to the CSV file.
+    - block_size (int): Number of bytes read at a time while seeking back.
+
+    Returns:
+    - A list with the fields of the last row, or None if the file has no complete rows.
     """
-    Reads the last non-empty timestamp from a specified column in a CSV file, adjusts the time by a given interval,
+    with open(filename, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        buffer = b''
+        skip_partial = True  # the tail of the file after the last newline is an incomplete row
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            file.seek(position)
+            buffer = file.read(read_size) + buffer
+            if skip_partial:
+                newline = buffer.rfind(b'\n')
+                if newline == -1:
+                    continue
+                buffer = buffer[:newline + 1]
+                skip_partial = False
+            lines = buffer.splitlines()
+            # the first line in the buffer may be cut off unless the start of the file has been reached
+            complete = lines if position == 0 else lines[1:]
+            for line in reversed(complete):
+                if line.strip():
+                    return next(csv.reader([line.decode('utf-8')]))
+    return None
+
+def scan_last_timestamp(filename):
+    """
+    Reads the whole first column of a CSV file and returns the last non-empty value.
+    Only used as a fallback when the end of the file can't be parsed.
+    """
+    # Configure Pandas to read only the first column in chunks
+    chunk_iterator = pd.read_csv(filename, header=None, skip_blank_lines=True, iterator=True, chunksize=1000, usecols=[0])
+
+    date_str = None
+    for chunk in chunk_iterator:
+        for value in chunk.iloc[:, 0].dropna().iloc[::-1]:
+            # skip the header and any rows that don't hold a timestamp
+            try:
+                datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S%z')
+            except ValueError:
+                continue
+            date_str = str(value)
+            break
+    return date_str
+
+def csv_timestamp(filename, logging_interval_minutes, state_path=None):
+    """
+    Reads the last timestamp recorded in a MasterTable CSV file, adjusts the time by a given interval,
     and returns the adjusted time in both datetime and formatted string suitable for URL parameters.
 
+    The last timestamp is taken from the site's state file when one is provided, otherwise only the last row of the
+    CSV file is read. The whole file is only scanned if the last row can't be parsed.
+
     Parameters:
     - filename (str): Path to the CSV file.
     - logging_interval_minutes (int): Number of minutes to add to the last recorded timestamp.
+    - state_path (str, optional): Path to the site's state file (see HOBOlink_state.site_state_path).
 
     Returns:
     - A tuple containing the formatted timestamp string for URL use and the datetime object representing the adjusted time.
     """
-    # Configure Pandas to read only the first column in chunks
-    chunk_iterator = pd.read_csv(filename, header=None, skip_blank_lines=True, iterator=True, chunksize=1000, usecols=[0])
-    
+    utc_format = '%Y-%m-%d %H:%M:%S%z'
     date_str = None
-    for chunk in chunk_iterator:
-        last_row = chunk.dropna().tail(1)  # Use tail to get the last non-empty row
-        if not last_row.empty:
-            date_str = last_row.iloc[0, 0]  # Assuming timestamp is in the first column
+
+    # Use the last committed timestamp from the state file if there is one
+    if state_path is not None:
+        date_str = load_state(state_path).get('last_timestamp')
+
+    # Otherwise read only the last row of the file
+    if date_str is None:
+        last_row = read_last_row(filename)
+        if last_row:
+            try:
+                datetime.strptime(last_row[0], utc_format)
+                date_str = last_row[0]
+            except ValueError:
+                date_str = None
+
+    # The end of the file is corrupt (or only holds a header) - fall back to scanning the file
+    if date_str is None:
+        date_str = scan_last_timestamp(filename)
 
     if date_str is None:
         raise ValueError("No valid timestamps found in the CSV.")
 
     # Convert string to datetime object and add logging interval
-    dt_start = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S%z') + timedelta(minutes=logging_interval_minutes)
+    dt_start = datetime.strptime(date_str, utc_format) + timedelta(minutes=logging_interval_minutes)
     
     # Prepare timestamp for URL encoding
     start_timestamp = dt_start.strftime("&start_date_time=%Y-%m-%d+%H:%M:%S").replace(':', '%3A')
@@ -123,117 +201,95 @@ def start_time_offset(time_string, logging_int, target_format=None):
     
     return dt_time, timestamp
      
-# function to parse the data from the HOBOlink API
-def parse_stream(hobolink_data, site_name, cdec=None, base_path=None, shef_toggle=False):
-    
-    """
-    Parses JSON data that was pulled and found with the dictionary key "observation_list"
-    JSON data is passed into the DataFrame into daily CSV files within a specified or default directory structure.
-    
-    Parameters:
-    - hobolink_data: data returned by the HOBOLink API call
-    - site_name: str, the name of the site, used in the directory structure and file naming. Typically a 3 character ID
-    - base_path: str or None, the base path where files will be saved. If None, uses a default directory structure.
-    """   
+# Define units - will depend on what sensors are connected (see HOBOlink_sensors.py)
+SI_UNITS = HOBOlink_sensors.stream_plan.si_units
+US_UNITS = HOBOlink_sensors.stream_plan.us_units
 
-    observation_list = hobolink_data["data"]
-    
-    # Define units - will depend on what sensors are connected
-    si_units = {"kPa", "°C", "meters"}
-    us_units = {"psi", "°F", "feet"}
-
-    # Process observations into a list for DataFrame
-    rows = []
-    tracked_units = set()  # To track encountered units (excluding battery voltage)
+def decode_observations(observation_list, si_units=SI_UNITS, us_units=US_UNITS):
+    """
+    Converts the list of observations returned by the API ("data") into a wide DataFrame with one row per timestamp
+    and one column per sensor measurement type and unit system, e.g. "Water Level us", "Water Level si", "Battery".
+    The whole list is decoded in one vectorized pass: the observations are loaded as columns, keyed on
+    (timestamp, sensor_measurement_type, unit) and scattered into the wide frame. The first valid value is kept when
+    a key is repeated. See benchmarks/bench_decode.py for a comparison with the old row by row decoder.
 
-    for obs in observation_list:
-        unit = obs["unit"]
-        sensor_type = obs["sensor_measurement_type"]
-        
-        if sensor_type.lower() != "battery":  # Ignore battery voltage
-            tracked_units.add(unit)
+    Parameters:
+    - observation_list: list of dicts, the "data" field of the API response
+    - si_units: set, units that are given the " si" suffix
+    - us_units: set, units that are given the " us" suffix
 
+    Returns:
+    - DataFrame with a "timestamp" column (str) and a numeric column for each sensor. Empty if there were no valid values.
+    """
+    obs = pd.DataFrame.from_records(observation_list, columns=["timestamp", "sensor_measurement_type", "unit", "value"])
+    values = pd.to_numeric(obs["value"], errors="coerce").to_numpy(dtype=float)
+    valid = ~np.isnan(values) & obs["timestamp"].notna().to_numpy()
+    obs, values = obs[valid], values[valid]
+    if obs.empty:
+        return pd.DataFrame()
+
+    # Integer codes for each timestamp and each (sensor_measurement_type, unit) pair - there are only a handful of pairs,
+    # so the column names are built once per pair rather than once per observation
+    time_codes, timestamps = pd.factorize(obs["timestamp"], sort=True)
+    sensor_codes, sensors = pd.factorize(obs["sensor_measurement_type"].astype(str))
+    unit_codes, units = pd.factorize(obs["unit"], use_na_sentinel=False)
+    pair_codes, pairs = pd.factorize(sensor_codes * len(units) + unit_codes)
+    keys = []
+    for pair in pairs:
+        sensor, unit = sensors[pair // len(units)], units[pair % len(units)]
         if unit in si_units:
-            key = f"{sensor_type} si"
+            keys.append(f"{sensor} si")
         elif unit in us_units:
-            key = f"{sensor_type} us"
+            keys.append(f"{sensor} us")
         else:  # Battery voltage or other unknown units
-            key = sensor_type
-
-        rows.append({"timestamp": obs["timestamp"], key: obs["value"]})
+            keys.append(sensor)
+    key_codes, columns = pd.factorize(pd.Series(keys))
+    column_codes = key_codes[pair_codes]
+
+    # Scatter the values into a (timestamp x column) array, keeping the first value seen for each cell
+    cells = time_codes * len(columns) + column_codes
+    cells, first = np.unique(cells, return_index=True)
+    wide = np.full(len(timestamps) * len(columns), np.nan)
+    wide[cells] = values[first]
+
+    df = pd.DataFrame(wide.reshape(len(timestamps), len(columns)), columns=list(columns))
+    df.insert(0, "timestamp", np.asarray(timestamps, dtype=object))
+    return df
+
+# Decoded column names -> MasterTable column names
+STREAM_COLUMN_NAMES = {'timestamp': 'timestamp_UTC',
+                       'Water Temperature si': 'water_temperature_C',
+                       'Water Level si': 'water_level_m',
+                       'Water Pressure si': 'water_pressure_kPa',
+                       'Water Pressure us': 'water_pressure_psi',
+                       'Diff Pressure si': 'diff_pressure_kPa',
+                       'Diff Pressure us': 'diff_pressure_psi',
+                       'Water Temperature us': 'water_temperature_F',
+                       'Water Level us': 'water_level_ft',
+                       'Barometric Pressure si': 'barometric_pressure_kPa',
+                       'Barometric Pressure us': 'barometric_pressure_psi',
+                       'Battery': 'battery_V'
+                       }
+
+def stream_frame(df, plan=None):
+    """
+    Converts decoded stream observations (see decode_observations) to the MasterTable columns: fills each sensor's
+    missing unit from the other one, adds the water pressure, drops incomplete rows and rounds to two decimals.
 
-    # Create DataFrame
-    df = pd.DataFrame(rows)
-    
-    # If there's no values, or there were only Battery V measurements, return
-    if df.empty:
-        print('No new data found.')
-        return df.shape[0]
-    
-    df = df.groupby("timestamp", as_index=False).first()
-    df = df[~((df["Battery"].notna()) & (df.drop(columns=["timestamp", "Battery"]).isna().all(axis=1)))]
+    Parameters:
+    - df: DataFrame returned by decode_observations
+    - plan: SensorPlan or None, the unit conversions to apply (see HOBOlink_sensors.py). None uses the current plan
 
-    # Safely convert columns to numeric without triggering deprecation warnings
-    for col in df.columns:
-        try:
-            df[col] = pd.to_numeric(df[col])
-        except Exception:
-            pass
+    Returns:
+    - DataFrame with the Raw MasterTable columns and 'battery_V'. Timestamps are left as returned by the API.
+    """
+    plan = plan if plan is not None else HOBOlink_sensors.stream_plan
 
-    sensor_fields = {
-        'Diff Pressure': ('psi', 'kPa', 6.89476),
-        'Barometric Pressure': ('psi', 'kPa', 6.89476),
-        'Water Level': ('feet', 'meters', 0.3048),
-        'Water Temperature': ('F', 'C', None),
-    }
-
-    for sensor, (us_unit, si_unit, factor) in sensor_fields.items():
-        us_col = f"{sensor} us"
-        si_col = f"{sensor} si"
-
-        # Ensure numeric with NaNs where conversion fails
-        if us_col in df.columns:
-            df[us_col] = pd.to_numeric(df[us_col], errors='coerce')
-        if si_col in df.columns:
-            df[si_col] = pd.to_numeric(df[si_col], errors='coerce')
-
-        if sensor == "Water Temperature":
-            # Fill missing SI from US
-            if us_col in df.columns and si_col in df.columns:
-                df.loc[df[si_col].isna() & df[us_col].notna(), si_col] = (
-                    (df[us_col] - 32) * 5 / 9
-                )
-                df.loc[df[us_col].isna() & df[si_col].notna(), us_col] = (
-                    df[si_col] * 9 / 5 + 32
-                )
-            elif us_col in df.columns:
-                df[si_col] = (df[us_col] - 32) * 5 / 9
-            elif si_col in df.columns:
-                df[us_col] = df[si_col] * 9 / 5 + 32
-        else:
-            # Fill missing SI from US
-            if us_col in df.columns and si_col in df.columns:
-                df.loc[df[si_col].isna() & df[us_col].notna(), si_col] = df[us_col] * factor
-                df.loc[df[us_col].isna() & df[si_col].notna(), us_col] = df[si_col] / factor
-            elif us_col in df.columns:
-                df[si_col] = df[us_col] * factor
-            elif si_col in df.columns:
-                df[us_col] = df[si_col] / factor
-
-
-    # Ensure base pressures are numeric
-    for col in ['Barometric Pressure si', 'Diff Pressure si', 'Barometric Pressure us', 'Diff Pressure us']:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-
-    # Calculate Water Pressure in missing units
-    if 'Barometric Pressure si' in df.columns and 'Diff Pressure si' in df.columns:
-        df['Water Pressure si'] = df['Barometric Pressure si'] + df['Diff Pressure si']
-        df['Water Pressure us'] = df['Water Pressure si'] / 6.89476
-    elif 'Barometric Pressure us' in df.columns and 'Diff Pressure us' in df.columns:
-        df['Water Pressure us'] = df['Barometric Pressure us'] + df['Diff Pressure us']
-        df['Water Pressure si'] = df['Water Pressure us'] * 6.89476
+    # Drop timestamps where only the battery was reported
+    df = df[~((df["Battery"].notna()) & (df.drop(columns=["timestamp", "Battery"]).isna().all(axis=1)))]
 
+    # Fill the missing SI/US values and calculate the derived channels (e.g. Water Pressure) in one pass
+    df = plan.apply(df)
 
     df = df.dropna().reset_index(drop=True)
     # Apply rounding and formatting to all numeric values
@@ -241,117 +297,47 @@ def parse_stream(hobolink_data, site_name, cdec=None, base_path=None, shef_toggl
     df[numeric_cols] = df[numeric_cols].round(2)
 
     # Rename columns to match MasterTable column names
-    new_column_names = {'timestamp': 'timestamp_UTC',
-                        'Water Temperature si': 'water_temperature_C',
-                        'Water Level si': 'water_level_m',
-                        'Water Pressure si': 'water_pressure_kPa',
-                        'Water Pressure us': 'water_pressure_psi',
-                        'Diff Pressure si': 'diff_pressure_kPa',
-                        'Diff Pressure us': 'diff_pressure_psi',
-                        'Water Temperature us': 'water_temperature_F',
-                        'Water Level us': 'water_level_ft',
-                        'Barometric Pressure si': 'barometric_pressure_kPa',
-                        'Barometric Pressure us': 'barometric_pressure_psi',
-                        'Battery': 'battery_V'
-                        }
-    
-    df = df.rename(columns=new_column_names)
-    
+    df = df.rename(columns=STREAM_COLUMN_NAMES)
+
     # If one of the columns doesn't exist, create a column with the right name and fill with nans
-    for col in new_column_names.values():
+    for col in STREAM_COLUMN_NAMES.values():
         if col not in df.columns:
             df[col] = np.nan
+    return df
 
-# check for 15 minute data and then resample
+def resample_stream(df2, resampler=None):
+    """
+    Resamples Processed rows to 15 minute intervals when any timestamp is off the quarter hour, and fills missing
+    values with -9999.99. Channels are averaged over each interval, except the battery voltage, which keeps the last
+    reading of the interval.
 
-    # Define the path for the long-running file
-    # if base_path=None the rating curve csv file must be stored in the same directory as where the script is running
-    dir_path = Path(base_path if base_path else './')
-    #dir_path.mkdir(parents=True, exist_ok=True)  # Ensure directory exists
-    rating_curve_path = dir_path / f'{site_name}/Rating_Curve/{site_name}.rating_curve_100_points.csv'
-    
-    # check if there is a rating curve. If not, set discharge to -9999.99
-    rating_curve_exists = os.path.exists(rating_curve_path)
-    if rating_curve_exists:
-        print('Rating curve found.')
-        # load the rating curve
-        rating_curve = pd.read_csv(rating_curve_path)
-        # Apply the rating curve to calculate discharge
-        water_flow_cfs = df['water_level_ft'].apply(lambda x: calculate_discharge(x, rating_curve))
-        water_flow_cfs = water_flow_cfs.round(6)
-
-        # Convert from cfs to cms with a vectorized operation
-        water_flow_cms = np.where(water_flow_cfs == -9999.99,
-                                            -9999.99,
-                                            water_flow_cfs * 0.0283168).round(6)
-    else:
-        print('No rating curve. Setting all discharge to -9999.99')
-        # Set the discharge to -9999.99
-        water_flow_cfs = np.full(len(df['water_level_ft']),-9999.99)
-        water_flow_cms = np.full(len(df['water_level_ft']),-9999.99)
-    
-    # Add discharge columns to the dataframe
-    df2 = df.drop(columns=['battery_V'])
-    df2['discharge_cfs'] = water_flow_cfs
-    df2['discharge_cms'] = water_flow_cms
+    Parameters:
+    - df2: DataFrame with the Processed MasterTable columns, plus 'battery_V' when it is needed for SHEF
+    - resampler: IntervalResampler or None. With a resampler only the completed 15 minute bins are returned and the
+      last partial bin is carried over to the next batch (see HOBOlink_resample.py). Without one the whole batch is
+      resampled, including a partial bin at the end.
 
-    # Define new columns - used for QC process
-    df2['level_corrected_ft'] = [-9999.99] * len(df2)
-    df2['level_corrected_m'] = [-9999.99] * len(df2)
-    df2['qc_status'] = ["Provisional"] * len(df2)
-
-    # Define the desired order of columns for the processed data
-    desired_column_order = [
-			'timestamp_UTC',
-			'water_pressure_psi',
-			'barometric_pressure_psi',
-			'diff_pressure_psi',
-			'water_level_ft',
-			'level_corrected_ft',
-			'discharge_cfs',
-			'water_temperature_F',
-			'water_pressure_kPa',
-			'barometric_pressure_kPa',
-			'diff_pressure_kPa',
-			'water_level_m',
-			'level_corrected_m',
-			'discharge_cms',
-			'water_temperature_C',
-			'qc_status'
-    ]
-
-    # Define columns for Raw data (subset)
-    raw_columns = [
-			'timestamp_UTC',
-			'water_pressure_psi',
-			'barometric_pressure_psi',
-			'diff_pressure_psi',
-			'water_level_ft',
-			'water_temperature_F',
-			'water_pressure_kPa',
-			'barometric_pressure_kPa',
-			'diff_pressure_kPa',
-			'water_level_m',
-			'water_temperature_C'
-    ]
-
-    # Reorder columns for processed data
-    df2 = df2[desired_column_order]
-
-    # Resample the data to correct 15-minute intervals
+    Returns:
+    - DataFrame with 'timestamp_UTC' formatted as 'YYYY-MM-DD HH:MM:SSZ'
+    """
     df2['timestamp_UTC'] = pd.to_datetime(df2['timestamp_UTC'])
 
-    if any(df2['timestamp_UTC'].dt.minute % 15 != 0):
+    if any(df2['timestamp_UTC'].dt.minute % 15 != 0) or (resampler is not None and resampler.carrying()):
         print("There are timestamps with irregular minutes. Resampling.")
-        
+
+        if resampler is not None:
+            df2_resampled = resampler.resample(df2.drop(columns='qc_status'))
+            df2_resampled["qc_status"] = 'Provisional'
+            return df2_resampled
+
         df2.set_index('timestamp_UTC', inplace=True)
         df2.replace(-9999.99, np.nan, inplace=True)
-        
-        # Define aggregation rules (mean for numeric columns)
-        aggregations = {col: 'mean' for col in df2.columns if col != 'qc_status'}
-        
+
+        # Define aggregation rules (mean for numeric columns, last reading for the battery)
+        aggregations = {col: 'last' if col == 'battery_V' else 'mean' for col in df2.columns if col != 'qc_status'}
+
         # Resample and round data
-        df2_resampled = df2.resample('15T').agg(aggregations).round(2)
+        df2_resampled = df2.resample('15min').agg(aggregations).round(2)
 
         # Fill NaN values with -9999.99 for numeric columns
         for col in df2_resampled.select_dtypes(include=['number']).columns:
@@ -359,369 +345,401 @@ def parse_stream(hobolink_data, site_name, cdec=None, base_path=None, shef_toggl
 
         df2_resampled["qc_status"] = 'Provisional'
         df2_resampled.index = df2_resampled.index.strftime('%Y-%m-%d %H:%M:%SZ')
-        
-        df2_resampled = df2_resampled.rename_axis('timestamp_UTC').reset_index()
-        df2 = df2_resampled
-    else:
-        print("All timestamps have regular minutes (00, 15, 30, or 45).")
-        df2['timestamp_UTC'] = df2['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%SZ')
 
-        # Fill NaN values with -9999.99
-        for col in df2.select_dtypes(include=['number']).columns:
-            df2[col] = df2[col].fillna(-9999.99)
+        return df2_resampled.rename_axis('timestamp_UTC').reset_index()
 
-    # Set up base master path
-    master_path = Path(base_path if base_path else './') / site_name
+    print("All timestamps have regular minutes (00, 15, 30, or 45).")
+    df2['timestamp_UTC'] = df2['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%SZ')
+
+    # Fill NaN values with -9999.99
+    for col in df2.select_dtypes(include=['number']).columns:
+        df2[col] = df2[col].fillna(-9999.99)
+    return df2
 
-    # Create subdirectories for Raw and Processed
+def stream_resampler(base_path, site_name, logging_interval_minutes=None):
+    """
+    Returns the IntervalResampler of a site's live stream pulls - 15 minute means, with the partial bin kept in the
+    site's state file under 'stream_resample'. Historical pulls must not use it: their rows are older than the state.
+    A bin is complete once the last row plus logging_interval_minutes reaches its end (see HOBOlink_resample.py).
+    """
+    interval = f'{int(logging_interval_minutes)}min' if logging_interval_minutes else None
+    return IntervalResampler('15min', {'battery_V': 'last'}, state_path=site_state_path(base_path, site_name),
+                             key='stream_resample', interval=interval)
+
+# One batch of stream data handed to each sink by process_stream
+# - processed: DataFrame with the Processed MasterTable columns, timestamps formatted as 'YYYY-MM-DD HH:MM:SSZ'
+# - battery: Series with the battery voltage of the decoded rows (only used for SHEF)
+# - rating_curve_exists: bool, the discharge was calculated with a rating curve
+# - journal: Journal the sinks stage their appends in - committed once every sink has written (see HOBOlink_journal.py)
+# - after_commit: list of callables run once the journal is committed - for writes that can't be journaled
+StreamBatch = namedtuple('StreamBatch', ['site_name', 'base_path', 'processed', 'battery', 'rating_curve_exists', 'journal',
+                                         'after_commit'])
+
+def site_tables(base_path, site_name):
+    """
+    Returns the paths of a site's Raw and Processed directories and MasterTables, creating the directories.
+    """
+    master_path = Path(base_path if base_path else './') / site_name
     raw_path = master_path / "Raw"
     processed_path = master_path / "Processed"
     raw_path.mkdir(parents=True, exist_ok=True)
     processed_path.mkdir(parents=True, exist_ok=True)
+    return (raw_path, processed_path, raw_path / f"{site_name}_MasterTable_Raw.csv",
+            processed_path / f"{site_name}_MasterTable_Processed.csv")
 
-    # File names
-    master_table_raw = raw_path / f"{site_name}_MasterTable_Raw.csv"
-    master_table_processed = processed_path / f"{site_name}_MasterTable_Processed.csv"
-
-    # Write to Raw CSV (only subset of columns)
-    df2[raw_columns].to_csv(master_table_raw, mode='a' if master_table_raw.exists() else 'w', 
-                            index=False, header=not master_table_raw.exists(), 
-                            escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+class AppendSink:
+    """
+    Appends the batch to the Raw and Processed MasterTables and records the last timestamp in the site's state file.
+    Used for new data, which always comes after the rows already in the tables. The appends and the timestamp are
+    staged in the batch's journal, so the tables and the state file are updated together.
+    """
+    def write(self, batch):
+        raw_path, processed_path, master_table_raw, master_table_processed = site_tables(batch.base_path, batch.site_name)
+        df2 = batch.processed
+        journal = batch.journal
+
+        with metrics.stage('csv_write', rows=len(df2)) as stage:
+            # Raw CSV (only subset of columns) - file permissions (User: RW, Group: R, Others: R) = `0o644`
+            raw_text = df2[RAW_COLUMNS].to_csv(None, index=False, header=journal.is_new(master_table_raw),
+                                               escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+            journal.append(master_table_raw, raw_text, 0o644)
+
+            # Processed CSV (all columns) - file permissions (User: RW, Group: RW, Others: R) = `0o664`
+            processed_text = df2.to_csv(None, index=False, header=journal.is_new(master_table_processed),
+                                        escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+            journal.append(master_table_processed, processed_text, 0o664)
+            stage.bytes = len(raw_text) + len(processed_text)
+
+        # Record the last timestamp written so the next run can resume without reading the MasterTable
+        journal.commit_timestamp(site_state_path(batch.base_path, batch.site_name), df2['timestamp_UTC'].max())
+
+class UpsertSink:
+    """
+    Merges the batch into the Raw and Processed MasterTables by timestamp (see upsert_csv) - rows for timestamps that
+    are already in a table replace them, so backfilled gaps land in time order without duplicates. The merged tables
+    and the timestamp are staged in the batch's journal, like AppendSink.
+    """
+    def write(self, batch):
+        raw_path, processed_path, master_table_raw, master_table_processed = site_tables(batch.base_path, batch.site_name)
+        df2 = batch.processed
+        journal = batch.journal
 
-    # Set file permissions for Raw (User: RW, Group: R, Others: R) = `0o644`
-    os.chmod(master_table_raw, 0o644)
+        with metrics.stage('csv_write', rows=len(df2)) as stage:
+            bytes_before = journal.staged_bytes()
+            upsert_csv(master_table_raw, df2[RAW_COLUMNS], permissions=0o644, journal=journal)
+            upsert_csv(master_table_processed, df2, permissions=0o664, journal=journal)
+            stage.bytes = journal.staged_bytes() - bytes_before
 
-    # Write to Processed CSV (all columns)
-    df2.to_csv(master_table_processed, mode='a' if master_table_processed.exists() else 'w', 
-            index=False, header=not master_table_processed.exists(), 
-            escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+        # The resume point only moves forward, so backfilling old gaps leaves it where it is
+        journal.commit_timestamp(site_state_path(batch.base_path, batch.site_name), df2['timestamp_UTC'].max())
 
-    # Set file permissions for Processed (User: RW, Group: RW, Others: R) = `0o664`
-    os.chmod(master_table_processed, 0o664)
+class ArchiveSink:
+    """
+    Writes the batch to the site's Parquet archive (see HOBOlink_archive.py, requires pyarrow). The Parquet files can't
+    be journaled, so they are written after the journal is committed - a run killed in between leaves the archive
+    missing the batch rather than holding rows the csv files don't have.
+    """
+    def write(self, batch):
+        from HOBOlink_archive import require_pyarrow, write_archive
+        require_pyarrow()
+        df2 = batch.processed
+        batch.after_commit.append(lambda: write_archive(df2[RAW_COLUMNS], batch.base_path, batch.site_name, 'Raw'))
+        batch.after_commit.append(lambda: write_archive(df2, batch.base_path, batch.site_name, 'Processed'))
+
+class DailySink:
+    """
+    Writes the batch to the Raw_Daily and Processed_Daily files - one write per daily file.
 
-    # Convert timestamp back for grouping
-    df2['timestamp_UTC'] = pd.to_datetime(df2['timestamp_UTC'], format='%Y-%m-%d %H:%M:%S%z')
+    Parameters:
+    - upsert: bool, merge the rows into the daily files by timestamp instead of appending them (used for backfills)
+    """
+    def __init__(self, upsert=False):
+        self.upsert = upsert
+
+    def write(self, batch):
+        raw_path, processed_path, _, _ = site_tables(batch.base_path, batch.site_name)
+        df2 = batch.processed
+        with metrics.stage('daily_write', rows=len(df2)):
+            if not self.upsert:
+                daily_writer.write(df2[RAW_COLUMNS], raw_path / "Raw_Daily", batch.site_name, 0o644, journal=batch.journal)
+                daily_writer.write(df2, processed_path / "Processed_Daily", batch.site_name, 0o664, journal=batch.journal)
+                return
+            for day, group in df2.groupby(df2['timestamp_UTC'].str[:10], sort=True):
+                year, month, day_of_month = day[:4], day[5:7], day[8:10]
+                daily_name = f"{batch.site_name}_{year}{month}{day_of_month}.csv"
+                upsert_csv(raw_path / "Raw_Daily" / year / month / daily_name, group[RAW_COLUMNS], permissions=0o644,
+                           journal=batch.journal)
+                upsert_csv(processed_path / "Processed_Daily" / year / month / daily_name, group, permissions=0o664,
+                           journal=batch.journal)
+
+class ShefSink:
+    """
+    Writes the batch as SHEF hourly files plus one file with every line (see write_shef). SHEF times are in Pacific time.
 
-    # Group data by date and hour
-    grouped = df2.groupby([
-        df2['timestamp_UTC'].dt.year,
-        df2['timestamp_UTC'].dt.month.apply(lambda x: f'{x:02d}'),
-        df2['timestamp_UTC'].dt.day.apply(lambda x: f'{x:02d}'),
-        df2['timestamp_UTC'].dt.hour.apply(lambda x: f'{x:02d}00')
-    ])
+    Parameters:
+    - cdec: str, CDEC ID used in the SHEF lines and file names
+    - single_file_name: str or None, name of the file that all lines are appended to
+    """
+    def __init__(self, cdec, single_file_name):
+        self.cdec = cdec
+        self.single_file_name = single_file_name
 
-    # Raw Daily & Processed Daily
-    for (year, month, day, hour), group in grouped:
-        
-        # **Raw Daily**
-        raw_daily_path = raw_path / "Raw_Daily" / str(year) / str(month)
-        raw_daily_path.mkdir(parents=True, exist_ok=True)
-        raw_daily_file = raw_daily_path / f"{site_name}_{year}{month}{day}.csv"
-        
-        # Format timestamp for storage
-        group['timestamp_UTC'] = group['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%S') + 'Z'
-        
-        # Store only selected raw columns
-        group[raw_columns].to_csv(raw_daily_file, mode='a' if raw_daily_file.exists() else 'w',
-                                index=False, header=not raw_daily_file.exists(),
-                                escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-
-        # Set file permissions for Raw Daily (User: RW, Group: R, Others: R) = `0o644`
-        os.chmod(raw_daily_file, 0o644)
-
-        # **Processed Daily**
-        processed_daily_path = processed_path / "Processed_Daily" / str(year) / str(month)
-        processed_daily_path.mkdir(parents=True, exist_ok=True)
-        processed_daily_file = processed_daily_path / f"{site_name}_{year}{month}{day}.csv"
-        
-        # Store entire DataFrame
-        group.to_csv(processed_daily_file, mode='a' if processed_daily_file.exists() else 'w',
-                    index=False, header=not processed_daily_file.exists(),
-                    escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-
-        # Set file permissions for Processed Daily (User: RW, Group: RW, Others: R) = `0o664`
-        os.chmod(processed_daily_file, 0o664)            
-       
-    
-    #------------------------------------------------------------------------------
-    
-    if shef_toggle == True and cdec != None:
-        # convert files to shef - must be done outside since the other files are in UTC 
+    def write(self, batch):
+        # convert files to shef - must be done outside since the other files are in UTC
+        df2 = batch.processed.copy()
         # Add battery column back in
-        df2['battery_V'] = df['battery_V']
-        
+        df2['battery_V'] = batch.battery
+
         # Ensure timestamps include a timezone offset instead of just 'UTC'
-        # If not, you'll need to preprocess them to include a proper offset (e.g., replace 'UTC' with '+0000')
         df2['timestamp_UTC'] = pd.to_datetime(df2['timestamp_UTC'], format='%Y-%m-%d %H:%M:%S%z')
-        
+
         # Convert to Pacific Time
         pacific = pytz.timezone('US/Pacific')
         df2['timestamp_UTC'] = df2['timestamp_UTC'].dt.tz_convert(pacific)
 
-        # Group data by date
-        grouped = df2.groupby([df2['timestamp_UTC'].dt.year, 
-                            df2['timestamp_UTC'].dt.month.apply(lambda x: f'{x:02d}'), 
-                            df2['timestamp_UTC'].dt.day.apply(lambda x: f'{x:02d}'),
-                            df2['timestamp_UTC'].dt.hour.apply(lambda x: f'{x:02d}')])
+        with metrics.stage('shef_write', rows=len(df2)):
+            write_shef(df2, batch.site_name, self.cdec, batch.base_path, batch.rating_curve_exists, self.single_file_name,
+                       journal=batch.journal)
 
-        for (year, month, day, hour), group in grouped:
-            #SHEF Hourly Output
-            shef_path = Path(base_path if base_path else f'./') / site_name / 'SHEF_Output' / str(year) / str(month) / str(day)
-            shef_path.mkdir(parents=True, exist_ok=True)
-            # Define the filename for SHEF files
-            shef_file = f"{cdec}_Streamflow_SHEF_{year}{month}{day}{hour}.txt"
-
-            # Full path for the file to be saved
-            shef_file_path = shef_path / shef_file
-            
-            # Determine the file mode: 'a' to append if the file exists, 'w' to write otherwise
-            file_mode = 'a' if shef_file_path.exists() else 'w'
-
-            # Open the file to write SHEF data
-            with shef_file_path.open(mode=file_mode) as file:
-                for _, row in group.iterrows():
-                    # Format the timestamp in SHEF format
-                    timestamp_shef = row['timestamp_UTC'].strftime('%Y%m%d%H%M')
-                    # Write stage and discharge lines in SHEF format
-                    """
-                    The .A format is designed for the transmission of one or more hydrometeorological parameters observed at various times for a single station.
-                    .A is the format used
-                    P indicates Pacific time
-                    DH = hour of day and also include minute value e.g. for 21:15 will be written as 2115
-                    HGI = river stage (feet)
-                    QRI = discharge (cubic feet per second)
-                    """
-                    # Write a shef line with the stage value
-                    data_line = f".A {cdec} {timestamp_shef[:8]} P DH{timestamp_shef[8:]} /HGI {format_shef_value(row['water_level_ft'])}"
-                    # If the rating_cuve_exists, include the discharge in the shef code.
-                    if rating_curve_exists:
-                        data_line = data_line + f"/QRI {format_shef_value(row['discharge_cfs'])}"
-                    # Include the water temperature (TWI for Fahrenheit, instantaneous)
-                    data_line = data_line + f"/TWI {format_shef_value(row['water_temperature_F'])}"
-                    # Include the barometric pressure (PAI in inHg, instantaneous).
-                    data_line = data_line + f"/PAI {format_shef_value(row['barometric_pressure_psi']*2.03602)}"
-                    # Include the battery data (VBI for battery voltage in Volts, instantaneous)
-                    data_line = data_line + f"/VBI {format_shef_value(row['battery_V'])}"
-                    
-
-                    # Write to the file
-                    file.write(data_line + '\n')
-                    os.chmod(shef_file_path, 0o664)
-            
-        #SHEF output - append all new data to one file
-        shef_path = Path(base_path if base_path else f'./') / site_name / 'SHEF_Output'
-        shef_path.mkdir(parents=True, exist_ok=True)
-        # Define the filename for SHEF files
-        shef_file = f"{cdec}_Streamflow_SHEF_latest.txt"
+def process_stream(hobolink_data, site_name, base_path=None, sinks=(), plan=None, resampler=None):
+    """
+    Stream processing engine shared by parse_stream, parse_stream_backfill and backfill_stream.
+    Decodes the observations, converts the units, calculates the discharge with the site's rating curve, resamples to
+    15 minutes and then hands the batch to each sink in order.
 
-        # Full path for the file to be saved
-        shef_file_path = shef_path / shef_file
-        
-        # Determine the file mode: 'a' to append if the file exists, 'w' to write otherwise
-        file_mode = 'a' if shef_file_path.exists() else 'w'
-        # check if there is any timestamp at the start of the new hour (00 minute)
-        #overwrite = df2['timestamp_UTC'].dt.minute.isin([0]).any()
-        #file_mode = 'w' if overwrite else 'a'
-            
-        # Open the file to write SHEF data
-        with shef_file_path.open(mode=file_mode) as file:
-            for _, row in df2.iterrows():
-                # Format the timestamp in SHEF format
-                timestamp_shef = row['timestamp_UTC'].strftime('%Y%m%d%H%M')
-                # Write stage and discharge lines in SHEF format
-                """
-                The .A format is designed for the transmission of one or more hydrometeorological parameters observed at various times for a single station.
-                .A is the format used
-                P indicates Pacific time
-                DH = hour of day and also include minute value e.g. for 21:15 will be written as 2115
-                HGI = river stage (feet)
-                QRI = discharge (cubic feet per second)
-                """
-                # Write a shef line with the stage value
-                data_line = f".A {cdec} {timestamp_shef[:8]} P DH{timestamp_shef[8:]} /HGI {format_shef_value(row['water_level_ft'])}"
-                # If the rating_cuve_exists, include the discharge in the shef code.
-                if rating_curve_exists:
-                    data_line = data_line + f"/QRI {format_shef_value(row['discharge_cfs'])}"
-                # Include the water temperature (TW for Fahrenheit, TU for Celcius)
-                data_line = data_line + f"/TWI {format_shef_value(row['water_temperature_F'])}"
-                # Include the barometric pressure (PAI in inHg, instantaneous).
-                data_line = data_line + f"/PAI {format_shef_value(row['barometric_pressure_psi']*2.03602)}"
-                # Include the battery data (VBI for battery voltage in Volts, instantaneous)
-                data_line = data_line + f"/VBI {format_shef_value(row['battery_V'])}"
-
-                # Write to the file
-                file.write(data_line + '\n')
-                os.chmod(shef_file_path, 0o775)
-
-    # Return both the number of records processed and the list of filenames
-    return df2.shape[0] #, filename_list
-
-# TODO: this function is no longer up to date
-def backfill_stream(hobolink_data,site_name, base_path=None, append_to_single_file=False):
-    # pass JSON data into a dateframe
-    df = pd.DataFrame.from_dict(hobolink_data["observation_list"])
-    # Parse data for stream gage
-    # Water Pressure
-    water_pressure = df.loc[df['sensor_measurement_type'] == 'Water Pressure']
-    # Check if the resulting DataFrame is empty
-    if water_pressure.empty:
-        # If no water pressure data is found, set default values
-        water_pressure_si = np.nan
-        water_pressure_us = np.nan
-        timestamp = np.nan
-    else:
-        water_pressure_si = water_pressure['si_value'].round(2).reset_index(drop=True)
-        water_pressure_us = water_pressure['us_value'].round(2).reset_index(drop=True)
-        # Date timestamps for data - each 'sensor_measurement_type' provides a 'timestamp' but only uses one value per timestamp so we drop duplicates
-        timestamp = water_pressure['timestamp'].reset_index(drop=True)
-        
-    # Difference Pressure
-    diff_pressure = df.loc[df['sensor_measurement_type'] == 'Diff Pressure']
-    # Check if the resulting DataFrame is empty
-    if diff_pressure.empty:
-        # If no water pressure data is found, set default values
-        diff_pressure_si = np.nan
-        diff_pressure_us = np.nan
-    else:
-        diff_pressure_si = diff_pressure['si_value'].round(2).reset_index(drop=True)
-        diff_pressure_us = diff_pressure['us_value'].round(2).reset_index(drop=True)
-
-    # Water Temperature
-    water_temp = df.loc[df['sensor_measurement_type'] == 'Water Temperature']
-    # Check if the resulting DataFrame is empty
-    if water_temp.empty:
-        # If no water pressure data is found, set default values
-        water_temp_si = np.nan
-        water_temp_us = np.nan
-    else:
-        water_temp_si = water_temp['si_value'].round(2).reset_index(drop=True)
-        water_temp_us = water_temp['us_value'].round(2).reset_index(drop=True)
-        
-    # Water Level
-    water_lvl = df.loc[df['sensor_measurement_type'] == 'Water Level']
-    # Check if the resulting DataFrame is empty
-    if water_lvl.empty:
-        # If no water pressure data is found, set default values
-        water_lvl_si = np.nan
-        water_lvl_us = np.nan
-    else:   
-        water_lvl_si = water_lvl['si_value'].round(2).reset_index(drop=True)
-        water_lvl_us = water_lvl['us_value'].round(2).reset_index(drop=True)
-    
-    # Barometric Pressure
-    bar_pressure = df.loc[df['sensor_measurement_type'] == 'Barometric Pressure']
-    # Check if the resulting DataFrame is empty
-    if bar_pressure.empty:
-        # If no barometric pressure data is found, set default values
-        bar_pressure_si = np.nan
-        bar_pressure_us = np.nan
-    else:
-        bar_pressure_si = bar_pressure['si_value'].round(2).reset_index(drop=True)
-        bar_pressure_us = bar_pressure['us_value'].round(2).reset_index(drop=True)
-        
-    # Attempt to filter for Water Flow measurements
-    water_flow = df.loc[df['sensor_measurement_type'] == 'Water Flow']
-    # Check if the resulting DataFrame is empty
-    if water_flow.empty:
-        # If no Water Flow data is found, set default values
-        water_flow_cfs = -9999.99
-        water_flow_cms = -9999.99
-    else:
-        # Proceed with the normal logic for non-empty DataFrame
-        water_flow_si = water_flow['si_value'].round(2).reset_index(drop=True)
-        water_flow_cfs = water_flow['us_value'].round(2).reset_index(drop=True)
-        # Convert L/s to m³/s and round to the second decimal point
-        water_flow_cms = (water_flow_si * 0.001).round(2)
-    
-    # Create a new dataframe with the parsed data
-    df2 = pd.DataFrame({'timestamp_UTC': timestamp,
-                        'water_temperature_Celsius': water_temp_si,
-                        'water_level_m': water_lvl_si,
-                        'water_pressure_kPa': water_pressure_si,
-                        'water_pressure_psi': water_pressure_us,
-                        'diff_pressure_kPa': diff_pressure_si,
-                        'diff_pressure_psi': diff_pressure_us,
-                        'water_temperature_Fahrenheit': water_temp_us,
-                        'water_level_ft': water_lvl_us,
-                        'barometric_pressure_kPa': bar_pressure_si,
-                        'barometric_pressure_psi': bar_pressure_us,
-                        'discharge_cfs': water_flow_cfs,
-                        'discharge_cms': water_flow_cms
-                        })
-
-    # Define new columns - used for QC process
-    new_columns = {
-        'level_corrected_ft': [-9999.99] * len(df2),
-        'level_corrected_m': [-9999.99] * len(df2),
-        'level_corrected_cm': [-9999.99] * len(df2),
-        'qc_status': ["Provisional"] * len(df2)
-        }
-
-    # Convert new columns to DataFrame
-    new_columns_df = pd.DataFrame(new_columns)
-
-    # Concatenate existing DataFrame with new columns
-    df2 = pd.concat([df2, new_columns_df], axis=1)
-
-    # Define the desired order of columns
-    desired_column_order = ['timestamp_UTC',
-                            'water_temperature_Celsius',
-                            'water_level_m',
-                            'water_pressure_kPa',
-                            'water_pressure_psi',
-                            'diff_pressure_kPa',
-                            'diff_pressure_psi',
-                            'water_temperature_Fahrenheit',
-                            'water_level_ft',
-                            'barometric_pressure_kPa',
-                            'barometric_pressure_psi',
-                            'level_corrected_ft',
-                            'level_corrected_m',
-                            'level_corrected_cm',
-                            'discharge_cfs',
-                            'discharge_cms',
-                            'qc_status']
-
-    # Reorder columns
-    df2 = df2[desired_column_order]
-
-    #read csv where data will be backfilled
-    csv_df = pd.read_csv(site_name + ".csv")
-
-    # Iterate over the rows in the CSV DataFrame
-    for index, csv_row in csv_df.iterrows():
-        # Find the index of the row in the original DataFrame with the same timestamp
-        idx = df2[df2['timestamp_UTC'] == csv_row.iloc[0]].index
-        if not idx.empty:
-           # Replace the row in the CSV DataFrame with the row from the original DataFrame
-            csv_df.loc[index] = df2.loc[idx].iloc[0]  # Update the row in the CSV DataFrame with the corresponding row from df2
-            # Write back the DataFrame to the CSV file, specifying header=True to keep the header
-            csv_df.to_csv(site_name + ".csv", index=False, header=True, escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-            #os.chmod(filepath, 0o775)
+    Parameters:
+    - hobolink_data: data returned by the HOBOLink API call
+    - site_name: str, the name of the site, used in the directory structure and file naming
+    - base_path: str or None, the base path where files are saved and the rating curve is read from
+    - sinks: list of sinks (AppendSink, UpsertSink, ArchiveSink, DailySink, ShefSink) - objects with a write(batch) method
+    - plan: SensorPlan or None, the unit conversions (see HOBOlink_sensors.py). None uses the current plan
+    - resampler: IntervalResampler or None, carries partial 15 minute bins between batches (see resample_stream).
+      Its state is saved with the batch
+
+    The sinks stage their appends in a journal that is committed once all of them have written the batch, so a run
+    that is killed never leaves the MasterTables, daily files, SHEF files and state file disagreeing. A batch left by
+    a killed run is finished before the next one (see HOBOlink_journal.py). Writes that can't be journaled (the Parquet
+    archive) are run after the commit.
+
+    Returns:
+    - int, number of rows handed to the sinks
+    """
+    # Finish the last batch if the run writing it was killed
+    if recover(base_path, site_name):
+        print(f'Recovered the last batch for {site_name} from its journal.')
+
+    # Decode the observations into one row per timestamp and one column per sensor/unit
+    plan = plan if plan is not None else HOBOlink_sensors.stream_plan
+    with metrics.stage('decode', rows=len(hobolink_data["data"])):
+        df = decode_observations(hobolink_data["data"], plan.si_units, plan.us_units)
+
+    # If there's no values, or there were only Battery V measurements, return
+    if df.empty:
+        print('No new data found.')
+        return df.shape[0]
+
+    with metrics.stage('transform') as stage:
+        df = stream_frame(df, plan)
+        stage.rows = len(df)
+
+    # if base_path=None the rating curve csv file must be stored in the same directory as where the script is running
+    rating_curve_path = Path(base_path if base_path else './') / f'{site_name}/Rating_Curve/{site_name}.rating_curve_100_points.csv'
+
+    # check if there is a rating curve. If not, set discharge to -9999.99
+    with metrics.stage('discharge', rows=len(df)):
+        rating_curve = load_rating_curve(rating_curve_path, site_name)
+        if rating_curve is not None:
+            print('Rating curve found.')
+        else:
+            print('No rating curve. Setting all discharge to -9999.99')
+        df2 = processed_frame(df, rating_curve)
+
+    # the battery voltage is resampled with the other channels so it stays lined up with the rows, then kept aside
+    # for the SHEF output - it isn't a MasterTable column
+    with metrics.stage('transform') as stage:
+        df2['battery_V'] = df['battery_V'].to_numpy()
+        df2 = resample_stream(df2, resampler)
+        battery = df2.pop('battery_V')
+        stage.rows = len(df2)
+
+    # every row may still be in the partial bin carried to the next batch
+    journal = Journal(journal_path(base_path, site_name))
+    after_commit = []
+    if not df2.empty:
+        batch = StreamBatch(site_name, base_path, df2, battery, rating_curve is not None, journal, after_commit)
+        for sink in sinks:
+            sink.write(batch)
+    if resampler is not None:
+        resampler.commit(journal)
+
+    with metrics.stage('journal_commit') as stage:
+        stage.bytes = journal.commit()
+    for write in after_commit:
+        write()
     return df2.shape[0]
 
+def parse_stream(hobolink_data, site_name, cdec=None, base_path=None, shef_toggle=False, archive_toggle=False, carry_bins=False,
+                 logging_interval_minutes=None):
+    """
+    Parses new stream data returned by the API and appends it to the site's MasterTables and daily files.
+
+    Parameters:
+    - hobolink_data: data returned by the HOBOLink API call
+    - site_name: str, the name of the site, used in the directory structure and file naming. Typically a 3 character ID
+    - cdec: str or None, CDEC ID - SHEF output is only written when it is given
+    - base_path: str or None, the base path where files will be saved. If None, uses a default directory structure.
+    - shef_toggle: bool, write the SHEF output
+    - archive_toggle: bool, also write the Raw and Processed data to the Parquet archive (requires pyarrow)
+    - carry_bins: bool, carry the partial 15 minute bin at the end of the batch over to the next pull in the site's
+      state file (see stream_resampler). Only for live pulls that move forward in time - historical pulls
+      (quick-pull, replay) resample each batch on its own
+    - logging_interval_minutes: int or None, logging interval of the site - a carried bin is written once the data
+      reaches its end. None waits for a row at or after the end of the bin
+    """
+    sinks = [AppendSink()]
+    if archive_toggle:
+        sinks.append(ArchiveSink())
+    sinks.append(DailySink())
+    if shef_toggle == True and cdec != None:
+        # SHEF hourly files, plus all new data appended to one file
+        sinks.append(ShefSink(cdec, f"{cdec}_Streamflow_SHEF_latest.txt"))
+    resampler = stream_resampler(base_path, site_name, logging_interval_minutes) if carry_bins else None
+    return process_stream(hobolink_data, site_name, base_path, sinks, resampler=resampler)
+
+def backfill_stream(hobolink_data, site_name, cdec=None, base_path=None, shef_toggle=False, archive_toggle=False):
+    """
+    Merges stream data pulled for gaps in the MasterTables (see find_gaps) into the site's MasterTables and daily files.
+    Rows are upserted by timestamp, so placeholder rows for the missing timestamps are replaced and the files stay in
+    time order.
+
+    Parameters:
+    - hobolink_data: data returned by the HOBOLink API call
+    - site_name: str, the name of the site
+    - cdec: str or None, CDEC ID - SHEF output is only written when it is given
+    - base_path: str or None, the base path where files are saved
+    - shef_toggle: bool, write the SHEF hourly files for the backfilled rows
+    - archive_toggle: bool, also write the rows to the Parquet archive - they replace archived rows with the same
+      timestamp when the archive is read (see HOBOlink_archive.py)
+    """
+    sinks = [UpsertSink(), DailySink(upsert=True)]
+    if archive_toggle:
+        sinks.append(ArchiveSink())
+    if shef_toggle and cdec is not None:
+        sinks.append(ShefSink(cdec, f"{cdec}_Streamflow_SHEF_backfill_{datetime.now().strftime('%Y%m%d')}.txt"))
+    return process_stream(hobolink_data, site_name, base_path, sinks)
+
 
 # Function to parse the data from the HOBOlink API
-def parse_precip(hobolink_data, site_name, base_path=None, append_to_single_file=False):
-    # Parse data for PrecipMet Tipping Bucket
-    df = pd.DataFrame.from_dict(hobolink_data["data"])
+def water_year(timestamps):
+    """
+    Returns the water year of each timestamp. A water year starts on October 1st 00:00:00Z, e.g. 2024-10-01 -> 2025
+    """
+    return timestamps.dt.year + (timestamps.dt.month >= 10).astype(int)
 
-    # Filter for precipitation data
-    precipitation_pulses = df.loc[df['sensor_measurement_type'] == 'Precipitation']
-    if precipitation_pulses.empty:
-        precipitation_mm = np.nan
-        timestamp = np.nan
-    else:
-        precipitation_mm = precipitation_pulses['scaled_value'].round(2).reset_index(drop=True)
-        timestamp = precipitation_pulses['timestamp'].iloc[:].reset_index(drop=True)
+def accumulate_precip(timestamps, precipitation_mm, total=0.0, current_water_year=None):
+    """
+    Accumulates precipitation since the start of each water year with one group-wise cumsum, so a batch can cross
+    any number of October 1st resets.
 
-    # Create a new dataframe with the parsed data
-    df2 = pd.DataFrame({'timestamp_UTC': timestamp, 'precipitation_mm': precipitation_mm})
+    Parameters:
+    - timestamps: Series of datetimes in time order
+    - precipitation_mm: Series of precipitation per record
+    - total: float, accumulated precipitation carried over from the previous batch
+    - current_water_year: int or None, water year of the carried total. The total is only added to rows in that water year
 
-    df2['timestamp_UTC'] = pd.to_datetime(df2['timestamp_UTC'], format='%Y-%m-%d %H:%M:%S%z')
+    Returns:
+    - Series with the accumulated precipitation in mm
+    """
+    years = water_year(timestamps)
+    accumulated = precipitation_mm.groupby(years.to_numpy()).cumsum()
+    if current_water_year is not None and total:
+        accumulated = accumulated + np.where(years == int(current_water_year), float(total), 0.0)
+    return accumulated
 
-    # Calculate accumulated precipitation
-    df2['accumulated_precipitation_mm'] = df2['precipitation_mm'].cumsum()
+def load_precip_accumulator(state_path, *csv_files):
+    """
+    Returns the precipitation accumulator of a site: {'last_timestamp', 'total', 'water_year'}.
+    The accumulator is read from the site's state file. Sites that don't have one yet are seeded from the last row of
+    the first csv file that exists, and an empty accumulator is returned for new sites.
+    """
+    accumulator = load_state(state_path).get('precip_accumulator') if state_path else None
+    if accumulator:
+        return accumulator
+
+    for csv_file in csv_files:
+        if not Path(csv_file).exists():
+            continue
+        header = pd.read_csv(csv_file, nrows=0).columns
+        last_row = read_last_row(csv_file)
+        if not last_row or 'accumulated_precipitation_mm' not in header:
+            continue
+        row = dict(zip(header, last_row))
+        try:
+            last_timestamp = pd.Timestamp(row['timestamp_UTC'])
+            total = float(row['accumulated_precipitation_mm'])
+        except (KeyError, ValueError):
+            continue
+        return {'last_timestamp': last_timestamp.strftime('%Y-%m-%d %H:%M:%S') + 'Z',
+                'total': 0.0 if np.isnan(total) else total,
+                'water_year': int(last_timestamp.year + (last_timestamp.month >= 10))}
+    return {}
+
+def write_precip_intervals(df2, raw_path, site_name, state_path, resample_freq, journal=None):
+    """
+    Appends the completed intervals of a batch of pulses to {site}_Precip_{resample_freq}.csv - the precipitation summed
+    and the accumulated precipitation at the end of each interval. The interval still being filled is carried over to
+    the next batch in the state file (see HOBOlink_resample.py) - pulses are events, not samples at the logging
+    interval, so an interval is only complete once a later pulse has arrived. The append and the carried interval are staged in
+    journal, or in a journal of their own that is committed here when none is given.
+    """
+    own_journal = journal is None
+    if own_journal:
+        journal = Journal(journal_path(raw_path.parent.parent, site_name))
+    resampler = IntervalResampler(resample_freq, {'precipitation_mm': 'sum', 'accumulated_precipitation_mm': 'last'},
+                                  state_path=state_path, key='precip_resample')
+    intervals = resampler.resample(df2[['timestamp_UTC', 'precipitation_mm', 'accumulated_precipitation_mm']])
+    if not intervals.empty:
+        interval_csv = raw_path / f"{site_name}_Precip_{resample_freq}.csv"
+        with metrics.stage('csv_write', rows=len(intervals)) as stage:
+            text = intervals.to_csv(None, index=False, header=journal.is_new(interval_csv),
+                                    escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+            journal.append(interval_csv, text, 0o644)
+            stage.bytes = len(text)
+    resampler.commit(journal)
+    if own_journal:
+        journal.commit()
+    return intervals
+
+def precipitation_frame(hobolink_data):
+    """
+    Returns the tipping bucket records of an API response as a DataFrame with 'timestamp_UTC' (UTC datetimes) and
+    'precipitation_mm' columns, sorted by time. The value is read from 'value' (v1 API), or from 'scaled_value' or
+    'si_value' in older responses that don't have it.
+    """
+    df = pd.DataFrame.from_dict(hobolink_data["data"])
+    if df.empty or 'sensor_measurement_type' not in df.columns:
+        return pd.DataFrame({'timestamp_UTC': pd.Series(dtype='datetime64[ns, UTC]'), 'precipitation_mm': pd.Series(dtype=float)})
+
+    precipitation_pulses = df.loc[df['sensor_measurement_type'] == 'Precipitation']
+    value_column = next(col for col in ('value', 'scaled_value', 'si_value') if col in df.columns)
+    df2 = pd.DataFrame({
+        'timestamp_UTC': pd.to_datetime(precipitation_pulses['timestamp'], format='%Y-%m-%d %H:%M:%S%z', utc=True),
+        'precipitation_mm': pd.to_numeric(precipitation_pulses[value_column], errors='coerce').round(2)})
+    return df2.sort_values('timestamp_UTC', kind='mergesort').reset_index(drop=True)
+
+def parse_precip(hobolink_data, site_name, base_path=None, append_to_single_file=False, archive_toggle=False, resample_freq=None):
+    # Parse data for PrecipMet Tipping Bucket - one row per pulse, sorted by time
+    # resample_freq (e.g. '15min') also appends the completed intervals to {site}_Precip_{resample_freq}.csv
+    # The appends and the accumulator in the state file are written through the site's journal (see HOBOlink_journal.py)
+    if recover(base_path, site_name):
+        print(f'Recovered the last batch for {site_name} from its journal.')
+    if archive_toggle:
+        from HOBOlink_archive import require_pyarrow
+        require_pyarrow()
+
+    with metrics.stage('decode', rows=len(hobolink_data["data"])):
+        df2 = precipitation_frame(hobolink_data)
+    transform = metrics.stage('transform')
 
     # Set up base master path
     master_path = Path(base_path if base_path else './') / site_name
@@ -733,159 +751,290 @@ def parse_precip(hobolink_data, site_name, base_path=None, append_to_single_file
     # Master table raw file path
     master_table_raw = raw_path / f"{site_name}_MasterTable_Raw.csv"
 
-    # Read the site.csv file to get the last recorded accumulated value
-    site_csv_path = raw_path / f"{site_name}.csv"
-    if site_csv_path.exists():
-        with open(site_csv_path, 'r') as file:
-            reader = csv.DictReader(file)
-            last_record = None
-            for row in reader:
-                last_record = row
-            if last_record is not None:
-                last_accumulated_precip = float(last_record['accumulated_precipitation_mm'])
-                df2['accumulated_precipitation_mm'] += last_accumulated_precip
-
-    # Identify the index where Timestamp reaches October 1st, 00:00:00 (New Water Year)
-    october_indices = df2[df2['timestamp_UTC'].dt.month == 10].index
-    if not october_indices.empty:
-        october_index = october_indices[0]
-    else:
-        october_index = None
-
-    if october_index is not None:
-        df2['Water_Year'] = (df2['timestamp_UTC'].dt.year + (df2['timestamp_UTC'].dt.month >= 10)).astype(str)
-        df2.loc[october_index:, 'accumulated_precipitation_mm'] -= df2.loc[october_index, 'accumulated_precipitation_mm']
-        precip_at_reset = df2.loc[october_index, 'precipitation_mm']
-        df2.loc[october_index, 'accumulated_precipitation_mm'] = 0
+    # Running total carried over from the last batch - kept in the site's state file so the csv is never read
+    state_path = site_state_path(base_path, site_name)
+    accumulator = load_precip_accumulator(state_path, master_table_raw, raw_path / f"{site_name}.csv")
 
-        # Add precipitation recorded at the reset moment to the new water year's accumulated total
-        if precip_at_reset > 0:
-            df2.loc[october_index + 1, 'accumulated_precipitation_mm'] += precip_at_reset
+    # Drop rows that an earlier batch already accumulated (overlapping pulls)
+    if accumulator.get('last_timestamp'):
+        df2 = df2[df2['timestamp_UTC'] > pd.Timestamp(accumulator['last_timestamp'])].reset_index(drop=True)
+    if df2.empty:
+        transform.stop()
+        return 0
 
+    # Accumulated precipitation resets at the start of every water year (October 1st 00:00:00Z)
+    df2['accumulated_precipitation_mm'] = accumulate_precip(df2['timestamp_UTC'], df2['precipitation_mm'],
+                                                            accumulator.get('total', 0.0), accumulator.get('water_year'))
     df2['accumulated_precipitation_mm'] = df2['accumulated_precipitation_mm'].round(2)
+    transform.stop(rows=len(df2))
+
+    # Append to Master Table Raw - file permissions (User: RW, Group: R, Others: R) = `0o644`
+    journal = Journal(journal_path(base_path, site_name))
+    csv_write = metrics.stage('csv_write', rows=len(df2))
+    text = df2.to_csv(None, index=False, header=journal.is_new(master_table_raw),
+                      escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+    journal.append(master_table_raw, text, 0o644)
+    csv_write.stop(nbytes=len(text))
+    archive_rows = df2.copy() if archive_toggle else None
+
+    # Record the last timestamp and running total so the next run can resume without reading the MasterTable
+    last_timestamp = df2['timestamp_UTC'].iloc[-1]
+    last_water_year = int(last_timestamp.year + (last_timestamp.month >= 10))
+    last_total = df2.loc[water_year(df2['timestamp_UTC']) == last_water_year, 'accumulated_precipitation_mm'].dropna()
+    if not last_total.empty:
+        total = float(last_total.iloc[-1])
+    else:
+        total = accumulator.get('total', 0.0) if accumulator.get('water_year') == last_water_year else 0.0
+    journal.update_state(state_path, precip_accumulator={
+        'last_timestamp': last_timestamp.strftime('%Y-%m-%d %H:%M:%S') + 'Z',
+        'total': total,
+        'water_year': last_water_year})
+    journal.commit_timestamp(state_path, last_timestamp.strftime('%Y-%m-%d %H:%M:%S') + 'Z')
 
-    # Group data by date
-    grouped = df2.groupby([
-        df2['timestamp_UTC'].dt.year, 
-        df2['timestamp_UTC'].dt.month.apply(lambda x: f'{x:02d}'), 
-        df2['timestamp_UTC'].dt.day.apply(lambda x: f'{x:02d}')
-    ])
-
-    # Append to Master Table Raw
-    df2.drop(columns=['Water_Year'], inplace=True, errors='ignore')
-    df2.to_csv(master_table_raw, mode='a' if master_table_raw.exists() else 'w', 
-            index=False, header=not master_table_raw.exists(), 
-            escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-
-    # Set file permissions for Master Table Raw (User: RW, Group: R, Others: R) = `0o644`
-    os.chmod(master_table_raw, 0o644)
+    if resample_freq:
+        write_precip_intervals(df2, raw_path, site_name, state_path, resample_freq, journal=journal)
 
     if append_to_single_file:
         # Define the path for the long-running file
         site_csv_path = raw_path / f"{site_name}.csv"
         df2['timestamp_UTC'] = df2['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%S') + 'Z'
-        mode = 'a' if site_csv_path.exists() else 'w'
-        header = not site_csv_path.exists()
-        
-        # Append data to the single file
-        df2.to_csv(site_csv_path, mode=mode, index=False, header=header, escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
 
-        # Set the file permissions to `0o644`
-        os.chmod(site_csv_path, 0o644)
+        # Append data to the single file - file permissions `0o644`
+        with metrics.stage('csv_write', rows=len(df2)) as stage:
+            text = df2.to_csv(None, index=False, header=journal.is_new(site_csv_path), escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+            journal.append(site_csv_path, text, 0o644)
+            stage.bytes = len(text)
 
     else:
-        for (year, month, day), group in grouped:
-            # **Raw Daily Directory**
-            raw_daily_path = raw_path / "Raw_Daily" / str(year) / str(month)
-            raw_daily_path.mkdir(parents=True, exist_ok=True)
-
-            # **Raw Daily File**
-            raw_daily_file = raw_daily_path / f"{site_name}_{year}-{month}-{day}.csv"
-
-            # Format timestamp for storage
-            group['timestamp_UTC'] = group['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%S') + 'Z'
-            mode_daily = 'a' if raw_daily_file.exists() else 'w'
-            header_daily = not raw_daily_file.exists()
+        # Raw Daily - one write per daily file
+        df2['timestamp_UTC'] = df2['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%S') + 'Z'
+        with metrics.stage('daily_write', rows=len(df2)):
+            daily_writer.write(df2, raw_path / "Raw_Daily", site_name, 0o644, file_format="{site}_{year}-{month}-{day}.csv",
+                               journal=journal)
 
-            # Write to Raw Daily File
-            group.drop(columns=['Water_Year'], inplace=True, errors='ignore')
-            group.to_csv(raw_daily_file, mode=mode_daily, index=False, header=header_daily,
-                        escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+    with metrics.stage('journal_commit') as stage:
+        stage.bytes = journal.commit()
 
-            # Set file permissions for Raw Daily (User: RW, Group: R, Others: R) = `0o644`
-            os.chmod(raw_daily_file, 0o644)
+    # Write the same rows to the columnar archive - it can't be journaled, so only once the csv files are committed
+    if archive_toggle:
+        from HOBOlink_archive import write_archive
+        write_archive(archive_rows, base_path, site_name, 'Raw')
 
     # Return only the number of records processed
     return df2.shape[0]
 
+# Met channels reported by PrecipMet stations (RX3000) - converted with the same kind of sensor registry as the streams
+# (see HOBOlink_sensors.py). Channels reported in the US unit are converted to the SI unit of the Met table.
+MET_REGISTRY = {
+    'sensors': {
+        'Temperature': {'si': '°C', 'us': '°F', 'factor': '5/9', 'offset': 32},
+        'Dew Point': {'si': '°C', 'us': '°F', 'factor': '5/9', 'offset': 32},
+        'Wind Speed': {'si': 'm/s', 'us': 'mph', 'factor': 0.44704},
+        'Gust Speed': {'si': 'm/s', 'us': 'mph', 'factor': 0.44704},
+        'Barometric Pressure': {'si': 'mbar', 'us': 'inHg', 'factor': 33.8639},
+    },
+}
+met_plan = HOBOlink_sensors.compile_registry(MET_REGISTRY)
+
+# Decoded column names -> Met table column names
+MET_COLUMN_NAMES = {'timestamp': 'timestamp_UTC',
+                    'Temperature si': 'air_temperature_C',
+                    'RH': 'relative_humidity_pct',
+                    'Dew Point si': 'dew_point_C',
+                    'Wind Speed si': 'wind_speed_mps',
+                    'Gust Speed si': 'wind_gust_mps',
+                    'Wind Direction': 'wind_direction_deg',
+                    'Solar Radiation': 'solar_radiation_Wm2',
+                    'Barometric Pressure si': 'barometric_pressure_mbar',
+                    'Battery': 'battery_V'
+                    }
+
+# Columns of the Met table - every PrecipMet site gets the same columns, -9999.99 where a sensor isn't installed
+MET_COLUMNS = list(MET_COLUMN_NAMES.values())
+
+def met_frame(hobolink_data):
+    """
+    Pivots every met channel of an API response into one row per timestamp with the MET_COLUMNS, in one vectorized
+    pass (see decode_observations). Timestamps that only have a battery or precipitation value are dropped.
+
+    Returns:
+    - DataFrame with the MET_COLUMNS, 'timestamp_UTC' formatted as 'YYYY-MM-DD HH:MM:SSZ'. Empty if there were no met values.
+    """
+    df = decode_observations(hobolink_data["data"], met_plan.si_units, met_plan.us_units)
+    if df.empty:
+        return pd.DataFrame(columns=MET_COLUMNS)
+    df = met_plan.apply(df).rename(columns=MET_COLUMN_NAMES).reindex(columns=MET_COLUMNS)
+
+    channels = [col for col in MET_COLUMNS if col not in ('timestamp_UTC', 'battery_V')]
+    df = df[df[channels].notna().any(axis=1)]
+    df[MET_COLUMNS[1:]] = df[MET_COLUMNS[1:]].round(2).fillna(-9999.99)
+    df['timestamp_UTC'] = pd.to_datetime(df['timestamp_UTC'], format='%Y-%m-%d %H:%M:%S%z', utc=True).dt.strftime('%Y-%m-%d %H:%M:%SZ')
+    return df.sort_values('timestamp_UTC', kind='mergesort').reset_index(drop=True)
+
+def parse_met(hobolink_data, site_name, base_path=None, archive_toggle=False):
+    """
+    Appends the met channels of a PrecipMet response to {site}/Raw/{site}_MetTable_Raw.csv and its Met_Daily files.
+    Rows at or before the last timestamp already written (kept in the site's state file) are skipped. The appends and
+    the timestamp are written through the site's journal (see HOBOlink_journal.py).
+
+    Parameters:
+    - hobolink_data: data returned by the HOBOLink API call
+    - site_name: str, the name of the site
+    - base_path: str or None, the base path where files are saved
+    - archive_toggle: bool, also write the rows to the Parquet archive (requires pyarrow)
+
+    Returns:
+    - int, number of rows written
+    """
+    if recover(base_path, site_name):
+        print(f'Recovered the last batch for {site_name} from its journal.')
+    if archive_toggle:
+        from HOBOlink_archive import require_pyarrow
+        require_pyarrow()
+
+    with metrics.stage('decode', rows=len(hobolink_data["data"])):
+        df = met_frame(hobolink_data)
+
+    state_path = site_state_path(base_path, site_name)
+    last_timestamp = load_state(state_path).get('met_last_timestamp')
+    if last_timestamp:
+        df = df[df['timestamp_UTC'] > last_timestamp].reset_index(drop=True)
+    if df.empty:
+        return 0
+
+    raw_path = Path(base_path if base_path else './') / site_name / "Raw"
+    raw_path.mkdir(parents=True, exist_ok=True)
+    met_table = raw_path / f"{site_name}_MetTable_Raw.csv"
+
+    journal = Journal(journal_path(base_path, site_name))
+    with metrics.stage('csv_write', rows=len(df)) as stage:
+        text = df.to_csv(None, index=False, header=journal.is_new(met_table), escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+        journal.append(met_table, text, 0o644)
+        stage.bytes = len(text)
+
+    journal.commit_timestamp(state_path, df['timestamp_UTC'].iloc[-1], key='met_last_timestamp')
+
+    with metrics.stage('daily_write', rows=len(df)):
+        daily_writer.write(df, raw_path / "Met_Daily", site_name, 0o644, file_format="{site}_Met_{year}-{month}-{day}.csv",
+                           journal=journal)
+
+    with metrics.stage('journal_commit') as stage:
+        stage.bytes = journal.commit()
+
+    # the archive can't be journaled - written once the csv files are committed
+    if archive_toggle:
+        from HOBOlink_archive import write_archive
+        write_archive(df, base_path, site_name, 'Met')
+    return df.shape[0]
+
 def backfill_precip(hobolink_data,filename):
-    # Parse data for PrecipMet Tipping Bucket
-    df = pd.DataFrame.from_dict(hobolink_data["data"])
-    # Parse data for PrecipMet Tipping Bucket
-    precipitation_pulses = df.loc[df['sensor_measurement_type'] == 'Precipitation']
-    if precipitation_pulses.empty:
-        # If no water pressure data is found, set default values
-        precipitation_mm = np.nan
-        timestamp = np.nan
+    # Parse data for PrecipMet Tipping Bucket - precipitation_frame reads the value field of any API version
+    df2 = precipitation_frame(hobolink_data)
+    df2 = df2.drop_duplicates('timestamp_UTC', keep='last')
+    if df2.empty:
+        return 0
+
+    # Merge the backfilled rows into the csv - pulled rows replace rows with the same timestamp
+    columns = ['timestamp_UTC', 'precipitation_mm', 'accumulated_precipitation_mm']
+    filename = Path(filename)
+    if filename.exists():
+        permissions = os.stat(filename).st_mode & 0o777
+        existing = pd.read_csv(filename)
+        columns = list(existing.columns)
+        existing['timestamp_UTC'] = pd.to_datetime(existing['timestamp_UTC'], utc=True, format='mixed')
     else:
-        precipitation_mm = precipitation_pulses['si_value'].round(2).reset_index(drop=True)
-        # Date timestamps for data - each 'sensor_measurement_type' provides a 'timestamp' but only uses one value per timestamp so we drop duplicates   
-        timestamp = precipitation_pulses['timestamp'].iloc[:].reset_index(drop=True)
-
-    # Create a new dataframe with the parsed data
-    df2 = pd.DataFrame({'timestamp_UTC': timestamp,
-                        'precipitation_mm': precipitation_mm
-                        })
-
-    # Calculate accumulated total
-    df2['accumulated_precipitation_mm'] = df2['precipitation_mm'].cumsum()
-
-    # Read the site.csv file to get the last recorded accumulated value
-    site_csv_path = Path(filename)
-    if site_csv_path.exists():
-        with open(site_csv_path, 'r') as file:
-            reader = csv.DictReader(file)
-            last_record = None
-            for row in reader:
-                last_record = row
-            if last_record is not None:
-                last_accumulated_precip = float(last_record['accumulated_precipitation_mm'])
-                df2['accumulated_precipitation_mm'] += last_accumulated_precip
-    
-    # Identify the index where Timestamp reaches October 1st, 00:00:00
-    october_indices = df2[df2['timestamp_UTC'].dt.month == 10].index
-    if not october_indices.empty:
-        october_index = october_indices[0]
-    else:
-        # Handle the case where there are no timestamps for October
-        # For example, set october_index to None or handle the situation in an appropriate way
-        october_index = None
-
-    if october_index is not None:
-        # Reset accumulated precipitation to 0 for each water year
-        df2['Water_Year'] = (df2['timestamp_UTC'].dt.year + (df2['timestamp_UTC'].dt.month >= 10)).astype(str)
-        df2.loc[october_index:, 'accumulated_precipitation_mm'] -= df2.loc[october_index, 'accumulated_precipitation_mm']
-        precip_at_reset = df2.loc[october_index, 'precipitation_mm']
-        df2.loc[october_index, 'accumulated_precipitation_mm'] = 0
-
-        # Add precipitation recorded at the reset moment to the new water year's accumulated total
-        if precip_at_reset > 0:
-            df2.loc[october_index + 1, 'accumulated_precipitation_mm'] += precip_at_reset
-
-    csv_df = pd.read_csv(filename)
-
-    # Iterate over the rows in the CSV DataFrame
-    for index, csv_row in csv_df.iterrows():
-        # Find the index of the row in the original DataFrame with the same timestamp
-        idx = df2[df2['timestamp_UTC'] == csv_row.iloc[0]].index
-        if not idx.empty:
-           # Replace the row in the CSV DataFrame with the row from the original DataFrame
-            csv_df.loc[index] = df2.loc[idx].iloc[0]  # Update the row in the CSV DataFrame with the corresponding row from df2
-            # Write back the DataFrame to the CSV file, specifying header=True to keep the header
-            csv_df.to_csv(filename, index=False, header=True, escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-            #os.chmod(filepath, 0o775)
+        permissions = 0o664
+        existing = pd.DataFrame(columns=columns)
+    merged = pd.concat([existing[~existing['timestamp_UTC'].isin(df2['timestamp_UTC'])], df2.reindex(columns=columns)],
+                       ignore_index=True) if not existing.empty else df2.reindex(columns=columns)
+    merged = merged.sort_values('timestamp_UTC', kind='mergesort').reset_index(drop=True)
+
+    # The running total is taken from the row before the first backfilled row, and every row from there on is
+    # accumulated again (resetting at October 1st) - the backfilled precipitation is added to all later totals
+    affected = (merged['timestamp_UTC'] >= df2['timestamp_UTC'].iloc[0]).to_numpy()
+    first = int(np.argmax(affected))
+    total, current_water_year = 0.0, None
+    if first > 0:
+        previous = merged.iloc[first - 1]
+        total = 0.0 if pd.isna(previous['accumulated_precipitation_mm']) else float(previous['accumulated_precipitation_mm'])
+        current_water_year = int(water_year(pd.Series([previous['timestamp_UTC']])).iloc[0])
+    merged.loc[affected, 'accumulated_precipitation_mm'] = accumulate_precip(
+        merged.loc[affected, 'timestamp_UTC'], merged.loc[affected, 'precipitation_mm'].astype(float),
+        total, current_water_year).round(2).to_numpy()
+
+    # Write the csv back once
+    merged['timestamp_UTC'] = merged['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%S') + 'Z'
+    atomic_write_csv(merged, filename, permissions)
     return df2.shape[0]
 
+def atomic_write_csv(df, path, permissions=0o664):
+    """
+    Writes a DataFrame to a CSV file in the MasterTable format. The data is written to a temporary file in the same
+    directory, flushed to disk and then renamed over the target, so readers never see a partially written file.
+
+    Parameters:
+    - df: DataFrame to write
+    - path: str or Path, destination file
+    - permissions: int, file permissions applied to the new file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='') as file:
+            df.to_csv(file, index=False, header=True, escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, permissions)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def upsert_csv(filename, df_new, key='timestamp_UTC', permissions=0o664, journal=None):
+    """
+    Merges rows into a CSV file keyed on a timestamp column. Rows whose timestamp is already in the file replace the
+    existing row, new timestamps are inserted in time order. The file is read once, merged with an index lookup and
+    written once with atomic_write_csv, or staged in a journal that replaces the file when it is committed.
+
+    Parameters:
+    - filename: str or Path, the CSV file to update. Created if it does not exist.
+    - df_new: DataFrame with the rows to merge. Columns that are not in the file are ignored.
+    - key: str, name of the timestamp column (timestamps must be formatted as 'YYYY-MM-DD HH:MM:SSZ')
+    - permissions: int, file permissions of a new file. An existing file keeps its permissions.
+    - journal: Journal or None, stage the merged file in the journal instead of writing it (see HOBOlink_journal.py)
+
+    Returns:
+    - The number of rows in the file after the merge, or None if there were no rows to merge.
+    """
+    filename = Path(filename)
+    if df_new.empty:
+        return None
+
+    if filename.exists():
+        permissions = os.stat(filename).st_mode & 0o777  # keep the permissions of the existing file
+        existing = pd.read_csv(filename)
+        columns = list(existing.columns)
+    else:
+        existing = pd.DataFrame(columns=df_new.columns)
+        columns = list(df_new.columns)
+
+    # If the same timestamp appears more than once in the new rows, the last one wins
+    new_rows = df_new.reindex(columns=columns).drop_duplicates(subset=[key], keep='last')
+    kept_rows = existing[~existing[key].isin(new_rows[key])]
+
+    merged = pd.concat([kept_rows, new_rows], ignore_index=True) if not kept_rows.empty else new_rows
+    # Timestamps share one fixed-width format, so sorting the strings sorts them in time
+    merged = merged.sort_values(key, kind='mergesort').reset_index(drop=True)
+
+    if journal is not None:
+        journal.append(filename, merged.to_csv(None, index=False, header=True, escapechar='\\', quoting=csv.QUOTE_NONNUMERIC),
+                       permissions, replace=True)
+    else:
+        atomic_write_csv(merged, filename, permissions)
+    return merged.shape[0]
+
 # split datetime into intervals to pull smaller data chunks for larger pulls of data
 # work around to not run into the data limit issues with the HOBOlink_API
 # currently doing 
@@ -901,6 +1050,35 @@ def timestamp_chunks(start_date, end_date, overlap_delta):
         intervals[-1] = (intervals[-1][0], end_date)
     return intervals
 
+def plan_chunks(start_date, end_date, logging_interval_minutes, n_channels, max_points=MAX_POINTS, fill=0.9):
+    """
+    Splits a time range into request windows sized so each request returns just under the API's data point limit.
+    The number of points in a window is (number of logging intervals) x (number of sensor channels), so 2-minute
+    sites get short windows and 15-minute sites get long ones.
+
+    Parameters:
+    - start_date: datetime, first timestamp to pull
+    - end_date: datetime, last timestamp to pull
+    - logging_interval_minutes: int, logging interval of the site
+    - n_channels: int, number of values the logger reports per timestamp (sensors and battery)
+    - max_points: int, data point limit of the API
+    - fill: float, fraction of the limit to aim for - leaves room for extra statistics or battery values
+
+    Returns:
+    - A list of (start, end) datetime tuples. Both ends are inclusive and consecutive windows don't overlap.
+    """
+    step = timedelta(minutes=int(logging_interval_minutes))
+    steps_per_window = max(1, int(max_points * fill) // max(1, int(n_channels)))
+    window = step * steps_per_window
+
+    intervals = []
+    current_date = start_date
+    while current_date <= end_date:
+        interval_end = min(current_date + window - step, end_date)
+        intervals.append((current_date, interval_end))
+        current_date = interval_end + step
+    return intervals
+
 def find_nan(csv_file):
     # Read the CSV file
     df = pd.read_csv(csv_file)
@@ -965,6 +1143,89 @@ def find_nan_optimized(csv_file):
     
     return nan_ranges if nan_ranges else "no"
 
+def utc_seconds(timestamps, utc_format='%Y-%m-%d %H:%M:%S%z'):
+    """
+    Parses MasterTable timestamps ('YYYY-MM-DD HH:MM:SSZ') to a numpy datetime64[s] array in UTC, with NaT for values
+    that can't be parsed. When every value has the fixed format it is parsed by numpy as bytes, which is about ten
+    times faster than pandas with a %z format; anything else falls back to pandas.
+    """
+    try:
+        text = timestamps.to_numpy().astype('S21')
+        chars = text.view('S1').reshape(-1, 21)
+        if (chars[:, 19] == b'Z').all() and (chars[:, 20] == b'').all():
+            return text.astype('S19').astype('datetime64[s]')
+    except (UnicodeError, ValueError):
+        pass
+    parsed = pd.to_datetime(timestamps, format=utc_format, errors='coerce', utc=True)
+    return parsed.dt.tz_localize(None).to_numpy(dtype='datetime64[s]')
+
+def find_gaps(csv_file, logging_interval_minutes, columns=None, sentinel=-9999.99, sentinel_how='all', chunksize=50000):
+    """
+    Streams a MasterTable in chunks and finds the time ranges that need to be backfilled. Two kinds of gaps are found:
+    - missing rows: expected timestamps (one every logging interval) that are not in the file
+    - bad rows: rows with NaN or blank values, or rows holding the -9999.99 sentinel
+    Memory use is bounded by the chunk size no matter how large the file is.
+
+    Parameters:
+    - csv_file: str or Path, MasterTable csv file with a 'timestamp_UTC' column
+    - logging_interval_minutes: int, logging interval of the site (15 for streams, 2 for precip)
+    - columns: list or None, value columns to check. Defaults to every column except 'timestamp_UTC' and 'qc_status'
+    - sentinel: float, value used for missing data
+    - sentinel_how: str, 'all' flags a row only when every checked column holds the sentinel (e.g. an empty resampled
+      bin), 'any' flags a row when any checked column holds it
+    - chunksize: int, number of rows read at a time
+
+    Returns:
+    - A list of (start, end) datetime tuples in time order. Each range covers the missing or bad timestamps, ranges that
+      touch are merged, and both ends are inclusive so they can be passed straight to plan_chunks.
+    """
+    interval = timedelta(minutes=logging_interval_minutes)
+    utc_format = '%Y-%m-%d %H:%M:%S%z'
+
+    header = pd.read_csv(csv_file, nrows=0).columns
+    if 'timestamp_UTC' not in header:
+        raise ValueError(f"'timestamp_UTC' column not found in {csv_file}.")
+    if columns is None:
+        columns = [col for col in header if col not in ('timestamp_UTC', 'qc_status')]
+
+    ranges = []
+    def add_range(start, end):
+        # merge with the previous range when the two touch
+        if ranges and start <= ranges[-1][1] + interval:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+
+    previous = None  # last timestamp of the previous chunk
+    for chunk in pd.read_csv(csv_file, usecols=['timestamp_UTC'] + list(columns), chunksize=chunksize):
+        times = utc_seconds(chunk['timestamp_UTC'], utc_format)
+        valid_time = ~np.isnat(times)
+        times = times[valid_time]
+        values = chunk[list(columns)].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)[valid_time]
+
+        # Rows with NaN/blank values or sentinel values
+        is_sentinel = np.isclose(values, sentinel)
+        bad = np.isnan(values).any(axis=1)
+        bad |= is_sentinel.all(axis=1) if sentinel_how == 'all' else is_sentinel.any(axis=1)
+
+        # Missing timestamps - compare each timestamp with the one before it, the end of the previous chunk is
+        # handled below
+        missing_after = np.flatnonzero(np.diff(times) > np.timedelta64(interval))
+
+        # Walk the flagged rows and the missing spans in time order - only those rows are converted to datetimes
+        stamp = lambda i: pd.Timestamp(times[i], tz=timezone.utc).to_pydatetime()
+        events = [(stamp(i), stamp(i)) for i in np.flatnonzero(bad)]
+        events += [(stamp(i) + interval, stamp(i + 1) - interval) for i in missing_after]
+        if previous is not None and len(times) and stamp(0) - previous > interval:
+            events.append((previous + interval, stamp(0) - interval))
+        for start, end in sorted(events):
+            add_range(start, end)
+
+        if len(times):
+            previous = stamp(len(times) - 1)
+
+    return ranges
+
 # Custom aggregation function that handles -9999 values correctly
 def custom_mean(series):
     filtered_series = series[series != -9999]  # Exclude -9999 values
@@ -973,6 +1234,147 @@ def custom_mean(series):
     else:
         return filtered_series.mean()
     
+class DailyFileWriter:
+    """
+    Writes rows to one CSV file per day, e.g. {directory}/YYYY/MM/{site}_YYYYMMDD.csv.
+    Rows are grouped by the file they belong to, so each daily file gets a single append per batch. The directories
+    created and the files known to exist are remembered for the rest of the run, so `mkdir` and `exists()` are only
+    called the first time a directory or file is seen.
+    """
+    def __init__(self):
+        self.created_dirs = set()
+        self.existing_files = set()
+        self.lock = threading.Lock()
+
+    def write(self, df, directory, site_name, permissions, file_format="{site}_{year}{month}{day}.csv", mode='a', journal=None):
+        """
+        Appends the rows of df to their daily files.
+
+        Parameters:
+        - df: DataFrame with a 'timestamp_UTC' column formatted as 'YYYY-MM-DD HH:MM:SSZ'
+        - directory: Path, directory holding the YYYY/MM daily folders (e.g. Raw/Raw_Daily)
+        - site_name: str, the name of the site used in the file names
+        - permissions: int, file permissions set on each file written
+        - file_format: str, file name with {site}, {year}, {month} and {day} fields
+        - mode: str, 'a' appends to the daily files, 'w' replaces them (used when rebuilding the outputs)
+        - journal: Journal or None, stage the writes in a journal instead of writing the files (see HOBOlink_journal.py)
+        """
+        if df.empty:
+            return
+        days = df['timestamp_UTC'].str[:10]
+        for day, group in df.groupby(days, sort=True):
+            year, month, day_of_month = day[:4], day[5:7], day[8:10]
+            daily_path = Path(directory) / year / month
+            daily_file = daily_path / file_format.format(site=site_name, year=year, month=month, day=day_of_month)
+
+            if journal is not None:
+                text = group.to_csv(None, index=False, header=mode == 'w' or journal.is_new(daily_file),
+                                    escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+                journal.append(daily_file, text, permissions, replace=mode == 'w')
+                continue
+
+            with self.lock:
+                if daily_path not in self.created_dirs:
+                    daily_path.mkdir(parents=True, exist_ok=True)
+                    self.created_dirs.add(daily_path)
+                # the header is only written when the file is new
+                header = mode == 'w' or (daily_file not in self.existing_files and not daily_file.exists())
+                self.existing_files.add(daily_file)
+
+            group.to_csv(daily_file, mode=mode, index=False, header=header,
+                         escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+            os.chmod(daily_file, permissions)
+
+# Shared by every parse call in the run
+daily_writer = DailyFileWriter()
+
+class RatingCurve:
+    """
+    Stage-discharge rating curve used to compute discharge for a whole column of water levels at once.
+
+    Parameters:
+    - levels: array-like, water levels in feet ("Level.ft"). Must be strictly increasing.
+    - discharges: array-like, discharge in cubic feet per second ("discharge.cfs") for each level. Must not decrease.
+    """
+    def __init__(self, levels, discharges):
+        self.levels = np.asarray(levels, dtype=float)
+        self.discharges = np.asarray(discharges, dtype=float)
+
+        if self.levels.shape != self.discharges.shape:
+            raise ValueError("Rating curve levels and discharges must be the same length.")
+        if np.isnan(self.levels).any() or np.isnan(self.discharges).any():
+            raise ValueError("Rating curve contains missing values.")
+        if np.any(np.diff(self.levels) <= 0):
+            raise ValueError("Rating curve levels must be strictly increasing.")
+        if np.any(np.diff(self.discharges) < 0):
+            raise ValueError("Rating curve discharge must increase with the water level.")
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Loads a rating curve from a {site}.rating_curve_100_points.csv file with "Level.ft" and "discharge.cfs" columns.
+        """
+        rating_curve = pd.read_csv(path)
+        return cls(rating_curve['Level.ft'], rating_curve['discharge.cfs'])
+
+    def discharge(self, stage):
+        """
+        Calculates discharge in cfs for an array of water levels in feet using linear interpolation (one np.interp call).
+        Levels outside the range of the rating curve, and results that are infinite, are set to -9999.99.
+        """
+        stage = np.asarray(stage, dtype=float)
+        # Set discharge to -9999.99 if the rating curve is empty
+        if self.levels.size == 0:
+            return np.full(stage.shape, -9999.99)
+
+        discharge = np.interp(stage, self.levels, self.discharges)
+        out_of_range = (stage < self.levels[0]) | (stage > self.levels[-1]) | np.isinf(discharge)
+        discharge[out_of_range] = -9999.99
+        return discharge
+
+# Rating curves that have already been parsed - {path: (modification time, RatingCurve)}
+_rating_curve_cache = {}
+_rating_curve_lock = threading.Lock()
+
+def load_rating_curve(path, site_name=None, strict=False):
+    """
+    Returns the RatingCurve stored at path, or None if there is no rating curve file.
+    Parsed curves are cached and only read again when the file's modification time changes.
+
+    A rating curve file that can't be used (missing columns, missing values, levels or discharge that don't increase)
+    is reported as an error to the site's log ({site_name}_Logger, see HOBOlink.py) and treated as missing, so the
+    batch is still recorded with discharge set to -9999.99. With strict=True the error is raised instead.
+
+    Parameters:
+    - path: str or Path, the {site}.rating_curve_100_points.csv file
+    - site_name: str or None, site ID used to find the site's logger
+    - strict: bool, raise a ValueError for a rating curve file that can't be used
+    """
+    path = str(path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    with _rating_curve_lock:
+        cached = _rating_curve_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    try:
+        rating_curve = RatingCurve.from_csv(path)
+    except (ValueError, KeyError) as e:
+        message = f'Rating curve {path} could not be used - discharge is set to -9999.99: {e!r}'
+        if strict:
+            raise ValueError(message) from e
+        print(message)
+        logging.getLogger(f'{site_name}_Logger' if site_name else __name__).error(message)
+        return None
+
+    with _rating_curve_lock:
+        _rating_curve_cache[path] = (mtime, rating_curve)
+    return rating_curve
+
 # Function to calculate discharge using linear interpolation
 def calculate_discharge(stage, rating_curve):
     # Check if the rating curve DataFrame is empty
@@ -991,445 +1393,152 @@ def calculate_discharge(stage, rating_curve):
     else:
         return interpolated_value
 
-# Adjusted function to handle formatting and special case
-def format_shef_value(value):
-    # First, handle the special case of -9999.99
-    if value == -9999.99:
-        return "-9999"
-    # Then, format other values as floating-point numbers with appropriate precision
-    else:
-        return f"{value:.2f}"
-    
-# function to parse the data from the HOBOlink API
-def parse_stream_backfill(hobolink_data, site_name, cdec=None, base_path=None, shef_toggle=False):
-    
-    """
-    Parses JSON data that was pulled and found with the dictionary key "observation_list"
-    JSON data is passed into the DataFrame into daily CSV files within a specified or default directory structure.
-    
-    Parameters:
-    - hobolink_data: data returned by the HOBOLink API call
-    - site_name: str, the name of the site, used in the directory structure and file naming. Typically a 3 character ID
-    - base_path: str or None, the base path where files will be saved. If None, uses a default directory structure.
-    """   
-
-    observation_list = hobolink_data["data"]
-    
-    # Define units - will depend on what sensors are connected
-    si_units = {"kPa", "°C", "meters"}
-    us_units = {"psi", "°F", "feet"}
-
-    # Process observations into a list for DataFrame
-    rows = []
-    tracked_units = set()  # To track encountered units (excluding battery voltage)
-
-    for obs in observation_list:
-        unit = obs["unit"]
-        sensor_type = obs["sensor_measurement_type"]
-        
-        if sensor_type.lower() != "battery":  # Ignore battery voltage
-            tracked_units.add(unit)
-
-        if unit in si_units:
-            key = f"{sensor_type} si"
-        elif unit in us_units:
-            key = f"{sensor_type} us"
-        else:  # Battery voltage or other unknown units
-            key = sensor_type
-
-        rows.append({"timestamp": obs["timestamp"], key: obs["value"]})
-
-    # Create DataFrame
-    df = pd.DataFrame(rows)
-    
-    # If there's no values, or there were only Battery V measurements, return
-    if df.empty:
-        print('No new data found.')
-        return df.shape[0]
-    
-    df = df.groupby("timestamp", as_index=False).first()
-    df = df[~((df["Battery"].notna()) & (df.drop(columns=["timestamp", "Battery"]).isna().all(axis=1)))]
+# Columns of the stream MasterTables
+RAW_COLUMNS = ['timestamp_UTC', 'water_pressure_psi', 'barometric_pressure_psi', 'diff_pressure_psi', 'water_level_ft',
+               'water_temperature_F', 'water_pressure_kPa', 'barometric_pressure_kPa', 'diff_pressure_kPa',
+               'water_level_m', 'water_temperature_C']
+PROCESSED_COLUMNS = ['timestamp_UTC', 'water_pressure_psi', 'barometric_pressure_psi', 'diff_pressure_psi',
+                     'water_level_ft', 'level_corrected_ft', 'discharge_cfs', 'water_temperature_F',
+                     'water_pressure_kPa', 'barometric_pressure_kPa', 'diff_pressure_kPa', 'water_level_m',
+                     'level_corrected_m', 'discharge_cms', 'water_temperature_C', 'qc_status']
 
-    # Safely convert columns to numeric without triggering deprecation warnings
-    for col in df.columns:
-        try:
-            df[col] = pd.to_numeric(df[col])
-        except Exception:
-            pass
-
-    sensor_fields = {
-        'Diff Pressure': ('psi', 'kPa', 6.89476),
-        'Barometric Pressure': ('psi', 'kPa', 6.89476),
-        'Water Level': ('feet', 'meters', 0.3048),
-        'Water Temperature': ('F', 'C', None),
-    }
-
-    for sensor, (us_unit, si_unit, factor) in sensor_fields.items():
-        us_col = f"{sensor} us"
-        si_col = f"{sensor} si"
-
-        # Ensure numeric with NaNs where conversion fails
-        if us_col in df.columns:
-            df[us_col] = pd.to_numeric(df[us_col], errors='coerce')
-        if si_col in df.columns:
-            df[si_col] = pd.to_numeric(df[si_col], errors='coerce')
-
-        if sensor == "Water Temperature":
-            # Fill missing SI from US
-            if us_col in df.columns and si_col in df.columns:
-                df.loc[df[si_col].isna() & df[us_col].notna(), si_col] = (
-                    (df[us_col] - 32) * 5 / 9
-                )
-                df.loc[df[us_col].isna() & df[si_col].notna(), us_col] = (
-                    df[si_col] * 9 / 5 + 32
-                )
-            elif us_col in df.columns:
-                df[si_col] = (df[us_col] - 32) * 5 / 9
-            elif si_col in df.columns:
-                df[us_col] = df[si_col] * 9 / 5 + 32
-        else:
-            # Fill missing SI from US
-            if us_col in df.columns and si_col in df.columns:
-                df.loc[df[si_col].isna() & df[us_col].notna(), si_col] = df[us_col] * factor
-                df.loc[df[us_col].isna() & df[si_col].notna(), us_col] = df[si_col] / factor
-            elif us_col in df.columns:
-                df[si_col] = df[us_col] * factor
-            elif si_col in df.columns:
-                df[us_col] = df[si_col] / factor
-
-
-    # Ensure base pressures are numeric
-    for col in ['Barometric Pressure si', 'Diff Pressure si', 'Barometric Pressure us', 'Diff Pressure us']:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-
-    # Calculate Water Pressure in missing units
-    if 'Barometric Pressure si' in df.columns and 'Diff Pressure si' in df.columns:
-        df['Water Pressure si'] = df['Barometric Pressure si'] + df['Diff Pressure si']
-        df['Water Pressure us'] = df['Water Pressure si'] / 6.89476
-    elif 'Barometric Pressure us' in df.columns and 'Diff Pressure us' in df.columns:
-        df['Water Pressure us'] = df['Barometric Pressure us'] + df['Diff Pressure us']
-        df['Water Pressure si'] = df['Water Pressure us'] * 6.89476
-
-
-    df = df.dropna().reset_index(drop=True)
-    # Apply rounding and formatting to all numeric values
-    numeric_cols = df.select_dtypes(include='number').columns
-    df[numeric_cols] = df[numeric_cols].round(2)
-
-    # Rename columns to match MasterTable column names
-    new_column_names = {'timestamp': 'timestamp_UTC',
-                        'Water Temperature si': 'water_temperature_C',
-                        'Water Level si': 'water_level_m',
-                        'Water Pressure si': 'water_pressure_kPa',
-                        'Water Pressure us': 'water_pressure_psi',
-                        'Diff Pressure si': 'diff_pressure_kPa',
-                        'Diff Pressure us': 'diff_pressure_psi',
-                        'Water Temperature us': 'water_temperature_F',
-                        'Water Level us': 'water_level_ft',
-                        'Barometric Pressure si': 'barometric_pressure_kPa',
-                        'Barometric Pressure us': 'barometric_pressure_psi',
-                        'Battery': 'battery_V'
-                        }
-    
-    df = df.rename(columns=new_column_names)
-    
-    # If one of the columns doesn't exist, create a column with the right name and fill with nans
-    for col in new_column_names.values():
-        if col not in df.columns:
-            df[col] = np.nan
+def processed_frame(raw, rating_curve):
+    """
+    Derives the Processed MasterTable rows from Raw MasterTable rows - the discharge is calculated with the rating curve
+    and the QC columns are added. No API data is needed, so the Processed outputs can be rebuilt from the Raw tables.
 
-# check for 15 minute data and then resample
+    Parameters:
+    - raw: DataFrame with the Raw MasterTable columns
+    - rating_curve: RatingCurve or None. Without a rating curve the discharge is set to -9999.99
 
-    # Define the path for the long-running file
-    # if base_path=None the rating curve csv file must be stored in the same directory as where the script is running
-    dir_path = Path(base_path if base_path else './')
-    #dir_path.mkdir(parents=True, exist_ok=True)  # Ensure directory exists
-    rating_curve_path = dir_path / f'{site_name}/Rating_Curve/{site_name}.rating_curve_100_points.csv'
-    
-    # check if there is a rating curve. If not, set discharge to -9999.99
-    rating_curve_exists = os.path.exists(rating_curve_path)
-    if rating_curve_exists:
-        print('Rating curve found.')
-        # load the rating curve
-        rating_curve = pd.read_csv(rating_curve_path)
-        # Apply the rating curve to calculate discharge
-        water_flow_cfs = df['water_level_ft'].apply(lambda x: calculate_discharge(x, rating_curve))
-        water_flow_cfs = water_flow_cfs.round(6)
-
-        # Convert from cfs to cms with a vectorized operation
-        water_flow_cms = np.where(water_flow_cfs == -9999.99,
-                                            -9999.99,
-                                            water_flow_cfs * 0.0283168).round(6)
+    Returns:
+    - DataFrame with the Processed MasterTable columns
+    """
+    df2 = raw.reindex(columns=RAW_COLUMNS).copy()
+    if rating_curve is not None:
+        water_flow_cfs = np.round(rating_curve.discharge(df2['water_level_ft']), 6)
+        water_flow_cms = np.where(water_flow_cfs == -9999.99, -9999.99, water_flow_cfs * 0.0283168).round(6)
     else:
-        print('No rating curve. Setting all discharge to -9999.99')
-        # Set the discharge to -9999.99
-        water_flow_cfs = np.full(len(df['water_level_ft']),-9999.99)
-        water_flow_cms = np.full(len(df['water_level_ft']),-9999.99)
-    
-    # Add discharge columns to the dataframe
-    df2 = df.drop(columns=['battery_V'])
+        water_flow_cfs = np.full(len(df2), -9999.99)
+        water_flow_cms = np.full(len(df2), -9999.99)
+
     df2['discharge_cfs'] = water_flow_cfs
     df2['discharge_cms'] = water_flow_cms
+    df2['level_corrected_ft'] = -9999.99
+    df2['level_corrected_m'] = -9999.99
+    df2['qc_status'] = "Provisional"
+    return df2[PROCESSED_COLUMNS]
 
-    # Define new columns - used for QC process
-    df2['level_corrected_ft'] = [-9999.99] * len(df2)
-    df2['level_corrected_m'] = [-9999.99] * len(df2)
-    df2['qc_status'] = ["Provisional"] * len(df2)
-
-    # Define the desired order of columns for the processed data
-    desired_column_order = [
-			'timestamp_UTC',
-			'water_pressure_psi',
-			'barometric_pressure_psi',
-			'diff_pressure_psi',
-			'water_level_ft',
-			'level_corrected_ft',
-			'discharge_cfs',
-			'water_temperature_F',
-			'water_pressure_kPa',
-			'barometric_pressure_kPa',
-			'diff_pressure_kPa',
-			'water_level_m',
-			'level_corrected_m',
-			'discharge_cms',
-			'water_temperature_C',
-			'qc_status'
-    ]
-
-    # Define columns for Raw data (subset)
-    raw_columns = [
-			'timestamp_UTC',
-			'water_pressure_psi',
-			'barometric_pressure_psi',
-			'diff_pressure_psi',
-			'water_level_ft',
-			'water_temperature_F',
-			'water_pressure_kPa',
-			'barometric_pressure_kPa',
-			'diff_pressure_kPa',
-			'water_level_m',
-			'water_temperature_C'
-    ]
-
-    # Reorder columns for processed data
-    df2 = df2[desired_column_order]
-
-    # Resample the data to correct 15-minute intervals
-    df2['timestamp_UTC'] = pd.to_datetime(df2['timestamp_UTC'])
-
-    if any(df2['timestamp_UTC'].dt.minute % 15 != 0):
-        print("There are timestamps with irregular minutes. Resampling.")
-        
-        df2.set_index('timestamp_UTC', inplace=True)
-        df2.replace(-9999.99, np.nan, inplace=True)
-        
-        # Define aggregation rules (mean for numeric columns)
-        aggregations = {col: 'mean' for col in df2.columns if col != 'qc_status'}
-        
-        # Resample and round data
-        df2_resampled = df2.resample('15T').agg(aggregations).round(2)
-
-        # Fill NaN values with -9999.99 for numeric columns
-        for col in df2_resampled.select_dtypes(include=['number']).columns:
-            df2_resampled[col] = df2_resampled[col].fillna(-9999.99)
-
-        df2_resampled["qc_status"] = 'Provisional'
-        df2_resampled.index = df2_resampled.index.strftime('%Y-%m-%d %H:%M:%SZ')
-        
-        df2_resampled = df2_resampled.rename_axis('timestamp_UTC').reset_index()
-        df2 = df2_resampled
-    else:
-        print("All timestamps have regular minutes (00, 15, 30, or 45).")
-        df2['timestamp_UTC'] = df2['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%SZ')
-
-        # Fill NaN values with -9999.99
-        for col in df2.select_dtypes(include=['number']).columns:
-            df2[col] = df2[col].fillna(-9999.99)
-
-    # Set up base master path
-    master_path = Path(base_path if base_path else './') / site_name
-
-    # Create subdirectories for Raw and Processed
-    raw_path = master_path / "Raw"
-    processed_path = master_path / "Processed"
-    raw_path.mkdir(parents=True, exist_ok=True)
-    processed_path.mkdir(parents=True, exist_ok=True)
-
-    # File names
-    master_table_raw = raw_path / f"{site_name}_MasterTable_Raw.csv"
-    master_table_processed = processed_path / f"{site_name}_MasterTable_Processed.csv"
-
-    # Write to Raw CSV (only subset of columns)
-    df2[raw_columns].to_csv(master_table_raw, mode='a' if master_table_raw.exists() else 'w', 
-                            index=False, header=not master_table_raw.exists(), 
-                            escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-
-    # Set file permissions for Raw (User: RW, Group: R, Others: R) = `0o644`
-    os.chmod(master_table_raw, 0o644)
-
-    # Write to Processed CSV (all columns)
-    df2.to_csv(master_table_processed, mode='a' if master_table_processed.exists() else 'w', 
-            index=False, header=not master_table_processed.exists(), 
-            escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-
-    # Set file permissions for Processed (User: RW, Group: RW, Others: R) = `0o664`
-    os.chmod(master_table_processed, 0o664)
+def format_shef_values(values):
+    """
+    Vectorized version of format_shef_value - formats a whole column of values for SHEF output at once.
+    -9999.99 is written as -9999, every other value with two decimals.
+    """
+    values = np.asarray(values, dtype=float)
+    return np.where(values == -9999.99, "-9999", np.char.mod("%.2f", values)).astype(object)
 
-    # Convert timestamp back for grouping
-    df2['timestamp_UTC'] = pd.to_datetime(df2['timestamp_UTC'], format='%Y-%m-%d %H:%M:%S%z')
+def shef_lines(df, cdec, include_discharge):
+    """
+    Builds the SHEF .A lines for every row of a DataFrame whose 'timestamp_UTC' column is already in Pacific time.
+
+    The .A format is designed for the transmission of one or more hydrometeorological parameters observed at various times for a single station.
+    .A is the format used
+    P indicates Pacific time
+    DH = hour of day and also include minute value e.g. for 21:15 will be written as 2115
+    HGI = river stage (feet)
+    QRI = discharge (cubic feet per second)
+    TWI = water temperature (Fahrenheit, instantaneous)
+    PAI = barometric pressure (inHg, instantaneous)
+    VBI = battery voltage (Volts, instantaneous)
 
-    # Group data by date and hour
-    grouped = df2.groupby([
-        df2['timestamp_UTC'].dt.year,
-        df2['timestamp_UTC'].dt.month.apply(lambda x: f'{x:02d}'),
-        df2['timestamp_UTC'].dt.day.apply(lambda x: f'{x:02d}'),
-        df2['timestamp_UTC'].dt.hour.apply(lambda x: f'{x:02d}00')
-    ])
+    Returns:
+    - A Series of SHEF lines (without line endings) in the same order as the DataFrame.
+    """
+    timestamps = df['timestamp_UTC']
+    # Write a shef line with the stage value
+    lines = (".A " + str(cdec) + " " + timestamps.dt.strftime('%Y%m%d') + " P DH" + timestamps.dt.strftime('%H%M')
+             + " /HGI " + format_shef_values(df['water_level_ft']))
+    # If the rating_cuve_exists, include the discharge in the shef code.
+    if include_discharge:
+        lines = lines + "/QRI " + format_shef_values(df['discharge_cfs'])
+    lines = lines + "/TWI " + format_shef_values(df['water_temperature_F'])
+    lines = lines + "/PAI " + format_shef_values(df['barometric_pressure_psi'] * 2.03602)
+    lines = lines + "/VBI " + format_shef_values(df['battery_V'])
+    return lines
+
+def write_shef(df, site_name, cdec, base_path, include_discharge, single_file_name, mode='a', journal=None):
+    """
+    Writes SHEF output for a DataFrame whose 'timestamp_UTC' column is already in Pacific time:
+    - hourly files: {site_name}/SHEF_Output/YYYY/MM/DD/{cdec}_Streamflow_SHEF_YYYYMMDDHH.txt
+    - one file with every line: {site_name}/SHEF_Output/{single_file_name}
+    All lines are formatted at once, each file is written with a single buffered write and its permissions are set once.
 
-    # Raw Daily & Processed Daily
-    for (year, month, day, hour), group in grouped:
-        
-        # **Raw Daily**
-        raw_daily_path = raw_path / "Raw_Daily" / str(year) / str(month)
-        raw_daily_path.mkdir(parents=True, exist_ok=True)
-        raw_daily_file = raw_daily_path / f"{site_name}_{year}{month}{day}.csv"
-        
-        # Format timestamp for storage
-        group['timestamp_UTC'] = group['timestamp_UTC'].dt.strftime('%Y-%m-%d %H:%M:%S') + 'Z'
-        
-        # Store only selected raw columns
-        group[raw_columns].to_csv(raw_daily_file, mode='a' if raw_daily_file.exists() else 'w',
-                                index=False, header=not raw_daily_file.exists(),
-                                escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-
-        # Set file permissions for Raw Daily (User: RW, Group: R, Others: R) = `0o644`
-        os.chmod(raw_daily_file, 0o644)
-
-        # **Processed Daily**
-        processed_daily_path = processed_path / "Processed_Daily" / str(year) / str(month)
-        processed_daily_path.mkdir(parents=True, exist_ok=True)
-        processed_daily_file = processed_daily_path / f"{site_name}_{year}{month}{day}.csv"
-        
-        # Store entire DataFrame
-        group.to_csv(processed_daily_file, mode='a' if processed_daily_file.exists() else 'w',
-                    index=False, header=not processed_daily_file.exists(),
-                    escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
+    Parameters:
+    - df: DataFrame with the processed data and a 'battery_V' column
+    - site_name: str, the name of the site
+    - cdec: str, CDEC ID used in the SHEF lines and file names
+    - base_path: str or None, the base path where files will be saved
+    - include_discharge: bool, include the discharge (QRI) in the lines - only when there is a rating curve
+    - single_file_name: str or None, name of the file that all lines are appended to. None skips the single file
+    - mode: str, 'a' appends to the hourly files, 'w' replaces them (used when rebuilding the outputs)
+    - journal: Journal or None, stage the writes in a journal instead of writing the files (see HOBOlink_journal.py)
+    """
+    if df.empty:
+        return
+    lines = shef_lines(df, cdec, include_discharge)
+    shef_root = Path(base_path if base_path else f'./') / site_name / 'SHEF_Output'
+
+    # SHEF Hourly Output
+    hours = df['timestamp_UTC'].dt.strftime('%Y%m%d%H')
+    created_dirs = set()
+    for hour, hour_lines in lines.groupby(hours, sort=True):
+        shef_path = shef_root / hour[:4] / hour[4:6] / hour[6:8]
+        if journal is not None:
+            journal.append(shef_path / f"{cdec}_Streamflow_SHEF_{hour}.txt", '\n'.join(hour_lines) + '\n', 0o664, replace=mode == 'w')
+            continue
+        if shef_path not in created_dirs:
+            shef_path.mkdir(parents=True, exist_ok=True)
+            created_dirs.add(shef_path)
+        # Full path for the file to be saved
+        shef_file_path = shef_path / f"{cdec}_Streamflow_SHEF_{hour}.txt"
+        # append mode creates the file if it doesn't exist yet
+        with shef_file_path.open(mode=mode) as file:
+            file.write('\n'.join(hour_lines) + '\n')
+        os.chmod(shef_file_path, 0o664)
+
+    if single_file_name is None:
+        return
+
+    # SHEF output - append all new data to one file
+    if journal is not None:
+        journal.append(shef_root / single_file_name, '\n'.join(lines) + '\n', 0o775)
+        return
+    shef_root.mkdir(parents=True, exist_ok=True)
+    shef_file_path = shef_root / single_file_name
+    with shef_file_path.open(mode='a') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.chmod(shef_file_path, 0o775)
 
-        # Set file permissions for Processed Daily (User: RW, Group: RW, Others: R) = `0o664`
-        os.chmod(processed_daily_file, 0o664)            
-    
-    #------------------------------------------------------------------------------
+# Adjusted function to handle formatting and special case
+def format_shef_value(value):
+    # First, handle the special case of -9999.99
+    if value == -9999.99:
+        return "-9999"
+    # Then, format other values as floating-point numbers with appropriate precision
+    else:
+        return f"{value:.2f}"
     
+def parse_stream_backfill(hobolink_data, site_name, cdec=None, base_path=None, shef_toggle=False, archive_toggle=False):
+    """
+    Same as parse_stream, but all the SHEF lines are appended to a {cdec}_Streamflow_SHEF_backfill_YYYYMMDD.txt file
+    named after the current date instead of the latest file.
+    """
+    sinks = [AppendSink()]
+    if archive_toggle:
+        sinks.append(ArchiveSink())
+    sinks.append(DailySink())
     if shef_toggle == True and cdec != None:
-        # convert files to shef - must be done outside since the other files are in UTC 
-        # Add battery column back in
-        df2['battery_V'] = df['battery_V']
-        
-        # Ensure timestamps include a timezone offset instead of just 'UTC'
-        # If not, you'll need to preprocess them to include a proper offset (e.g., replace 'UTC' with '+0000')
-        df2['timestamp_UTC'] = pd.to_datetime(df2['timestamp_UTC'], format='%Y-%m-%d %H:%M:%S%z')
-        
-        # Convert to Pacific Time
-        pacific = pytz.timezone('US/Pacific')
-        df2['timestamp_UTC'] = df2['timestamp_UTC'].dt.tz_convert(pacific)
-
-        # Group data by date
-        grouped = df2.groupby([df2['timestamp_UTC'].dt.year, 
-                            df2['timestamp_UTC'].dt.month.apply(lambda x: f'{x:02d}'), 
-                            df2['timestamp_UTC'].dt.day.apply(lambda x: f'{x:02d}'),
-                            df2['timestamp_UTC'].dt.hour.apply(lambda x: f'{x:02d}')])
-
-        for (year, month, day, hour), group in grouped:
-            #SHEF Hourly Output
-            shef_path = Path(base_path if base_path else f'./') / site_name / 'SHEF_Output' / str(year) / str(month) / str(day)
-            shef_path.mkdir(parents=True, exist_ok=True)
-            # Define the filename for SHEF files
-            shef_file = f"{cdec}_Streamflow_SHEF_{year}{month}{day}{hour}.txt"
-
-            # Full path for the file to be saved
-            shef_file_path = shef_path / shef_file
-            
-            # Determine the file mode: 'a' to append if the file exists, 'w' to write otherwise
-            file_mode = 'a' if shef_file_path.exists() else 'w'
-
-            # Open the file to write SHEF data
-            with shef_file_path.open(mode=file_mode) as file:
-                for _, row in group.iterrows():
-                    # Format the timestamp in SHEF format
-                    timestamp_shef = row['timestamp_UTC'].strftime('%Y%m%d%H%M')
-                    # Write stage and discharge lines in SHEF format
-                    """
-                    The .A format is designed for the transmission of one or more hydrometeorological parameters observed at various times for a single station.
-                    .A is the format used
-                    P indicates Pacific time
-                    DH = hour of day and also include minute value e.g. for 21:15 will be written as 2115
-                    HGI = river stage (feet)
-                    QRI = discharge (cubic feet per second)
-                    """
-                    # Write a shef line with the stage value
-                    data_line = f".A {cdec} {timestamp_shef[:8]} P DH{timestamp_shef[8:]} /HGI {format_shef_value(row['water_level_ft'])}"
-                    # If the rating_cuve_exists, include the discharge in the shef code.
-                    if rating_curve_exists:
-                        data_line = data_line + f"/QRI {format_shef_value(row['discharge_cfs'])}"
-                    # Include the water temperature (TWI for Fahrenheit, instantaneous)
-                    data_line = data_line + f"/TWI {format_shef_value(row['water_temperature_F'])}"
-                    # Include the barometric pressure (PAI in inHg, instantaneous).
-                    data_line = data_line + f"/PAI {format_shef_value(row['barometric_pressure_psi']*2.03602)}"
-                    # Include the battery data (VBI for battery voltage in Volts, instantaneous)
-                    data_line = data_line + f"/VBI {format_shef_value(row['battery_V'])}"
-                    
-
-                    # Write to the file
-                    file.write(data_line + '\n')
-                    os.chmod(shef_file_path, 0o664)
-            
-        #SHEF output - append all new data to one file
-        shef_path = Path(base_path if base_path else f'./') / site_name / 'SHEF_Output'
-        shef_path.mkdir(parents=True, exist_ok=True)
-        # Define the filename for SHEF files
         # Get current date for backfill file name
         current_date_str = datetime.now().strftime('%Y%m%d')
-        shef_file = f"{cdec}_Streamflow_SHEF_backfill_{current_date_str}.txt"
-
-        # Full path for the file to be saved
-        shef_file_path = shef_path / shef_file
-        
-        # Determine the file mode: 'a' to append if the file exists, 'w' to write otherwise
-        file_mode = 'a' if shef_file_path.exists() else 'w'
-        # check if there is any timestamp at the start of the new hour (00 minute)
-        #overwrite = df2['timestamp_UTC'].dt.minute.isin([0]).any()
-        #file_mode = 'w' if overwrite else 'a'
-            
-        # Open the file to write SHEF data
-        with shef_file_path.open(mode=file_mode) as file:
-            for _, row in df2.iterrows():
-                # Format the timestamp in SHEF format
-                timestamp_shef = row['timestamp_UTC'].strftime('%Y%m%d%H%M')
-                # Write stage and discharge lines in SHEF format
-                """
-                The .A format is designed for the transmission of one or more hydrometeorological parameters observed at various times for a single station.
-                .A is the format used
-                P indicates Pacific time
-                DH = hour of day and also include minute value e.g. for 21:15 will be written as 2115
-                HGI = river stage (feet)
-                QRI = discharge (cubic feet per second)
-                """
-                # Write a shef line with the stage value
-                data_line = f".A {cdec} {timestamp_shef[:8]} P DH{timestamp_shef[8:]} /HGI {format_shef_value(row['water_level_ft'])}"
-                # If the rating_cuve_exists, include the discharge in the shef code.
-                if rating_curve_exists:
-                    data_line = data_line + f"/QRI {format_shef_value(row['discharge_cfs'])}"
-                # Include the water temperature (TW for Fahrenheit, TU for Celcius)
-                data_line = data_line + f"/TWI {format_shef_value(row['water_temperature_F'])}"
-                # Include the barometric pressure (PAI in inHg, instantaneous).
-                data_line = data_line + f"/PAI {format_shef_value(row['barometric_pressure_psi']*2.03602)}"
-                # Include the battery data (VBI for battery voltage in Volts, instantaneous)
-                data_line = data_line + f"/VBI {format_shef_value(row['battery_V'])}"
-
-                # Write to the file
-                file.write(data_line + '\n')
-                os.chmod(shef_file_path, 0o775)
-
-    # Return both the number of records processed and the list of filenames
-    return df2.shape[0] #, filename_list
\ No newline at end of file
+        sinks.append(ShefSink(cdec, f"{cdec}_Streamflow_SHEF_backfill_{current_date_str}.txt"))
+    return process_stream(hobolink_data, site_name, base_path, sinks)
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Parsers for each site type
+# HOBOlink.py, the response cache replay and the CLI look up the parser of a site type here instead of branching on
+# 'S'/'P'. Each parser knows its metadata csv, the number of channels its loggers report and how to record a response.
+# A new station type only needs a parser class registered with register_parser:
+#
+#   class SnowParser(SiteParser):
+#       site_type = 'N'
+#       metadata_csv = 'Snow_Metadata.csv'
+#       default_channels = 4
+#       def parse(self, data, site_id, cdec_id=None, base_path=None, shef_toggle=False, archive_toggle=False, live=False,
+#                 logging_interval_minutes=None):
+#           ...
+#   register_parser(SnowParser())
+
+class SiteParser:
+    """
+    Base class of the site type parsers.
+
+    Attributes:
+    - site_type: str, letter used for the site type in the scripts and the metadata csv ('S', 'P', ...)
+    - metadata_csv: str, metadata csv listing the sites of this type
+    - default_channels: int, values a logger reports per timestamp - used to size each request
+    """
+    site_type = None
+    metadata_csv = None
+    default_channels = 6
+
+    def parse(self, data, site_id, cdec_id=None, base_path=None, shef_toggle=False, archive_toggle=False, live=False,
+              logging_interval_minutes=None):
+        """
+        Records one API response to the site's files.
+
+        Parameters:
+        - data: data returned by the HOBOLink API call
+        - site_id: str, the site ID from the metadata csv
+        - cdec_id: str or None, the CDEC ID of the site
+        - base_path: str or None, the base path where files are saved
+        - shef_toggle: bool, write the SHEF files
+        - archive_toggle: bool, also write the rows to the Parquet archive
+        - live: bool, the response continues the site's latest data (HOBOlink.py). Only live pulls keep partial
+          resample intervals in the site's state file - historical pulls and replays resample on their own
+        - logging_interval_minutes: int or None, logging interval of the site, used to tell when a carried interval
+          is complete
+
+        Returns:
+        - int, number of records parsed
+        """
+        raise NotImplementedError
+
+class StreamParser(SiteParser):
+    # Stream gauges - MasterTable, Daily and SHEF files (parse_stream)
+    site_type = 'S'
+    metadata_csv = 'Streams_Metadata.csv'
+    default_channels = 6
+
+    def parse(self, data, site_id, cdec_id=None, base_path=None, shef_toggle=False, archive_toggle=False, live=False,
+              logging_interval_minutes=None):
+        from HOBOlink_parse import parse_stream
+        return parse_stream(data, site_id, cdec_id, base_path=base_path, shef_toggle=shef_toggle, archive_toggle=archive_toggle,
+                            carry_bins=live, logging_interval_minutes=logging_interval_minutes)
+
+class PrecipMetParser(SiteParser):
+    # PrecipMet stations - the tipping bucket (parse_precip) and the met channels (parse_met) of the same response
+    # resample_freq (e.g. '15min') also writes the precipitation summed over fixed intervals
+    site_type = 'P'
+    metadata_csv = 'PrecipMet_Metadata.csv'
+    default_channels = 8
+
+    def __init__(self, resample_freq=None):
+        self.resample_freq = resample_freq
+
+    def parse(self, data, site_id, cdec_id=None, base_path=None, shef_toggle=False, archive_toggle=False, live=False,
+              logging_interval_minutes=None):
+        from HOBOlink_parse import parse_precip, parse_met
+        records = parse_precip(data, site_id, base_path=base_path, append_to_single_file=True, archive_toggle=archive_toggle,
+                               resample_freq=self.resample_freq if live else None)
+        parse_met(data, site_id, base_path=base_path, archive_toggle=archive_toggle)
+        return records
+
+# site type -> parser
+PARSERS = {}
+
+def register_parser(parser):
+    """
+    Adds a parser to the registry, replacing any parser already registered for its site type.
+    """
+    PARSERS[parser.site_type.upper()] = parser
+    return parser
+
+def parser_for(site_type):
+    """
+    Returns the parser registered for a site type ('S', 's', 'P', ...).
+    """
+    try:
+        return PARSERS[str(site_type).upper()]
+    except KeyError:
+        raise ValueError(f"Unknown site type {site_type!r} - expected one of {', '.join(sorted(PARSERS))}")
+
+register_parser(StreamParser())
+register_parser(PrecipMetParser())
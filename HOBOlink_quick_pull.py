@@ -3,23 +3,28 @@
 # Adolfo Lopez Miranda
 
 # import modules
-import requests, os, time, pandas as pd, csv, numpy as np
-from datetime import datetime, timezone, timedelta
+import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv, find_dotenv
 #from pathlib import Path
-from HOBOlink_parse import get_new_token, parse_stream, timestamp_chunks, find_nan_optimized, backfill_stream, calculate_discharge
+from HOBOlink_parse import parse_stream, plan_chunks, find_gaps, backfill_stream
+from HOBOlink_client import HOBOlinkClient, API_URL
+from HOBOlink_cache import cache_from_env
 
 # load .env file - the .env file is the best place to store sensitive info such as the user ID, and token information
 load_dotenv(find_dotenv())
 
 # load path where data will be stored
-base_dir = "/data/CW3E_data/CW3E_Streamflow_Archive/"
+base_dir = os.environ.get("HOBOLINK_BASE_DIR", "/data/CW3E_data/CW3E_Streamflow_Archive/")
 # Note base_dir will need to be indicated in the parse fucntion - the default is None (data will be stored in the same place as where the script is running)
 #base_dir.mkdir(parents=True, exist_ok=True)  # Ensure directory exists
 
 # SHEF Output Toggle
 shef = True
 
+# Parquet archive toggle - also write the data to {site}/Archive (requires pyarrow, see HOBOlink_archive.py)
+archive = False
+
 # HOBOlink account and device info
 logger_id='22050044' # update this to the correct Logger SN - can be found on HOBOlink
 site_id='WHT' # Change this to the appropriate site ID
@@ -50,176 +55,103 @@ end_dt = datetime.strptime(end_str, date_format)
 # interval - logging interval setup on HOBOlink
 # streams is 15 and precip is 2 - as of March 2024
 interval = 15
+interval_minutes = interval # kept separately - `interval` is reused as a loop variable below
 int_t =  60 * interval  #converting log interval into seconds
 overlap_t = timedelta(seconds=int_t) # will be used to break up data chunks appropriately on data pull
-    
-# workaround to avoid data limit is to break up timestamps into smaller intervals (if needed)
-timestamp_intervals = timestamp_chunks(start_dt, end_dt, overlap_t)
-url_intervals = []  # list to hold url str with timestamp parameters
-for interval in timestamp_intervals:
-    url_start = interval[0].strftime("&start_date_time=%Y-%m-%d+%H") + "%3A" + interval[0].strftime("%M") + "%3A" + interval[0].strftime("%S")
-    url_end = interval[1].strftime("&end_date_time=%Y-%m-%d+%H") + "%3A" + interval[1].strftime("%M") + "%3A" + interval[1].strftime("%S")
-    url_timestamp = url_start + url_end
-    url_intervals.append(url_timestamp)
-
-#--------------------------------------------------------------------------------------------------------------------------------------------------
-# loop over the intervals and make requests to get the data
-print("Timestamp ranges for the desired data:", start_str, "to", end_str)
-
-for i in range(len(url_intervals)):
-    print("pulling data chunk for the following period:")
-    print(timestamp_intervals[i][0].strftime("%Y-%m-%d %H:%M:%SZ"), "-", timestamp_intervals[i][1].strftime("%Y-%m-%d %H:%M:%SZ"))
-    # HOBOlink url to get data from file endpoints
-    hobolink_api_url = "https://api.hobolink.licor.cloud/v1/data?loggers=" + logger_id + url_intervals[i]
-    while True:
-        #  send data request using token
-        api_call_headers = {
-            'accept': 'application/json',
-            'Authorization': 'Bearer ' + token} # HTTP Authentication required for HOBOlink
-        api_call_response = requests.get(hobolink_api_url, headers=api_call_headers, verify=True) # requests a representation of the specified resource
-        if api_call_response.status_code == 200: 
-            # Convert data to dict
-            data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
-            
-            # TODO: resample the data
-            
-            
-            if len(data["observation_list"]) > 0 :
-                data_int = parse_stream(data, site_id, cdec, base_path=base_dir, append_to_single_file=False, shef_toggle=shef)
-            elif len(data["observation_list"]) == 0:
-                print('No data available.')
-            break
-        elif api_call_response.status_code == 400 or api_call_response.status_code == 500 or api_call_response.status_code == 509: 
-            # Failures have occured - Record error code and error description in log file
-            data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
-            print('error: %s\nmessage: %s\nerror_description: %s' %(data["error"], data["message"], data["error_description"]))
-        else:
-            # record status code and response in log file
-            data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
-            print('Unexpected status code: %s\n Unexpected Response: %s' %(api_call_response.status_code, data))
-        break
-    time.sleep(5) #delay added to avoid excessive requests to server.
-
-#----------------------------------------------------------------------------------------------------------------------------------
-# Backfill data if data points were missed
-# check csv for missing data points
-file_csv = f'{site_id}_MasterTable.csv'
-#nan_check = find_nan(file_csv)
-nan_check = find_nan_optimized(f'{base_dir}/{site_id}/{file_csv}')
-print(nan_check)
-# If NaN's or blank spaces exist backfill that data by pulling data again
-# check if NaN's or blank spaces were found
-nan_range = []
-url_intervals = []  # list to hold url str with timestamp parameters
-if nan_check != "no":
-    print("Timestamp ranges with NaN values or empty spaces:")
-    for start, end in nan_check:
-        print(f"Start: {start}, End: {end}")
-        datetime.strptime(start, date_format)
-        nan_range.append((datetime.strptime(start, date_format), datetime.strptime(end, date_format)))
-    
-    for nan_start, nan_end in nan_range:
-        # workaround to avoid data limit is to break up timestamps into smaller intervals (if needed)
-        timestamp_intervals = timestamp_chunks(nan_start, nan_end, overlap_t)
-        #print(timestamp_intervals)
-        for interval in timestamp_intervals:
-            url_start = interval[0].strftime("&start_date_time=%Y-%m-%d+%H") + "%3A" + interval[0].strftime("%M") + "%3A" + interval[0].strftime("%S")
-            url_end = interval[1].strftime("&end_date_time=%Y-%m-%d+%H") + "%3A" + interval[1].strftime("%M") + "%3A" + interval[1].strftime("%S")
-            url_timestamp = url_start + url_end
-            url_intervals.append(url_timestamp)
-    
-    #print(url_intervals)
 
-    for url in url_intervals:
-        print("Backfilling data.")
-        # HOBOlink url to get data from file endpoints
-        hobolink_api_url = "https://api.hobolink.licor.cloud/v1/data?loggers=" + logger_id + url_intervals[i]
+# number of values the logger reports per timestamp (sensors and battery) - used to size each request
+n_channels = 6
     
-        while True:
-            #  send data request using token
-            api_call_headers = {
-                'accept': 'application/json',
-                'Authorization': 'Bearer ' + token} # HTTP Authentication required for HOBOlink
-            api_call_response = requests.get(hobolink_api_url, headers=api_call_headers, verify=True) # requests a representation of the specified resource
+def main(site_id=site_id, logger_id=logger_id, cdec=cdec, start_dt=start_dt, end_dt=end_dt, interval_minutes=interval_minutes, n_channels=n_channels):
+    """
+    Pulls a site for a fixed time range, then pulls again any gaps found in its MasterTable.
+
+    Parameters:
+    - site_id: str, site ID used in the directory structure and file names
+    - logger_id: str, logger serial number
+    - cdec: str or None, CDEC ID used for the SHEF output
+    - start_dt, end_dt: datetime, time range to pull (UTC)
+    - interval_minutes: int, logging interval of the site
+    - n_channels: int, number of values the logger reports per timestamp
+    """
+    start_str = start_dt.strftime("%Y-%m-%d %H:%M:%SZ")
+    end_str = end_dt.strftime("%Y-%m-%d %H:%M:%SZ")
+
+    # API client - pooled keep-alive connections, retries with backoff on 509/5xx and a token bucket rate limit
+    # requests_per_second replaces the fixed delay that used to be added between requests
+    # responses are cached when RESPONSE_CACHE_DIR is set (see HOBOlink_cache.py)
+    response_cache = cache_from_env()
+    client = HOBOlinkClient(token, base_url=os.environ.get("HOBOLINK_API_URL", API_URL),
+                            requests_per_second=float(os.environ.get("MAX_REQUESTS_PER_SECOND", 1)), cache=response_cache)
+
+    # workaround to avoid data limit is to break up timestamps into windows that stay under the 100,000 data point limit
+    timestamp_intervals = plan_chunks(start_dt, end_dt, interval_minutes, n_channels)
+
+    #--------------------------------------------------------------------------------------------------------------------------------------------------
+    # loop over the intervals and make requests to get the data
+    print("Timestamp ranges for the desired data:", start_str, "to", end_str)
+
+    for window_start, window_end in timestamp_intervals:
+        #  send data request using token - 509 and 5xx responses are retried, truncated windows are split by the client
+        for chunk_start, chunk_end, api_call_response, data in client.get_window(logger_id, window_start, window_end, interval_minutes):
+            print("pulling data chunk for the following period:")
+            print(chunk_start.strftime("%Y-%m-%d %H:%M:%SZ"), "-", chunk_end.strftime("%Y-%m-%d %H:%M:%SZ"))
             if api_call_response.status_code == 200: 
-                # Convert data to dict
-                data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
-                if len(data["observation_list"]) > 0 :
-                    #print(data["observation_list"])
-                    backfill_stream(data,file_csv)
-                    #print("Data has been parsed and stored in:", f)
-                elif len(data["observation_list"]) == 0:
+                # data from HOBOlink will be in JSON JavaScript Object Notation
+                # parse_stream resamples off-grid timestamps to 15 minutes (see resample_stream)
+                if len(data["data"]) > 0 :
+                    data_int = parse_stream(data, site_id, cdec, base_path=base_dir, shef_toggle=shef, archive_toggle=archive)
+                elif len(data["data"]) == 0:
                     print('No data available.')
-                break
             elif api_call_response.status_code == 400 or api_call_response.status_code == 500 or api_call_response.status_code == 509: 
                 # Failures have occured - Record error code and error description in log file
-                data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
                 print('error: %s\nmessage: %s\nerror_description: %s' %(data["error"], data["message"], data["error_description"]))
             else:
                 # record status code and response in log file
-                data = api_call_response.json() # data from HOBOlink will be in JSON JavaScript Object Notation
                 print('Unexpected status code: %s\n Unexpected Response: %s' %(api_call_response.status_code, data))
-            break
-        time.sleep(5) #delay added to avoid excessive requests to server.
-
-else:
-    print("No NaN's or blanks found. Data is complete.")
 
-#------------------------------------------------------------------------------------------------------------------------------
-# TODO: have it resample data between the start and end date.
-# Have it put the resampled data into the correct place in the MasterTable.
-'''
-# Resample data if neccessary - this is only necessary for streams at the moment. Will output a seperate csv from the raw data
-# Define the target date for comparison (March 15th, 2024)
-target_date = datetime(2024, 8, 1, tzinfo=timezone.utc) # all streams were switch to 15th minute logging intervals around this time
-# Check if start_dt is before the target date and if it also a Stream site (S)
-if site_type == 'S' or site_type == "s" and start_dt < target_date:
-    df = pd.read_csv(f'{base_dir}/{site_id}/{file_csv}')
-    # Convert the timestamp column to datetime
-    df['timestamp_UTC'] = pd.to_datetime(df['timestamp_UTC'])
-    # Set the timestamp column as the index
-    df.set_index('timestamp_UTC', inplace=True)
-    # Step 1: Convert -9999.99 to NaN
-    df.replace(-9999.99, np.nan, inplace=True)
-    # Define an aggregation dictionary that specifies how to aggregate each column
-    # For numeric columns, use 'mean'; exclude or use a different function for non-numeric columns
-    aggregations = {col: 'mean' for col in df.columns if col != 'qc_status'}
-    # You can add the 'qc_status' column back later or handle it separately as needed
-    # Resample using the defined aggregations
-    df_resampled = df.resample('15T').agg(aggregations)
-    # Round the values to two decimal places
-    df_resampled = df_resampled.round(2)
-    # Fill NaN values with -9999.99 for numeric columns only
-    for col in df_resampled.select_dtypes(include=['number']).columns:
-        if col != 'qc_status':  # Skip 'qc_status' column
-            df_resampled[col] = df_resampled[col].fillna(-9999.99)
-                
-    #add qc column back in
-    df_resampled["qc_status"] = 'Provisional'
-    # Convert timestamp back to string format
-    df_resampled.index = df_resampled.index.strftime('%Y-%m-%d %H:%M:%SZ')
-    # Output the resampled data to a new CSV file
-    # Save data to csv file
-    resampled_csv = f'{base_dir}/{site_id}/{site_id}_resampled_data.csv'
-    file_exists = os.path.isfile(resampled_csv)
-    if file_exists == True:
-        header = False
-    elif file_exists == False:
-        header = True
-    #df_resampled.to_csv(resampled_csv, mode='a', header=header, escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-    #print("Data has been resampled and stored in:", resampled_csv)
-    
-    df_resampled.to_csv(resampled_csv, mode='a', header=header, escapechar='\\', quoting=csv.QUOTE_NONNUMERIC)
-    print("Data has been resampled and stored in:", resampled_csv)
-    
-print("Data pull complete for:", site_id)
+    #----------------------------------------------------------------------------------------------------------------------------------
+    # Backfill data if data points were missed
+    # check csv for missing data points - missing timestamps, blank/NaN values and -9999.99 rows
+    file_csv = f'{site_id}_MasterTable_Raw.csv'
+    #nan_check = find_nan(file_csv)
+    gap_ranges = find_gaps(f'{base_dir}/{site_id}/Raw/{file_csv}', interval_minutes)
+    # If gaps exist backfill that data by pulling data again
+    if gap_ranges:
+        print("Timestamp ranges with missing data:")
+        timestamp_intervals = []
+        for gap_start, gap_end in gap_ranges:
+            print(f"Start: {gap_start}, End: {gap_end}")
+            # workaround to avoid data limit is to break up timestamps into smaller intervals (if needed)
+            timestamp_intervals += plan_chunks(gap_start, gap_end, interval_minutes, n_channels)
+
+        for window_start, window_end in timestamp_intervals:
+            print("Backfilling data.")
+            #  send data request using token - 509 and 5xx responses are retried, truncated windows are split by the client
+            for _, _, api_call_response, data in client.get_window(logger_id, window_start, window_end, interval_minutes):
+                if api_call_response.status_code == 200: 
+                    # data from HOBOlink will be in JSON JavaScript Object Notation
+                    if len(data["data"]) > 0 :
+                        #print(data["data"])
+                        backfill_stream(data, site_id, cdec, base_path=base_dir, shef_toggle=shef, archive_toggle=archive)
+                        #print("Data has been parsed and stored in:", f)
+                    elif len(data["data"]) == 0:
+                        print('No data available.')
+                elif api_call_response.status_code == 400 or api_call_response.status_code == 500 or api_call_response.status_code == 509: 
+                    # Failures have occured - Record error code and error description in log file
+                    print('error: %s\nmessage: %s\nerror_description: %s' %(data["error"], data["message"], data["error_description"]))
+                else:
+                    # record status code and response in log file
+                    print('Unexpected status code: %s\n Unexpected Response: %s' %(api_call_response.status_code, data))
+
+    else:
+        print("No gaps found. Data is complete.")
+
+    client.close()
+
+if __name__ == '__main__':
+    main()
 
-# Write the RawDaily files.
-write_RawDaily(pd.read_csv(resampled_csv), site_id, base_dir)
-
-# Write the hourly SHEF_Output files, and a backfill file with all the shef codes to send to CDEC.
-#write_SHEFhourly(pd.read_csv(resampled_csv), site_id, base_dir)
-'''
 #-----------------------------------------------------------------------------------------
 # process stream data
 # Define the path to the rating curve and stage data files
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Rebuilds the Processed outputs of stream sites from their Raw MasterTables - no API requests are made.
+# Use it after a rating curve changes or a conversion is fixed to regenerate:
+#   {site}/Processed/{site}_MasterTable_Processed.csv
+#   {site}/Processed/Processed_Daily/YYYY/MM/{site}_YYYYMMDD.csv
+#   {site}/SHEF_Output/YYYY/MM/DD/{cdec}_Streamflow_SHEF_YYYYMMDDHH.txt (optional)
+# The Raw MasterTable of every site is split into one file per year in a single pass, and the years are rebuilt by a
+# process pool - each job only reads its own year.
+#
+# Usage: python HOBOlink_reprocess.py <base_dir> [site_ID ...] [--shef]
+# Sites default to every site in Streams_Metadata.csv
+
+# import modules
+import sys, re, pytz, tempfile, pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from HOBOlink_parse import load_rating_curve, processed_frame, write_shef, atomic_write_csv, DailyFileWriter
+
+def raw_table_path(base_path, site_name):
+    return Path(base_path if base_path else './') / site_name / "Raw" / f"{site_name}_MasterTable_Raw.csv"
+
+def rating_curve_path(base_path, site_name):
+    return Path(base_path if base_path else './') / site_name / 'Rating_Curve' / f'{site_name}.rating_curve_100_points.csv'
+
+def split_raw_years(base_path, site_name, directory, chunksize=200000):
+    """
+    Splits a site's Raw MasterTable into one csv file per year, reading the table once.
+
+    Parameters:
+    - base_path: str or None, the base path where files are saved
+    - site_name: str, site ID
+    - directory: str or Path, directory the year files are written to
+    - chunksize: int, number of rows read at a time
+
+    Returns:
+    - dict of {year ('YYYY'): Path of the year's file}
+    """
+    paths = {}
+    for chunk in pd.read_csv(raw_table_path(base_path, site_name), chunksize=chunksize):
+        years = chunk['timestamp_UTC'].astype(str).str[:4]
+        for year, group in chunk.groupby(years, sort=True):
+            if not year.isdigit():
+                continue
+            year_path = Path(directory) / f"{site_name}_{year}.csv"
+            group.to_csv(year_path, mode='a', index=False, header=year not in paths)
+            paths[year] = year_path
+    return dict(sorted(paths.items()))
+
+def shef_battery(shef_root, cdec, timestamps):
+    """
+    Reads the battery voltage (VBI) of the lines already in the SHEF hourly files. The battery voltage is not stored in
+    the Raw MasterTable, so it is carried over from the files that are being rebuilt.
+
+    Parameters:
+    - shef_root: Path, the site's SHEF_Output directory
+    - cdec: str, CDEC ID used in the file names
+    - timestamps: Series of timestamps in Pacific time
+
+    Returns:
+    - Series of battery voltages in the same order as timestamps, -9999.99 where no file has a value
+    """
+    keys = timestamps.dt.strftime('%Y%m%d%H%M')
+    battery = {}
+    for hour in keys.str[:10].unique():
+        shef_file_path = shef_root / hour[:4] / hour[4:6] / hour[6:8] / f"{cdec}_Streamflow_SHEF_{hour}.txt"
+        if not shef_file_path.exists():
+            continue
+        with open(shef_file_path, 'r') as file:
+            for line in file:
+                fields = line.split()
+                match = re.search(r'/VBI (\S+)', line)
+                if len(fields) >= 5 and fields[0] == '.A' and match and match.group(1) != '-9999':
+                    battery[fields[2] + fields[4][2:]] = float(match.group(1))
+    return keys.map(battery).fillna(-9999.99).astype(float)
+
+def reprocess_year(base_path, site_name, year, raw_year_path, cdec=None, shef_toggle=False):
+    """
+    Rebuilds one year of a site's Processed outputs. The Processed_Daily and SHEF hourly files of the year are
+    replaced; the Processed MasterTable is written by the caller once every year of the site is done.
+
+    Parameters:
+    - base_path: str or None, the base path where files are saved
+    - site_name: str, site ID
+    - year: str, year to rebuild ('YYYY')
+    - raw_year_path: str or Path, the Raw MasterTable rows of the year (see split_raw_years)
+    - cdec: str or None, CDEC ID used for the SHEF files
+    - shef_toggle: bool, also rebuild the SHEF hourly files. The battery voltage (VBI) of the existing files is kept
+
+    Returns:
+    - DataFrame with the Processed MasterTable rows of the year
+    """
+    master_path = Path(base_path if base_path else './') / site_name
+    # a rebuild replaces the discharge of every row - fail instead of overwriting it with -9999.99
+    rating_curve = load_rating_curve(rating_curve_path(base_path, site_name), site_name, strict=True)
+
+    df2 = processed_frame(pd.read_csv(raw_year_path), rating_curve)
+    # a new writer per job - the directory cache of a forked worker can't be trusted
+    DailyFileWriter().write(df2, master_path / "Processed" / "Processed_Daily", site_name, 0o664, mode='w')
+
+    if shef_toggle and cdec:
+        shef = df2.copy()
+        shef['timestamp_UTC'] = pd.to_datetime(shef['timestamp_UTC'], format='%Y-%m-%d %H:%M:%S%z').dt.tz_convert(pytz.timezone('US/Pacific'))
+        # the battery voltage is not stored in the Raw MasterTable - keep the values of the files being replaced
+        shef['battery_V'] = shef_battery(master_path / 'SHEF_Output', cdec, shef['timestamp_UTC'])
+        write_shef(shef, site_name, cdec, base_path, rating_curve is not None, None, mode='w')
+    return df2
+
+def reprocess_sites(sites, base_path=None, shef_toggle=False, max_workers=None):
+    """
+    Rebuilds the Processed outputs of several stream sites from their Raw MasterTables with a process pool.
+
+    Parameters:
+    - sites: dict of {site ID: CDEC ID or None}
+    - base_path: str or None, the base path where files are saved
+    - shef_toggle: bool, also rebuild the SHEF hourly files
+    - max_workers: int or None, number of processes. Defaults to the number of cores
+
+    Returns:
+    - dict of {site ID: number of rows written to the Processed MasterTable}
+    """
+    # check every rating curve first, so a broken curve stops the rebuild before any file is replaced
+    for site_name in sites:
+        load_rating_curve(rating_curve_path(base_path, site_name), site_name, strict=True)
+
+    rows = {}
+    with tempfile.TemporaryDirectory() as split_dir, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # one pass over each Raw MasterTable - every job then reads only its own year
+        jobs = [(site_name, year, year_path) for site_name in sites if raw_table_path(base_path, site_name).exists()
+                for year, year_path in split_raw_years(base_path, site_name, split_dir).items()]
+        remaining = {site_name: sum(1 for site, _, _ in jobs if site == site_name) for site_name, _, _ in jobs}
+        results = {site_name: {} for site_name in remaining}
+
+        futures = {executor.submit(reprocess_year, base_path, site_name, year, year_path, sites[site_name], shef_toggle): (site_name, year)
+                   for site_name, year, year_path in jobs}
+        for future in as_completed(futures):
+            site_name, year = futures[future]
+            results[site_name][year] = future.result()
+            remaining[site_name] -= 1
+
+            # every year of the site is done - replace the Processed MasterTable in one write
+            if remaining[site_name] == 0:
+                years = results.pop(site_name)
+                df2 = pd.concat([years[year] for year in sorted(years)], ignore_index=True)
+                master_table_processed = Path(base_path if base_path else './') / site_name / "Processed" / f"{site_name}_MasterTable_Processed.csv"
+                atomic_write_csv(df2, master_table_processed, permissions=0o664)
+                rows[site_name] = df2.shape[0]
+                print(f'Reprocessed {site_name}: {df2.shape[0]} rows.')
+    return rows
+
+def metadata_sites(site_ids=None, metadata_csv='Streams_Metadata.csv'):
+    """
+    Returns {site ID: CDEC ID or None} for the sites in the metadata csv, or only for site_ids if given.
+    """
+    df_sites = pd.read_csv(metadata_csv).set_index('site_ID')
+    cdec_ids = {site_id: (None if pd.isna(row['CDEC_ID']) or row['CDEC_ID'] == '' else row['CDEC_ID'])
+                for site_id, row in df_sites.iterrows()}
+    return {site_id: cdec_ids.get(site_id) for site_id in (site_ids or cdec_ids)}
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--shef']
+    if not args:
+        print("Usage: python HOBOlink_reprocess.py <base_dir> [site_ID ...] [--shef]")
+        sys.exit(1)
+    base_dir, site_ids = args[0], args[1:]
+
+    reprocess_sites(metadata_sites(site_ids), base_path=base_dir, shef_toggle='--shef' in sys.argv)
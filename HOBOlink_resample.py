@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Incremental resampling of irregular logger data to fixed intervals (e.g. 15 minutes)
+# Each batch is aggregated on its own and only the bins that are complete are returned. The bin still being filled at
+# the end of a batch is carried over to the next run in the site's state file (running sums, counts and last values),
+# so a bin that spans two pulls is written once with all of its samples instead of twice, half filled each time.
+#
+# A bin [t, t + freq) is complete once the data reaches its end: the last timestamp of the batch plus the logger's
+# nominal logging interval is at or past t + freq. Without a logging interval a bin is only complete once a later
+# timestamp has arrived, so a bin is never written before all of its samples are in.
+#
+# The carried bin is only merged into a batch that continues it (starts in that bin or the next one). A carried bin
+# that the next batch doesn't continue - e.g. before a logger outage - is written as it is, on its own, instead of
+# with placeholder bins for the whole gap.
+#
+#   resampler = IntervalResampler('15min', state_path=site_state_path(base_path, site), key='stream_resample',
+#                                 interval='5min')
+#   bins = resampler.resample(df)     # completed bins only
+#   ...write bins...
+#   resampler.commit()                # save the carried bin once the bins are written (or resampler.commit(journal))
+
+# import modules
+import numpy as np, pandas as pd
+from HOBOlink_state import load_state, update_state
+
+class IntervalResampler:
+    """
+    Streaming resampler - see the module notes.
+
+    Parameters:
+    - freq: str, bin size, e.g. '15min'
+    - aggregations: dict of {column: 'mean', 'sum' or 'last'}. Other numeric columns use 'mean', non numeric columns are dropped
+    - state_path: path of the site's state file, or None to keep the carried bin in memory only
+    - key: str, field of the state file holding the carried bin
+    - missing: float, value treated as missing in the input and written for bins without data
+    - interval: str, Timedelta or None, the logger's logging interval, used to tell when a bin is complete. None
+      waits for a timestamp at or after the end of the bin
+    """
+    def __init__(self, freq='15min', aggregations=None, state_path=None, key='resample', missing=-9999.99, interval=None):
+        self.freq = pd.Timedelta(freq)
+        self.interval = pd.Timedelta(interval) if interval is not None else pd.Timedelta(0)
+        self.aggregations = aggregations or {}
+        self.state_path = state_path
+        self.key = key
+        self.missing = missing
+        self.state = (load_state(state_path).get(key) or {}) if state_path is not None else {}
+
+    def carrying(self):
+        # True when a partial bin from an earlier batch is waiting for more data
+        return bool(self.state.get('carry'))
+
+    def resample(self, df, time_column='timestamp_UTC'):
+        """
+        Adds a batch of rows and returns the bins completed by it.
+
+        Parameters:
+        - df: DataFrame with a time column (datetimes or 'YYYY-MM-DD HH:MM:SSZ' strings) and numeric columns
+        - time_column: str, name of the time column
+
+        Returns:
+        - DataFrame with the time column formatted as 'YYYY-MM-DD HH:MM:SSZ' and one column per aggregated column,
+          rounded to two decimals with missing values set to `missing`. Bins without data between the completed bins
+          are included. A carried bin that the batch doesn't continue is the first row, on its own. Rows at or before
+          the last timestamp of an earlier batch are ignored, so the resampler is only meant for data that moves
+          forward in time (live pulls).
+        """
+        columns = [col for col in df.columns if col != time_column and
+                   (col in self.aggregations or pd.api.types.is_numeric_dtype(df[col]))]
+        how = [self.aggregations.get(col, 'mean') for col in columns]
+
+        times = pd.to_datetime(df[time_column], utc=True).reset_index(drop=True)
+        values = pd.DataFrame(df[columns].to_numpy(dtype=float), columns=columns)
+        values = values.mask(values == self.missing)
+
+        last_seen = pd.Timestamp(self.state['last']) if self.state.get('last') else None
+        if last_seen is not None:
+            keep = (times > last_seen).to_numpy()
+            times, values = times[keep].reset_index(drop=True), values[keep].reset_index(drop=True)
+        if times.empty:
+            return pd.DataFrame(columns=[time_column] + columns)
+        order = np.argsort(times.to_numpy(), kind='mergesort')
+        times, values = times.iloc[order].reset_index(drop=True), values.iloc[order].reset_index(drop=True)
+
+        # running sums, counts and last values of each bin in the batch
+        grouped = values.groupby(times.dt.floor(self.freq).rename('bin'))
+        sums, counts, last = grouped.sum(min_count=1), grouped.count(), grouped.last()
+
+        # add the bin carried from the last batch, if this batch continues it - otherwise it is written on its own
+        carry = self.state.get('carry')
+        flushed = None
+        if carry:
+            carry_bin = pd.Timestamp(carry['bin'])
+            carried = {name: pd.Series(carry[name], dtype=float).reindex(columns) for name in ('sum', 'count', 'last')}
+            if times.iloc[0].floor(self.freq) > carry_bin + self.freq:
+                flushed = self.bins(pd.DataFrame([carried['sum']], index=[carry_bin]),
+                                    pd.DataFrame([carried['count'].fillna(0)], index=[carry_bin]),
+                                    pd.DataFrame([carried['last']], index=[carry_bin]), columns, how, time_column)
+            else:
+                if carry_bin not in sums.index:
+                    sums.loc[carry_bin], counts.loc[carry_bin], last.loc[carry_bin] = np.nan, 0, np.nan
+                    sums, counts, last = sums.sort_index(), counts.sort_index(), last.sort_index()
+                sums.loc[carry_bin] = sums.loc[carry_bin].add(carried['sum'], fill_value=0)
+                counts.loc[carry_bin] = counts.loc[carry_bin] + carried['count'].fillna(0)
+                last.loc[carry_bin] = last.loc[carry_bin].fillna(carried['last'])
+
+        # a bin is complete once the data reaches its end (see the module notes)
+        last_time = times.iloc[-1]
+        complete = sums.index + self.freq <= last_time + self.interval
+
+        # save the partial bin (at most one - every earlier bin ends before the last timestamp)
+        self.state = {'last': last_time.strftime('%Y-%m-%d %H:%M:%SZ'), 'carry': None}
+        if not complete.all():
+            partial = sums.index[~complete][0]
+            self.state['carry'] = {
+                'bin': partial.strftime('%Y-%m-%d %H:%M:%SZ'),
+                'sum': {col: None if pd.isna(value) else float(value) for col, value in sums.loc[partial].items()},
+                'count': {col: int(value) for col, value in counts.loc[partial].items()},
+                'last': {col: None if pd.isna(value) else float(value) for col, value in last.loc[partial].items()}}
+
+        sums, counts, last = sums[complete], counts[complete], last[complete]
+        result = self.bins(sums, counts, last, columns, how, time_column)
+        if flushed is not None:
+            result = pd.concat([flushed, result], ignore_index=True) if not result.empty else flushed
+        return result
+
+    def bins(self, sums, counts, last, columns, how, time_column):
+        # one row per bin between the first and last bins - bins without data are missing
+        if sums.empty:
+            return pd.DataFrame(columns=[time_column] + columns)
+        bins = pd.date_range(sums.index[0], sums.index[-1], freq=self.freq)
+        sums, counts, last = sums.reindex(bins), counts.reindex(bins, fill_value=0), last.reindex(bins)
+        result = pd.DataFrame(index=bins)
+        for col, agg in zip(columns, how):
+            if agg == 'sum':
+                result[col] = sums[col]
+            elif agg == 'last':
+                result[col] = last[col]
+            else:
+                result[col] = sums[col] / counts[col].where(counts[col] > 0)
+        result = result.round(2).fillna(self.missing)
+        result.insert(0, time_column, bins.strftime('%Y-%m-%d %H:%M:%SZ'))
+        return result.reset_index(drop=True)
+
+    def commit(self, journal=None):
+        """
+        Saves the carried bin and the last timestamp to the state file. Call it after the bins returned by resample
+        are written, so a failed write doesn't drop the rows of the next run.
+
+        Parameters:
+        - journal: Journal or None, stage the update with the batch's writes instead (see HOBOlink_journal.py)
+        """
+        if self.state_path is None:
+            return
+        if journal is not None:
+            journal.update_state(self.state_path, **{self.key: self.state})
+        else:
+            update_state(self.state_path, **{self.key: self.state})
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# Registry of the stream sensors and their units, compiled into a plan of numpy operations
+# Each sensor is reported by the logger in SI or US units (or both). The plan fills the missing unit of every sensor
+# and then computes the derived channels (e.g. the water pressure) - one vectorized operation per column, on numpy
+# arrays, with the frame built once at the end.
+#
+# The registry can be loaded from a YAML or JSON file with the same layout as DEFAULT_REGISTRY:
+#   sensors:
+#     Water Level: {si: meters, us: feet, factor: 0.3048}       # si = (us - offset) * factor
+#     Water Temperature: {si: °C, us: °F, factor: 5/9, offset: 32}
+#   derived:
+#     Water Pressure: {si: kPa, us: psi, factor: 6.89476, sum: [Barometric Pressure, Diff Pressure]}
+# Set SENSOR_REGISTRY=<file> in the .env file to use it in HOBOlink.py.
+
+# import modules
+import json, numpy as np, pandas as pd
+from pathlib import Path
+
+DEFAULT_REGISTRY = {
+    'sensors': {
+        'Diff Pressure': {'si': 'kPa', 'us': 'psi', 'factor': 6.89476},
+        'Barometric Pressure': {'si': 'kPa', 'us': 'psi', 'factor': 6.89476},
+        'Water Level': {'si': 'meters', 'us': 'feet', 'factor': 0.3048},
+        'Water Temperature': {'si': '°C', 'us': '°F', 'factor': '5/9', 'offset': 32},
+    },
+    'derived': {
+        # calculated in the unit system that both parts were reported in
+        'Water Pressure': {'si': 'kPa', 'us': 'psi', 'factor': 6.89476, 'sum': ['Barometric Pressure', 'Diff Pressure']},
+    },
+}
+
+def parse_factor(factor):
+    """
+    Returns a conversion factor as (numerator, denominator). Factors can be numbers or fractions such as '5/9' - a
+    fraction is applied as `* 5 / 9`, which keeps the results identical to the hand written conversions.
+    """
+    if isinstance(factor, str) and '/' in factor:
+        numerator, denominator = factor.split('/')
+        return float(numerator), float(denominator)
+    return float(factor), 1.0
+
+class SensorPlan:
+    """
+    Compiled sensor registry - see compile_registry.
+
+    Attributes:
+    - fills: list of (si column, us column, numerator, denominator, offset)
+    - derived: list of (si column, us column, numerator, denominator, offset, [si parts], [us parts])
+    - si_units, us_units: sets of units, passed to decode_observations
+    """
+    def __init__(self, fills, derived, si_units, us_units):
+        self.fills = fills
+        self.derived = derived
+        self.si_units = si_units
+        self.us_units = us_units
+
+    def apply(self, df):
+        """
+        Fills the missing SI/US values of every sensor and adds the derived columns.
+
+        Parameters:
+        - df: DataFrame from decode_observations, with a "timestamp" column and "{sensor} si"/"{sensor} us" columns
+
+        Returns:
+        - DataFrame with the same rows, the filled columns and the derived columns added after the existing ones
+        """
+        columns = {name: df[name].to_numpy(dtype=float) for name in df.columns if name != 'timestamp'}
+
+        for si_col, us_col, numerator, denominator, offset in self.fills:
+            si, us = columns.get(si_col), columns.get(us_col)
+            if si is not None and us is not None:
+                si_missing, us_missing = np.isnan(si), np.isnan(us)
+                columns[si_col] = np.where(si_missing & ~us_missing, (us - offset) * numerator / denominator, si)
+                columns[us_col] = np.where(us_missing & ~si_missing, si * denominator / numerator + offset, us)
+            elif us is not None:
+                columns[si_col] = (us - offset) * numerator / denominator
+            elif si is not None:
+                columns[us_col] = si * denominator / numerator + offset
+
+        for si_col, us_col, numerator, denominator, offset, si_parts, us_parts in self.derived:
+            if all(part in columns for part in si_parts):
+                total = columns[si_parts[0]]
+                for part in si_parts[1:]:
+                    total = total + columns[part]
+                columns[si_col] = total
+                columns[us_col] = total * denominator / numerator + offset
+            elif all(part in columns for part in us_parts):
+                total = columns[us_parts[0]]
+                for part in us_parts[1:]:
+                    total = total + columns[part]
+                columns[us_col] = total
+                columns[si_col] = (total - offset) * numerator / denominator
+
+        frame = pd.DataFrame(columns, index=df.index)
+        if 'timestamp' in df.columns:
+            frame.insert(0, 'timestamp', df['timestamp'])
+        return frame
+
+def compile_registry(registry):
+    """
+    Compiles a sensor registry (see DEFAULT_REGISTRY) into a SensorPlan.
+    """
+    fills, derived, si_units, us_units = [], [], set(), set()
+    for sensor, spec in registry.get('sensors', {}).items():
+        numerator, denominator = parse_factor(spec['factor'])
+        fills.append((f"{sensor} si", f"{sensor} us", numerator, denominator, float(spec.get('offset', 0))))
+        si_units.add(spec['si'])
+        us_units.add(spec['us'])
+    for sensor, spec in registry.get('derived', {}).items():
+        numerator, denominator = parse_factor(spec['factor'])
+        derived.append((f"{sensor} si", f"{sensor} us", numerator, denominator, float(spec.get('offset', 0)),
+                        [f"{part} si" for part in spec['sum']], [f"{part} us" for part in spec['sum']]))
+    return SensorPlan(fills, derived, si_units, us_units)
+
+def load_registry(path):
+    """
+    Loads a sensor registry from a YAML (.yml/.yaml) or JSON file.
+    """
+    path = Path(path)
+    with open(path, encoding='utf-8') as file:
+        if path.suffix.lower() in ('.yml', '.yaml'):
+            import yaml
+            return yaml.safe_load(file)
+        return json.load(file)
+
+# Plan used by the stream parser
+stream_plan = compile_registry(DEFAULT_REGISTRY)
+
+def use_registry(path):
+    """
+    Replaces the plan used by the stream parser with the registry in a file.
+    """
+    global stream_plan
+    stream_plan = compile_registry(load_registry(path))
+    return stream_plan
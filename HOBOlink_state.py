@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Adolfo Lopez Miranda
+
+# import modules
+import os, json, tempfile
+from datetime import datetime
+from pathlib import Path
+
+# Functions to keep a small JSON state file next to each site's data
+# The state file lets the scripts pick up where the last run stopped without reading the MasterTables
+
+def site_state_path(base_path, site_name):
+    """
+    Returns the path of the state file for a site: {base_path}/{site_name}/{site_name}_state.json
+    """
+    return Path(base_path if base_path else './') / site_name / f"{site_name}_state.json"
+
+def load_state(state_path):
+    """
+    Reads a site state file. Returns an empty dict if the file does not exist or can't be read.
+    """
+    try:
+        with open(state_path, 'r') as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+def save_state(state_path, state):
+    """
+    Writes the state dict to the state file. The file is written to a temporary file first and then renamed,
+    so a run that is killed partway through never leaves a half written state file behind.
+    """
+    state_path = Path(state_path)
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_path.parent, prefix=state_path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(state, file, indent=2, sort_keys=True)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, state_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.chmod(state_path, 0o664)
+
+def update_state(state_path, **fields):
+    """
+    Updates the given fields of a state file and returns the new state.
+    """
+    state = load_state(state_path)
+    state.update(fields)
+    save_state(state_path, state)
+    return state
+
+def commit_timestamp(state_path, timestamp, key='last_timestamp'):
+    """
+    Records the last timestamp written to a site's MasterTable. The stored timestamp only moves forward, so
+    backfilling older data does not move the resume point back.
+
+    Parameters:
+    - state_path: path of the site's state file
+    - timestamp: str, timestamp formatted as 'YYYY-MM-DD HH:MM:SSZ'
+    - key: str, name of the field in the state file
+    """
+    utc_format = '%Y-%m-%d %H:%M:%S%z'
+    state = load_state(state_path)
+    current = state.get(key)
+    if current is not None:
+        try:
+            if datetime.strptime(current, utc_format) >= datetime.strptime(timestamp, utc_format):
+                return state
+        except ValueError:
+            pass
+    state[key] = timestamp
+    save_state(state_path, state)
+    return state
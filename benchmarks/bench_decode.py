@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# CW3E Field Team
+# Benchmark for decoding the API observation list into the wide sensor DataFrame
+#
+# Usage: python benchmarks/bench_decode.py [n_obs ...]
+
+# import modules
+import sys, time, pandas as pd
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from HOBOlink_parse import decode_observations, SI_UNITS, US_UNITS
+from synthetic import make_observations
+
+def legacy_decode(observation_list):
+    # Row by row decoder that parse_stream used before decode_observations
+    rows = []
+    for obs in observation_list:
+        unit = obs["unit"]
+        sensor_type = obs["sensor_measurement_type"]
+        if unit in SI_UNITS:
+            key = f"{sensor_type} si"
+        elif unit in US_UNITS:
+            key = f"{sensor_type} us"
+        else:
+            key = sensor_type
+        rows.append({"timestamp": obs["timestamp"], key: obs["value"]})
+    df = pd.DataFrame(rows)
+    df = df.groupby("timestamp", as_index=False).first()
+    for col in df.columns:
+        try:
+            df[col] = pd.to_numeric(df[col])
+        except Exception:
+            pass
+    return df
+
+def best_time(func, arg, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main(sizes):
+    print(f"{'observations':>12} {'legacy rows/s':>15} {'vectorized rows/s':>18} {'speedup':>8}")
+    for n_obs in sizes:
+        observations = make_observations(n_obs)
+
+        # both decoders must produce the same frame
+        expected = legacy_decode(observations)
+        result = decode_observations(observations)
+        pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+
+        legacy = best_time(legacy_decode, observations)
+        vectorized = best_time(decode_observations, observations)
+        print(f"{n_obs:>12} {n_obs / legacy:>15,.0f} {n_obs / vectorized:>18,.0f} {legacy / vectorized:>7.1f}x")
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000])
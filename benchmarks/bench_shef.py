@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# CW3E Field Team
+# Benchmark for SHEF output - row by row writer vs the batched write_shef
+#
+# Usage: python benchmarks/bench_shef.py [days]
+
+# import modules
+import sys, os, time, shutil, tempfile, numpy as np, pandas as pd
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from HOBOlink_parse import write_shef, format_shef_value
+
+def make_frame(days):
+    # 15 minute processed data in Pacific time, like parse_stream builds before writing SHEF files
+    rng = np.random.default_rng(0)
+    n_rows = days * 96
+    timestamps = pd.date_range('2024-01-01', periods=n_rows, freq='15min', tz='UTC').tz_convert('US/Pacific')
+    return pd.DataFrame({
+        'timestamp_UTC': timestamps,
+        'water_level_ft': np.round(2 + rng.standard_normal(n_rows), 2),
+        'discharge_cfs': np.where(rng.random(n_rows) < 0.1, -9999.99, np.round(100 + 10 * rng.standard_normal(n_rows), 2)),
+        'water_temperature_F': np.round(55 + 5 * rng.standard_normal(n_rows), 2),
+        'barometric_pressure_psi': np.round(14.3 + 0.1 * rng.standard_normal(n_rows), 2),
+        'battery_V': np.round(12.8 + 0.1 * rng.standard_normal(n_rows), 2),
+    })
+
+def legacy_write_shef(df2, site_name, cdec, base_path, rating_curve_exists, single_file_name):
+    # Row by row writer that parse_stream used before write_shef
+    grouped = df2.groupby([df2['timestamp_UTC'].dt.year,
+                        df2['timestamp_UTC'].dt.month.apply(lambda x: f'{x:02d}'),
+                        df2['timestamp_UTC'].dt.day.apply(lambda x: f'{x:02d}'),
+                        df2['timestamp_UTC'].dt.hour.apply(lambda x: f'{x:02d}')])
+    def write_rows(rows, shef_file_path, permissions):
+        file_mode = 'a' if shef_file_path.exists() else 'w'
+        with shef_file_path.open(mode=file_mode) as file:
+            for _, row in rows.iterrows():
+                timestamp_shef = row['timestamp_UTC'].strftime('%Y%m%d%H%M')
+                data_line = f".A {cdec} {timestamp_shef[:8]} P DH{timestamp_shef[8:]} /HGI {format_shef_value(row['water_level_ft'])}"
+                if rating_curve_exists:
+                    data_line = data_line + f"/QRI {format_shef_value(row['discharge_cfs'])}"
+                data_line = data_line + f"/TWI {format_shef_value(row['water_temperature_F'])}"
+                data_line = data_line + f"/PAI {format_shef_value(row['barometric_pressure_psi']*2.03602)}"
+                data_line = data_line + f"/VBI {format_shef_value(row['battery_V'])}"
+                file.write(data_line + '\n')
+                os.chmod(shef_file_path, permissions)
+    for (year, month, day, hour), group in grouped:
+        shef_path = Path(base_path) / site_name / 'SHEF_Output' / str(year) / str(month) / str(day)
+        shef_path.mkdir(parents=True, exist_ok=True)
+        write_rows(group, shef_path / f"{cdec}_Streamflow_SHEF_{year}{month}{day}{hour}.txt", 0o664)
+    shef_path = Path(base_path) / site_name / 'SHEF_Output'
+    write_rows(df2, shef_path / single_file_name, 0o775)
+
+def timed(func, df, out_dir):
+    start = time.perf_counter()
+    func(df, 'TST', 'TST', out_dir, True, 'TST_Streamflow_SHEF_latest.txt')
+    return time.perf_counter() - start
+
+def main(days):
+    df = make_frame(days)
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        legacy = timed(legacy_write_shef, df, tmp / 'legacy')
+        batched = timed(write_shef, df, tmp / 'batched')
+
+        # both writers must produce the same files
+        for legacy_file in (tmp / 'legacy').rglob('*.txt'):
+            batched_file = tmp / 'batched' / legacy_file.relative_to(tmp / 'legacy')
+            assert legacy_file.read_text() == batched_file.read_text(), legacy_file
+        n_files = sum(1 for _ in (tmp / 'batched').rglob('*.txt'))
+    finally:
+        shutil.rmtree(tmp)
+
+    print(f"{len(df)} rows, {n_files} SHEF files")
+    print(f"row by row: {legacy:.3f} s ({len(df) / legacy:,.0f} rows/s)")
+    print(f"batched:    {batched:.3f} s ({len(df) / batched:,.0f} rows/s)")
+    print(f"speedup:    {legacy / batched:.1f}x")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 31)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# CW3E Field Team
+# Load test for HOBOlink.py against the local mock API (benchmarks/mock_api.py)
+# Builds a metadata csv with synthetic stream sites, runs HOBOlink.py end to end in a temporary directory and
+# reports sites per minute, requests per second and the number of throttled (509) requests.
+#
+# Usage: python benchmarks/load_test.py [--sites 20] [--days 30] [--workers 4] [--rps 10] [--server-rate 0]
+
+# import modules
+import os, sys, json, time, shutil, argparse, tempfile, subprocess, urllib.request, pandas as pd
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from mock_api import start_server
+
+def write_metadata(path, n_sites, days):
+    # stream sites that have not been pulled yet - every site starts `days` days ago
+    start = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%SZ')
+    pd.DataFrame({
+        'site_ID': [f"T{index:03d}" for index in range(n_sites)],
+        'CDEC_ID': [''] * n_sites,
+        'logger_SN': [30000000 + index for index in range(n_sites)],
+        'logging_int': [15] * n_sites,
+        'start_time': [start] * n_sites,
+    }).to_csv(path, index=False)
+
+def run(n_sites, days, workers, rps, server_rate, latency, max_points, keep=False):
+    """
+    Runs HOBOlink.py once against a fresh mock server and returns the measurements as a dict.
+    """
+    server = start_server(latency=latency, rate=server_rate, burst=max(1, int(server_rate)), max_points=max_points)
+    work_dir = Path(tempfile.mkdtemp(prefix='hobolink_load_'))
+    try:
+        write_metadata(work_dir / 'Streams_Metadata.csv', n_sites, days)
+        env = dict(os.environ, TOKEN='load-test', HOBOLINK_API_URL=server.url, HOBOLINK_BASE_DIR=str(work_dir / 'data'),
+                   MAX_WORKERS=str(workers), MAX_REQUESTS_PER_SECOND=str(rps), PYTHONPATH=str(REPO))
+        env.pop('RESPONSE_CACHE_DIR', None)
+
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, str(REPO / 'HOBOlink.py')], cwd=work_dir, env=env,
+                                capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr[-2000:])
+
+        with urllib.request.urlopen(server.url.replace('/v1/data', '/stats')) as response:
+            stats = json.load(response)
+        rows = sum(sum(1 for _ in open(path)) - 1 for path in (work_dir / 'data').glob('*/Raw/*_MasterTable_Raw.csv'))
+        return {
+            'sites': n_sites, 'days': days, 'workers': workers, 'client_rps': rps, 'server_rate': server_rate,
+            'latency_s': latency, 'seconds': round(elapsed, 2),
+            'sites_per_minute': round(n_sites / elapsed * 60, 1),
+            'requests_per_second': round(stats['requests'] / elapsed, 2),
+            'requests': stats['requests'], 'throttled': stats['throttled'], 'truncated': stats['truncated'],
+            'points': stats['points'], 'rows_written': rows,
+        }
+    finally:
+        server.shutdown()
+        if keep:
+            print(f"Output kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End to end load test of HOBOlink.py against the mock API')
+    parser.add_argument('--sites', type=int, default=20)
+    parser.add_argument('--days', type=int, default=30, help='days of data pulled for each site')
+    parser.add_argument('--workers', type=int, default=4, help='MAX_WORKERS passed to HOBOlink.py')
+    parser.add_argument('--rps', type=float, default=10, help='MAX_REQUESTS_PER_SECOND passed to HOBOlink.py (0 = no limit)')
+    parser.add_argument('--server-rate', type=float, default=0, help='requests per second before the mock returns 509 (0 = off)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every mock response')
+    parser.add_argument('--max-points', type=int, default=100000,
+                        help='mock truncation limit - HOBOlink.py plans for 100,000, so lower values show the cost of silent truncation')
+    parser.add_argument('--keep', action='store_true', help='keep the output directory')
+    args = parser.parse_args()
+
+    results = run(args.sites, args.days, args.workers, args.rps, args.server_rate, args.latency, args.max_points, args.keep)
+    for key, value in results.items():
+        print(f"{key:>20}: {value}")
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# CW3E Field Team
+# Local stand-in for the HOBOlink "Get Data Endpoint" (https://api.hobolink.licor.cloud/v1/data)
+# Serves synthetic stream and precip observations in the v1 response schema, with configurable latency,
+# 509 throttling and truncation at the 100,000 point limit.
+#
+# Usage: python benchmarks/mock_api.py [--port 8089] [--latency 0.05] [--rate 5] [--precip-loggers 2100,2101]
+# Point the pull scripts at it with HOBOLINK_API_URL=http://127.0.0.1:8089/v1/data
+
+# import modules
+import sys, json, time, zlib, random, argparse, threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from HOBOlink_client import MAX_POINTS
+from synthetic import make_observations, STREAM_SENSORS, PRECIP_SENSORS, MET_SENSORS
+
+class MockHOBOlink(ThreadingHTTPServer):
+    """
+    Threaded HTTP server that answers GET /v1/data like the HOBOlink API and GET /stats with its request counters.
+
+    Parameters:
+    - address: (host, port), use port 0 to pick a free port
+    - latency: float, seconds added to every response
+    - jitter: float, random extra latency of up to this many seconds
+    - rate: float, requests per second allowed before 509 is returned (0 turns throttling off)
+    - burst: int, requests allowed at once before throttling
+    - max_points: int, responses are truncated to this many observations
+    - precip_loggers: set of logger serial numbers that report tipping bucket data every 2 minutes. The others are
+      stream gauges logging every 15 minutes
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, rate=0.0, burst=1, max_points=MAX_POINTS, precip_loggers=()):
+        super().__init__(address, MockHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.max_points = max_points
+        self.precip_loggers = {str(logger) for logger in precip_loggers}
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'throttled': 0, 'truncated': 0, 'points': 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/data"
+
+    def count(self, **fields):
+        with self.lock:
+            for key, value in fields.items():
+                self.stats[key] += value
+
+    def throttled(self):
+        # same token bucket as the client, but without waiting - a request without a token gets a 509
+        if self.rate <= 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.burst), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return False
+            return True
+
+    def observations(self, logger, start_dt, end_dt):
+        # one observation per sensor per logging interval between start and end, never past the current time
+        precip = logger in self.precip_loggers
+        sensors, interval = (PRECIP_SENSORS + MET_SENSORS, 2) if precip else (STREAM_SENSORS, 15)
+        end_dt = min(end_dt, datetime.now(timezone.utc))
+        step = timedelta(minutes=interval)
+        first = start_dt + (-(start_dt - datetime(2000, 1, 1, tzinfo=timezone.utc)) % step)
+        if first > end_dt:
+            return []
+        n_times = (end_dt - first) // step + 1
+        # cap the number of rows generated - the response is truncated to max_points anyway
+        n_times = min(n_times, self.max_points // len(sensors) + 1)
+        # the same logger and time always gets the same values
+        seed = zlib.crc32(f"{logger}{first.isoformat()}".encode())
+        return make_observations(n_times * len(sensors), sensors, first, interval, logger, seed)
+
+class MockHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def error(self, status, error, message, headers=None):
+        self.send_json(status, {'error': error, 'message': message, 'error_description': message}, headers)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            with server.lock:
+                return self.send_json(200, dict(server.stats))
+        if url.path != '/v1/data':
+            return self.error(404, 'not_found', f'Unknown path {url.path}')
+
+        server.count(requests=1)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.error(401, 'unauthorized', 'Missing bearer token')
+        if server.throttled():
+            server.count(throttled=1)
+            return self.error(509, 'rate_limit_exceeded', 'Too many requests', {'Retry-After': '1'})
+
+        query = parse_qs(url.query)
+        try:
+            logger = query['loggers'][0]
+            start_dt = datetime.strptime(query['start_date_time'][0], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+            end_dt = datetime.strptime(query['end_date_time'][0], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        except (KeyError, ValueError):
+            return self.error(400, 'invalid_request', 'loggers, start_date_time and end_date_time are required')
+
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+        data = server.observations(logger, start_dt, end_dt)
+        if len(data) > server.max_points:
+            data = data[:server.max_points]
+            server.count(truncated=1)
+        server.count(points=len(data))
+        self.send_json(200, {'data': data})
+
+def start_server(port=0, **kwargs):
+    """
+    Starts a MockHOBOlink server on a background thread and returns it. Call server.shutdown() to stop it.
+    """
+    server = MockHOBOlink(('127.0.0.1', port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local mock of the HOBOlink v1 data endpoint')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency in seconds')
+    parser.add_argument('--rate', type=float, default=0.0, help='requests per second before 509 is returned (0 = off)')
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument('--max-points', type=int, default=MAX_POINTS)
+    parser.add_argument('--precip-loggers', default='', help='comma separated logger serial numbers with precip data')
+    args = parser.parse_args()
+
+    server = MockHOBOlink(('127.0.0.1', args.port), latency=args.latency, jitter=args.jitter, rate=args.rate,
+                          burst=args.burst, max_points=args.max_points,
+                          precip_loggers=[logger for logger in args.precip_loggers.split(',') if logger])
+    print(f"Mock HOBOlink API on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# CW3E Field Team
+# Benchmark suite for the hot paths in HOBOlink_parse.py, run on synthetic data
+# Each case is timed (best of --repeat runs) and run once more under tracemalloc for its peak memory.
+#
+# Usage:
+#   python benchmarks/run_benchmarks.py run [--output results.json] [--repeat 3] [--filter parse] [--quick]
+#   python benchmarks/run_benchmarks.py compare base.json new.json [--threshold 0.10]
+# compare exits with status 1 when a case got slower (or used more memory) by more than the threshold.
+
+# import modules
+import os, sys, io, json, time, shutil, argparse, platform, tempfile, tracemalloc, subprocess, contextlib
+import numpy as np, pandas as pd
+from datetime import datetime, timezone
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import HOBOlink_parse
+from HOBOlink_parse import (parse_stream, calculate_discharge, RatingCurve, shef_lines, write_shef, csv_timestamp,
+                            scan_last_timestamp, find_nan_optimized, find_gaps, backfill_stream)
+from synthetic import make_response, make_raw_table
+
+class Case:
+    """
+    One benchmark case.
+
+    Parameters:
+    - name: str, name used in the results file
+    - func: callable run by the benchmark - receives the value returned by setup
+    - items: int, number of items processed per call (observations, rows, ...) used for the throughput
+    - unit: str, name of the items
+    - setup: callable or None, called before every run (not timed)
+    """
+    def __init__(self, name, func, items, unit, setup=None):
+        self.name = name
+        self.func = func
+        self.items = items
+        self.unit = unit
+        self.setup = setup or (lambda: None)
+
+def rating_curve_frame():
+    levels = np.linspace(0.2, 4.0, 100)
+    return pd.DataFrame({'Level.ft': levels, 'discharge.cfs': np.round(25 * levels ** 1.8, 3)})
+
+def fresh_dir(root):
+    # empty output directory for cases that write files
+    def setup():
+        path = Path(tempfile.mkdtemp(dir=root))
+        # the shared daily writer remembers directories, forget them between runs
+        HOBOlink_parse.daily_writer.created_dirs.clear()
+        HOBOlink_parse.daily_writer.existing_files.clear()
+        return path
+    return setup
+
+def build_cases(root, quick=False):
+    """
+    Builds the benchmark cases. Large inputs are generated once into root.
+    """
+    big_rows = 100000 if quick else 1000000
+    cases = []
+
+    # parse_stream - decode, unit conversion, discharge, MasterTable and daily file writes
+    for n_obs in (1000, 10000, 100000):
+        response = make_response(n_obs)
+        cases.append(Case(f'parse_stream_{n_obs // 1000}k', lambda path, response=response: parse_stream(response, 'BEN', None, base_path=path),
+                          n_obs, 'observations', fresh_dir(root)))
+
+    # parse_stream with a rating curve and SHEF output
+    response = make_response(10000)
+    def shef_setup():
+        path = fresh_dir(root)()
+        (path / 'BEN' / 'Rating_Curve').mkdir(parents=True)
+        rating_curve_frame().to_csv(path / 'BEN' / 'Rating_Curve' / 'BEN.rating_curve_100_points.csv', index=False)
+        return path
+    cases.append(Case('parse_stream_10k_shef', lambda path: parse_stream(response, 'BEN', 'BNC', base_path=path, shef_toggle=True),
+                      10000, 'observations', shef_setup))
+
+    # discharge - the scalar calculate_discharge in a loop, and the vectorized RatingCurve
+    curve = rating_curve_frame()
+    stages = np.random.default_rng(0).uniform(0, 4.5, big_rows)
+    small_stages = stages[:10000]
+    cases.append(Case('calculate_discharge_10k', lambda _: [calculate_discharge(stage, curve) for stage in small_stages],
+                      len(small_stages), 'stages'))
+    rating_curve = RatingCurve(curve['Level.ft'], curve['discharge.cfs'])
+    cases.append(Case(f'rating_curve_discharge_{big_rows // 1000}k', lambda _: rating_curve.discharge(stages),
+                      big_rows, 'stages'))
+
+    # SHEF - formatting and writing 30 days of 15 minute data
+    n_rows = 30 * 96
+    rng = np.random.default_rng(0)
+    shef_frame = pd.DataFrame({
+        'timestamp_UTC': pd.date_range('2024-01-01', periods=n_rows, freq='15min', tz='UTC').tz_convert('US/Pacific'),
+        'water_level_ft': np.round(2 + rng.standard_normal(n_rows), 2),
+        'discharge_cfs': np.round(100 + 10 * rng.standard_normal(n_rows), 2),
+        'water_temperature_F': np.round(55 + 5 * rng.standard_normal(n_rows), 2),
+        'barometric_pressure_psi': np.round(14.3 + 0.1 * rng.standard_normal(n_rows), 2),
+        'battery_V': np.round(12.8 + 0.1 * rng.standard_normal(n_rows), 2),
+    })
+    cases.append(Case('shef_lines_30d', lambda _: shef_lines(shef_frame, 'BNC', True), n_rows, 'rows'))
+    cases.append(Case('write_shef_30d', lambda path: write_shef(shef_frame, 'BEN', 'BNC', path, True, 'BNC_latest.txt'),
+                      n_rows, 'rows', fresh_dir(root)))
+
+    # Large MasterTable reads
+    big_table = root / f'BEN_MasterTable_Raw_{big_rows}.csv'
+    make_raw_table(big_rows).to_csv(big_table, index=False, quoting=1)
+    cases.append(Case(f'csv_timestamp_{big_rows // 1000}k', lambda _: csv_timestamp(big_table, 15), big_rows, 'rows'))
+    cases.append(Case(f'scan_last_timestamp_{big_rows // 1000}k', lambda _: scan_last_timestamp(big_table), big_rows, 'rows'))
+    cases.append(Case(f'find_nan_optimized_{big_rows // 1000}k', lambda _: find_nan_optimized(big_table), big_rows, 'rows'))
+    cases.append(Case(f'find_gaps_{big_rows // 1000}k', lambda _: find_gaps(big_table, 15), big_rows, 'rows'))
+
+    # backfill_stream - upsert 10k observations into a 100k row Raw MasterTable and its daily files
+    backfill_response = make_response(10000, start=datetime(2016, 6, 1, tzinfo=timezone.utc))
+    site_table = root / 'BEN_MasterTable_Raw_100k.csv'
+    make_raw_table(100000).to_csv(site_table, index=False, quoting=1)
+    def backfill_setup():
+        path = fresh_dir(root)()
+        (path / 'BEN' / 'Raw').mkdir(parents=True)
+        shutil.copy(site_table, path / 'BEN' / 'Raw' / 'BEN_MasterTable_Raw.csv')
+        return path
+    cases.append(Case('backfill_stream_10k', lambda path: backfill_stream(backfill_response, 'BEN', base_path=path),
+                      10000, 'observations', backfill_setup))
+
+    # parse_stream on 5 minute data - ten batches resampled to 15 minutes, the partial bin carried between batches
+    irregular = make_response(100000, interval_minutes=5)['data']
+    batches = [{'data': irregular[i:i + 10000]} for i in range(0, len(irregular), 10000)]
+    cases.append(Case('parse_stream_5min_10x10k', lambda path: [parse_stream(batch, 'BEN', None, base_path=path, carry_bins=True, logging_interval_minutes=5) for batch in batches],
+                      len(irregular), 'observations', fresh_dir(root)))
+
+    # import time - a fresh interpreter importing each entry point, as a cron job or container start would
+    for module in ('HOBOlink_cli', 'HOBOlink_client', 'HOBOlink_parse'):
+        cases.append(Case(f'import_{module}', lambda _, module=module: import_module(module), 1, 'imports'))
+    return cases
+
+def import_module(module):
+    subprocess.run([sys.executable, '-c', f'import {module}'], cwd=REPO, check=True)
+
+def measure(case, repeat):
+    """
+    Returns the best time of `repeat` runs and the peak traced memory of one more run.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            arg = case.setup()
+            start = time.perf_counter()
+            case.func(arg)
+            times.append(time.perf_counter() - start)
+
+        arg = case.setup()
+        tracemalloc.start()
+        try:
+            case.func(arg)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    best = min(times)
+    return {'seconds': round(best, 6), 'median_seconds': round(float(np.median(times)), 6), 'items': case.items,
+            'unit': case.unit, 'items_per_second': round(case.items / best, 1), 'peak_mb': round(peak / 1024 ** 2, 3)}
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%SZ'), 'commit': commit,
+            'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+def run(output, repeat, name_filter=None, quick=False):
+    root = Path(tempfile.mkdtemp(prefix='hobolink_bench_'))
+    results = {}
+    try:
+        for case in build_cases(root, quick):
+            if name_filter and name_filter not in case.name:
+                continue
+            results[case.name] = measure(case, repeat)
+            result = results[case.name]
+            print(f"{case.name:<28} {result['seconds'] * 1000:>10.1f} ms {result['items_per_second']:>14,.0f} {case.unit}/s "
+                  f"{result['peak_mb']:>9.1f} MB peak")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({'metadata': metadata(), 'repeat': repeat, 'quick': quick, 'results': results}, file, indent=2)
+        print(f"Results written to {output}")
+    return results
+
+def compare(base_file, new_file, threshold):
+    """
+    Compares two results files. Returns the list of cases that regressed by more than the threshold.
+    """
+    with open(base_file) as file:
+        base = json.load(file)['results']
+    with open(new_file) as file:
+        new = json.load(file)['results']
+
+    regressions = []
+    print(f"{'case':<28} {'base ms':>10} {'new ms':>10} {'time':>8} {'base MB':>9} {'new MB':>9} {'memory':>8}")
+    for name in sorted(set(base) & set(new)):
+        old_result, new_result = base[name], new[name]
+        time_change = new_result['seconds'] / old_result['seconds'] - 1
+        memory_change = (new_result['peak_mb'] / old_result['peak_mb'] - 1) if old_result['peak_mb'] else 0.0
+        flags = []
+        if time_change > threshold:
+            flags.append('SLOWER')
+        if memory_change > threshold:
+            flags.append('MORE MEMORY')
+        if flags:
+            regressions.append(name)
+        print(f"{name:<28} {old_result['seconds'] * 1000:>10.1f} {new_result['seconds'] * 1000:>10.1f} {time_change:>+8.1%} "
+              f"{old_result['peak_mb']:>9.1f} {new_result['peak_mb']:>9.1f} {memory_change:>+8.1%} {' '.join(flags)}")
+    for name in sorted(set(base) ^ set(new)):
+        print(f"{name:<28} only in {'base' if name in base else 'new'}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for HOBOlink_parse.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--output', help='write the results to this JSON file')
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--filter', help='only run cases whose name contains this text')
+    run_parser.add_argument('--quick', action='store_true', help='100k row tables instead of 1M')
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.10, help='allowed slowdown, 0.10 = 10%%')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args.output, args.repeat, args.filter, args.quick)
+    else:
+        regressions = compare(args.base, args.new, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
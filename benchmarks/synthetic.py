@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# CW3E Field Team
+# Synthetic HOBOlink API responses used by the benchmarks
+
+# import modules
+import numpy as np
+from datetime import datetime, timedelta, timezone
+
+# Sensors reported by a stream gauge RX3000 - (sensor_measurement_type, unit, typical value, spread)
+STREAM_SENSORS = [
+    ("Diff Pressure", "kPa", 5.0, 2.0),
+    ("Barometric Pressure", "kPa", 98.0, 1.0),
+    ("Water Level", "meters", 0.6, 0.3),
+    ("Water Temperature", "°C", 12.0, 4.0),
+    ("Battery", "V", 12.8, 0.2),
+]
+
+# Sensors reported by a PrecipMet RX3000
+PRECIP_SENSORS = [
+    ("Precipitation", "mm", 0.0, 0.0),
+    ("Battery", "V", 12.8, 0.2),
+]
+
+# Met channels reported next to the tipping bucket by a PrecipMet RX3000
+MET_SENSORS = [
+    ("Temperature", "°C", 8.0, 5.0),
+    ("RH", "%", 70.0, 15.0),
+    ("Wind Speed", "m/s", 3.0, 1.5),
+    ("Gust Speed", "m/s", 6.0, 2.5),
+    ("Wind Direction", "°", 180.0, 90.0),
+    ("Solar Radiation", "W/m²", 250.0, 150.0),
+]
+
+def make_observations(n_obs, sensors=STREAM_SENSORS, start=None, interval_minutes=15, logger_sn="00000000", seed=0):
+    """
+    Builds a list of observations in the v1 "Get Data Endpoint" schema.
+
+    Parameters:
+    - n_obs: int, number of observations (one per sensor per timestamp)
+    - sensors: list of (sensor_measurement_type, unit, mean, spread) tuples
+    - start: datetime, first timestamp (UTC). Defaults to 2024-01-01 00:00:00Z
+    - interval_minutes: int, logging interval
+    - logger_sn: str, logger serial number written into each observation
+    - seed: int, seed for the random values
+    """
+    rng = np.random.default_rng(seed)
+    start = start or datetime(2024, 1, 1, tzinfo=timezone.utc)
+    n_times = -(-n_obs // len(sensors))
+    times = [(start + timedelta(minutes=interval_minutes * i)).strftime('%Y-%m-%d %H:%M:%SZ') for i in range(n_times)]
+
+    observations = []
+    for sensor_index, (sensor, unit, mean, spread) in enumerate(sensors):
+        if sensor == "Precipitation":
+            # tipping bucket - mostly zeros with the odd 0.2 mm tip
+            values = np.where(rng.random(n_times) < 0.05, 0.2, 0.0)
+        else:
+            values = np.round(mean + spread * rng.standard_normal(n_times), 3)
+        for timestamp, value in zip(times, values.tolist()):
+            observations.append({
+                "logger_sn": logger_sn,
+                "sensor_sn": f"{logger_sn}-{sensor_index + 1}",
+                "timestamp": timestamp,
+                "data_type_id": "1",
+                "data_type": "CURRENT",
+                "sensor_measurement_type": sensor,
+                "value": value,
+                "unit": unit,
+            })
+    # the API returns the observations ordered by time
+    observations.sort(key=lambda obs: obs["timestamp"])
+    return observations[:n_obs]
+
+def make_response(n_obs, **kwargs):
+    """
+    Builds a full API response dict ({"data": [...]}) - see make_observations for the arguments.
+    """
+    return {"data": make_observations(n_obs, **kwargs)}
+
+def make_raw_table(n_rows, start=None, interval_minutes=15, seed=0, sentinel_rate=0.001):
+    """
+    Builds a Raw MasterTable DataFrame with n_rows rows ('timestamp_UTC' formatted as 'YYYY-MM-DD HH:MM:SSZ').
+    A small share of the rows hold -9999.99 or NaN, like real tables with gaps.
+    """
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    start = start or datetime(2015, 1, 1, tzinfo=timezone.utc)
+    timestamps = pd.date_range(start, periods=n_rows, freq=f"{interval_minutes}min").strftime('%Y-%m-%d %H:%M:%SZ')
+    columns = {
+        'water_pressure_psi': (14.9, 0.3), 'barometric_pressure_psi': (14.2, 0.1), 'diff_pressure_psi': (0.7, 0.3),
+        'water_level_ft': (1.6, 0.8), 'water_temperature_F': (54.0, 7.0), 'water_pressure_kPa': (103.0, 2.0),
+        'barometric_pressure_kPa': (98.0, 1.0), 'diff_pressure_kPa': (5.0, 2.0), 'water_level_m': (0.5, 0.25),
+        'water_temperature_C': (12.0, 4.0),
+    }
+    table = pd.DataFrame({'timestamp_UTC': timestamps})
+    for name, (mean, spread) in columns.items():
+        table[name] = np.round(mean + spread * rng.standard_normal(n_rows), 2)
+    missing = rng.random(n_rows) < sentinel_rate
+    table.loc[missing, 'water_level_ft'] = -9999.99
+    table.loc[rng.random(n_rows) < sentinel_rate / 2, 'water_temperature_C'] = np.nan
+    return table
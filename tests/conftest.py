@@ -0,0 +1,35 @@
+# Shared helpers for the tests - API responses in the v1 "Get Data Endpoint" schema
+
+import pytest
+import pandas as pd
+
+# (sensor_measurement_type, unit, value) reported by a stream gauge RX3000
+STREAM_SENSORS = [
+    ("Diff Pressure", "kPa", 5.0),
+    ("Barometric Pressure", "kPa", 98.0),
+    ("Water Level", "meters", 0.5),
+    ("Water Temperature", "°C", 12.0),
+    ("Battery", "V", 12.8),
+]
+
+def stream_response(start, periods, freq='15min', level_m=None, battery_v=None):
+    """
+    Returns an API response with one observation per sensor per timestamp.
+    level_m: list of water levels in meters (one per timestamp), defaults to 0.5
+    battery_v: list of battery voltages (one per timestamp), defaults to 12.8
+    """
+    times = pd.date_range(start, periods=periods, freq=freq, tz='UTC').strftime('%Y-%m-%d %H:%M:%SZ')
+    data = []
+    for i, timestamp in enumerate(times):
+        for sensor, unit, value in STREAM_SENSORS:
+            if sensor == "Water Level" and level_m is not None:
+                value = level_m[i]
+            if sensor == "Battery" and battery_v is not None:
+                value = battery_v[i]
+            data.append({"logger_sn": "00000000", "timestamp": timestamp, "sensor_measurement_type": sensor,
+                         "value": value, "unit": unit})
+    return {"data": data}
+
+@pytest.fixture
+def make_stream_response():
+    return stream_response
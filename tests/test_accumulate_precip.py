@@ -0,0 +1,26 @@
+# Tests for the water year precipitation accumulation (HOBOlink_parse.py)
+
+import pandas as pd
+import pytest
+from HOBOlink_parse import accumulate_precip, water_year
+
+def times(*texts):
+    return pd.Series(pd.to_datetime(list(texts), utc=True, format='mixed'))
+
+def test_water_year_starts_october_first():
+    assert water_year(times('2024-09-30 23:58', '2024-10-01 00:00', '2025-01-01')).tolist() == [2024, 2025, 2025]
+
+def test_resets_at_october_first():
+    timestamps = times('2024-09-30 23:56', '2024-09-30 23:58', '2024-10-01 00:00', '2024-10-01 00:02')
+    accumulated = accumulate_precip(timestamps, pd.Series([0.2, 0.2, 0.4, 0.2]))
+    assert accumulated.tolist() == pytest.approx([0.2, 0.4, 0.4, 0.6])
+
+def test_carried_total_only_added_to_its_water_year():
+    timestamps = times('2024-09-30 23:58', '2024-10-01 00:00')
+    accumulated = accumulate_precip(timestamps, pd.Series([0.2, 0.2]), total=100.0, current_water_year=2024)
+    assert accumulated.tolist() == pytest.approx([100.2, 0.2])
+
+def test_several_water_years_in_one_batch():
+    timestamps = times('2022-09-30', '2022-10-01', '2023-09-30', '2023-10-01', '2024-10-01')
+    accumulated = accumulate_precip(timestamps, pd.Series([1.0, 1.0, 1.0, 1.0, 1.0]), total=5.0, current_water_year=2022)
+    assert accumulated.tolist() == pytest.approx([6.0, 1.0, 2.0, 1.0, 1.0])
@@ -0,0 +1,81 @@
+# Tests for the bulk precip reprocessing (HOBOlink_backfill.py)
+
+import pandas as pd
+import pytest
+from datetime import datetime, timezone
+from HOBOlink_backfill import reprocess_precip
+from HOBOlink_parse import parse_precip
+from HOBOlink_state import site_state_path, load_state
+
+class Response:
+    status_code = 200
+
+class FakeClient:
+    """
+    Serves the pulses of a fixed list of timestamps for any window.
+    """
+    def __init__(self, timestamps, value=0.2):
+        self.timestamps = pd.to_datetime(timestamps, utc=True)
+        self.value = value
+
+    def get_window(self, logger, start_dt, end_dt, logging_interval_minutes):
+        inside = self.timestamps[(self.timestamps >= start_dt) & (self.timestamps <= end_dt)]
+        yield start_dt, end_dt, Response(), pulses(inside, self.value)
+
+def pulses(timestamps, value=0.2):
+    return {"data": [{"timestamp": t.strftime('%Y-%m-%d %H:%M:%SZ'), "sensor_measurement_type": "Precipitation",
+                      "value": value, "unit": "mm"} for t in pd.to_datetime(timestamps, utc=True)]}
+
+def utc(text):
+    return datetime.strptime(text, '%Y-%m-%d %H:%M:%S%z')
+
+def accumulated(tmp_path):
+    table = pd.read_csv(tmp_path / 'TSP' / 'Raw' / 'TSP_MasterTable_Raw.csv')
+    return dict(zip(table['timestamp_UTC'].str[:16], table['accumulated_precipitation_mm']))
+
+@pytest.fixture
+def site(tmp_path):
+    # one pulse a day in water years 2024 and 2025, with 2024-01-10 - 2024-01-12 missing
+    days = pd.date_range('2023-12-01', '2024-11-30', freq='D', tz='UTC')
+    days = days[(days < '2024-01-10') | (days > '2024-01-12')]
+    parse_precip(pulses(days), 'TSP', base_path=tmp_path, append_to_single_file=True)
+    return tmp_path
+
+def test_mid_water_year_backfill_updates_the_rest_of_the_year(site):
+    before = accumulated(site)
+    client = FakeClient(pd.date_range('2024-01-10', '2024-01-12', freq='D', tz='UTC'))
+    assert reprocess_precip(client, '123', 'TSP', utc('2024-01-10 00:00:00Z'), utc('2024-01-12 23:59:00Z'), base_path=site) == 3
+
+    after = accumulated(site)
+    assert len(after) == len(before) + 3
+    assert after['2024-01-09 00:00'] == before['2024-01-09 00:00']
+    assert after['2024-01-12 00:00'] == pytest.approx(before['2024-01-09 00:00'] + 0.6)
+    # the totals after the backfilled range include its pulses up to the end of the water year
+    assert after['2024-09-30 00:00'] == pytest.approx(before['2024-09-30 00:00'] + 0.6)
+
+def test_later_water_years_are_not_rewritten(site):
+    # mark the next water year, so a recompute of it would show
+    path = site / 'TSP' / 'Raw' / 'TSP_MasterTable_Raw.csv'
+    table = pd.read_csv(path)
+    table.loc[table['timestamp_UTC'] >= '2024-10-01', 'accumulated_precipitation_mm'] += 100
+    table.to_csv(path, index=False)
+    before = accumulated(site)
+    client = FakeClient(pd.date_range('2024-01-10', '2024-01-12', freq='D', tz='UTC'))
+    reprocess_precip(client, '123', 'TSP', utc('2024-01-10 00:00:00Z'), utc('2024-01-12 23:59:00Z'), base_path=site)
+
+    after = accumulated(site)
+    assert after['2024-10-01 00:00'] == pytest.approx(100.2)
+    # the next water year isn't affected by the backfill and keeps its values
+    assert {t: v for t, v in after.items() if t >= '2024-10-01'} == {t: v for t, v in before.items() if t >= '2024-10-01'}
+    assert load_state(site_state_path(site, 'TSP'))['precip_accumulator'] == {
+        'last_timestamp': '2024-11-30 00:00:00Z', 'total': before['2024-11-30 00:00'], 'water_year': 2025}
+
+def test_backfill_across_october_first_keeps_the_reset(site):
+    client = FakeClient(pd.date_range('2024-09-29 12:00', '2024-10-01 12:00', freq='12h', tz='UTC'), value=1.0)
+    reprocess_precip(client, '123', 'TSP', utc('2024-09-29 00:00:00Z'), utc('2024-10-02 00:00:00Z'), base_path=site)
+
+    after = accumulated(site)
+    assert after['2024-10-01 00:00'] == pytest.approx(1.0)  # the pulled value replaces the 0.2 pulse and restarts the year
+    assert after['2024-10-01 12:00'] == pytest.approx(2.0)
+    assert after['2024-10-02 00:00'] == pytest.approx(2.2)
+    assert after['2024-09-30 12:00'] - after['2024-09-29 00:00'] == pytest.approx(3.0)
@@ -0,0 +1,34 @@
+# Tests for the response cache (HOBOlink_cache.py)
+
+import pandas as pd
+import pytest
+from datetime import datetime, timedelta, timezone
+from HOBOlink_cache import ResponseCache, replay
+
+def test_windows_inside_the_upload_grace_are_not_cached(tmp_path):
+    cache = ResponseCache(tmp_path, upload_grace=timedelta(hours=6))
+    end_dt = datetime.now(timezone.utc) - timedelta(hours=1)
+    assert not cache.put('123', end_dt - timedelta(days=1), end_dt, {'data': [1]})
+    assert not cache.path('123', end_dt - timedelta(days=1), end_dt).exists()
+    assert cache.get('123', end_dt - timedelta(days=1), end_dt) is None
+
+def test_windows_past_the_upload_grace_are_served(tmp_path):
+    cache = ResponseCache(tmp_path, upload_grace=timedelta(hours=6))
+    end_dt = datetime(2024, 1, 2, tzinfo=timezone.utc)
+    assert cache.put('123', end_dt - timedelta(days=1), end_dt, {'data': [1]})
+    assert cache.get('123', end_dt - timedelta(days=1), end_dt) == {'data': [1]}
+
+def test_replay_writes_overlapping_windows_once(tmp_path, make_stream_response):
+    cache = ResponseCache(tmp_path / 'cache')
+    first, second = datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    cache.put('123', first, first + timedelta(hours=24), make_stream_response('2024-01-01 00:00', 96))
+    cache.put('123', second, second + timedelta(hours=24), make_stream_response('2024-01-01 12:00', 96))
+    df_sites = pd.DataFrame({'logger_SN': ['123'], 'CDEC_ID': [None]}, index=pd.Index(['TST'], name='site_ID'))
+
+    assert replay(cache, df_sites, 'S', base_path=tmp_path / 'rebuild') == {'TST': 144}
+    raw = pd.read_csv(tmp_path / 'rebuild' / 'TST' / 'Raw' / 'TST_MasterTable_Raw.csv')
+    assert raw['timestamp_UTC'].is_unique and len(raw) == 144
+
+    # replaying again would append every row a second time
+    with pytest.raises(FileExistsError):
+        replay(cache, df_sites, 'S', base_path=tmp_path / 'rebuild')
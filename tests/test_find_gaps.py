@@ -0,0 +1,51 @@
+# Tests for the streaming gap detector (find_gaps in HOBOlink_parse.py)
+
+from datetime import datetime, timezone
+import pandas as pd
+import pytest
+from HOBOlink_parse import find_gaps
+
+def utc(text):
+    return datetime.strptime(text, '%Y-%m-%d %H:%M').replace(tzinfo=timezone.utc)
+
+def write_table(path, minutes, levels):
+    times = [pd.Timestamp('2024-01-01', tz='UTC') + pd.Timedelta(minutes=m) for m in minutes]
+    pd.DataFrame({'timestamp_UTC': [t.strftime('%Y-%m-%d %H:%M:%SZ') for t in times],
+                  'water_level_ft': levels, 'discharge_cfs': [1.0] * len(levels),
+                  'qc_status': [''] * len(levels)}).to_csv(path, index=False)
+    return path
+
+@pytest.mark.parametrize('chunksize', [2, 3, 50000])
+def test_missing_and_bad_rows(tmp_path, chunksize):
+    # 00:30 and 00:45 are missing, 01:15 is blank - the two touching ranges are merged
+    path = write_table(tmp_path / 'table.csv', [0, 15, 60, 75, 90, 105, 120], [1.0, 1.0, 1.0, None, 1.0, 1.0, 1.0])
+    assert find_gaps(path, 15, chunksize=chunksize) == [(utc('2024-01-01 00:30'), utc('2024-01-01 00:45')),
+                                                        (utc('2024-01-01 01:15'), utc('2024-01-01 01:15'))]
+
+def test_touching_ranges_are_merged(tmp_path):
+    path = write_table(tmp_path / 'table.csv', [0, 30, 45, 60], [1.0, -9999.99, 1.0, 1.0])
+    # the missing 00:15 row and the sentinel 00:30 row
+    assert find_gaps(path, 15, columns=['water_level_ft']) == [(utc('2024-01-01 00:15'), utc('2024-01-01 00:30'))]
+
+def test_sentinel_how(tmp_path):
+    path = write_table(tmp_path / 'table.csv', [0, 15, 30], [1.0, -9999.99, 1.0])
+    assert find_gaps(path, 15) == []
+    assert find_gaps(path, 15, sentinel_how='any') == [(utc('2024-01-01 00:15'), utc('2024-01-01 00:15'))]
+
+def test_no_gaps(tmp_path):
+    path = write_table(tmp_path / 'table.csv', range(0, 150, 15), [1.0] * 10)
+    assert find_gaps(path, 15, chunksize=4) == []
+
+def test_missing_timestamp_column(tmp_path):
+    path = tmp_path / 'table.csv'
+    pd.DataFrame({'time': ['2024-01-01 00:00:00Z']}).to_csv(path, index=False)
+    with pytest.raises(ValueError):
+        find_gaps(path, 15)
+
+def test_timestamps_outside_the_mastertable_format(tmp_path):
+    # written by another tool - parsed by the pandas fallback instead of the fixed format fast path
+    path = tmp_path / 'table.csv'
+    pd.DataFrame({'timestamp_UTC': ['2024-01-01 00:00:00+00:00', '2024-01-01 00:15:00+00:00', 'not a time',
+                                    '2024-01-01 00:45:00+00:00'],
+                  'water_level_ft': [1.0, 1.0, 1.0, 1.0]}).to_csv(path, index=False)
+    assert find_gaps(path, 15) == [(utc('2024-01-01 00:30'), utc('2024-01-01 00:30'))]
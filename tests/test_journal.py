@@ -0,0 +1,146 @@
+# Tests for the write-ahead journal (HOBOlink_journal.py)
+
+import json
+import pytest
+import pandas as pd
+import HOBOlink_journal
+from HOBOlink_journal import Journal, journal_path, apply_journal, recover
+from HOBOlink_state import site_state_path, load_state
+from HOBOlink_parse import parse_stream
+
+class Crash(Exception):
+    pass
+
+def crash(*args, **kwargs):
+    raise Crash()
+
+def staged(tmp_path):
+    table = tmp_path / 'TST' / 'table.csv'
+    table.parent.mkdir(parents=True)
+    table.write_text('a,b\n1,2\n')
+    journal = Journal(journal_path(tmp_path, 'TST'))
+    journal.append(table, '3,4\n', 0o644)
+    journal.append(tmp_path / 'TST' / 'new' / 'daily.csv', 'a,b\n3,4\n', 0o664)
+    journal.commit_timestamp(site_state_path(tmp_path, 'TST'), '2024-01-01 00:15:00Z')
+    return journal, table
+
+def test_commit_applies_and_removes_journal(tmp_path):
+    journal, table = staged(tmp_path)
+    assert journal.commit() == len('3,4\n') + len('a,b\n3,4\n')
+
+    assert table.read_text() == 'a,b\n1,2\n3,4\n'
+    daily = tmp_path / 'TST' / 'new' / 'daily.csv'
+    assert daily.read_text() == 'a,b\n3,4\n'
+    assert daily.stat().st_mode & 0o777 == 0o664
+    assert load_state(site_state_path(tmp_path, 'TST'))['last_timestamp'] == '2024-01-01 00:15:00Z'
+    assert not journal.path.exists()
+
+def test_crash_before_rename_leaves_files_untouched(tmp_path, monkeypatch):
+    journal, table = staged(tmp_path)
+    monkeypatch.setattr(HOBOlink_journal.os, 'replace', crash)
+    with pytest.raises(Crash):
+        journal.commit()
+    monkeypatch.undo()
+
+    assert table.read_text() == 'a,b\n1,2\n'
+    assert not recover(tmp_path, 'TST')
+    assert table.read_text() == 'a,b\n1,2\n'
+    assert list((tmp_path / 'TST').glob('*.tmp')) == []
+
+def test_crash_after_rename_is_recovered(tmp_path, monkeypatch):
+    journal, table = staged(tmp_path)
+    monkeypatch.setattr(HOBOlink_journal, 'apply_journal', crash)
+    with pytest.raises(Crash):
+        journal.commit()
+    monkeypatch.undo()
+    assert journal.path.exists()
+    assert table.read_text() == 'a,b\n1,2\n'
+
+    assert recover(tmp_path, 'TST')
+    assert table.read_text() == 'a,b\n1,2\n3,4\n'
+    assert load_state(site_state_path(tmp_path, 'TST'))['last_timestamp'] == '2024-01-01 00:15:00Z'
+    assert not journal.path.exists()
+
+def test_partly_applied_journal_is_written_once(tmp_path, monkeypatch):
+    journal, table = staged(tmp_path)
+    monkeypatch.setattr(HOBOlink_journal, 'apply_journal', crash)
+    with pytest.raises(Crash):
+        journal.commit()
+    monkeypatch.undo()
+    # killed half way through the append
+    with open(table, 'a') as file:
+        file.write('3,')
+
+    recover(tmp_path, 'TST')
+    assert table.read_text() == 'a,b\n1,2\n3,4\n'
+
+def test_applying_twice_gives_the_same_files(tmp_path, monkeypatch):
+    journal, table = staged(tmp_path)
+    monkeypatch.setattr(HOBOlink_journal.os, 'remove', crash)
+    with pytest.raises(Crash):
+        journal.commit()
+    monkeypatch.undo()
+    # every write was applied, but the journal wasn't removed
+    assert table.read_text() == 'a,b\n1,2\n3,4\n'
+
+    apply_journal(journal.path)
+    assert table.read_text() == 'a,b\n1,2\n3,4\n'
+    assert (tmp_path / 'TST' / 'new' / 'daily.csv').read_text() == 'a,b\n3,4\n'
+
+def test_is_new_tracks_staged_files(tmp_path):
+    journal = Journal(journal_path(tmp_path, 'TST'))
+    path = tmp_path / 'TST' / 'table.csv'
+    assert journal.is_new(path)
+    journal.append(path, 'a\n', 0o644)
+    assert not journal.is_new(path)
+
+def test_parse_stream_finishes_a_killed_batch_first(tmp_path, monkeypatch, make_stream_response):
+    monkeypatch.setattr(HOBOlink_journal, 'apply_journal', crash)
+    with pytest.raises(Crash):
+        parse_stream(make_stream_response('2024-01-01', 4), 'TST', base_path=tmp_path)
+    monkeypatch.undo()
+    assert not (tmp_path / 'TST' / 'Raw' / 'TST_MasterTable_Raw.csv').exists()
+
+    parse_stream(make_stream_response('2024-01-01 01:00', 4), 'TST', base_path=tmp_path)
+    raw = pd.read_csv(tmp_path / 'TST' / 'Raw' / 'TST_MasterTable_Raw.csv')
+    assert len(raw) == 8
+    assert raw['timestamp_UTC'].is_monotonic_increasing
+    state = json.loads(site_state_path(tmp_path, 'TST').read_text())
+    assert state['last_timestamp'] == '2024-01-01 01:45:00Z'
+
+def test_killed_backfill_is_finished_by_the_next_run(tmp_path, monkeypatch, make_stream_response):
+    from HOBOlink_parse import backfill_stream
+    parse_stream(make_stream_response('2024-01-01', 4, level_m=[0.5, 0, 0, 0.5]), 'TST', base_path=tmp_path)
+    monkeypatch.setattr(HOBOlink_journal, 'apply_journal', crash)
+    with pytest.raises(Crash):
+        backfill_stream(make_stream_response('2024-01-01 00:15', 2, level_m=[0.6, 0.6]), 'TST', base_path=tmp_path)
+    monkeypatch.undo()
+    # nothing was written before the journal was committed
+    raw = pd.read_csv(tmp_path / 'TST' / 'Raw' / 'TST_MasterTable_Raw.csv')
+    assert raw['water_level_m'].tolist() == [0.5, 0, 0, 0.5]
+
+    assert recover(tmp_path, 'TST')
+    for table in ('Raw/TST_MasterTable_Raw.csv', 'Raw/Raw_Daily/2024/01/TST_20240101.csv',
+                  'Processed/TST_MasterTable_Processed.csv', 'Processed/Processed_Daily/2024/01/TST_20240101.csv'):
+        assert pd.read_csv(tmp_path / 'TST' / table)['water_level_m'].tolist() == [0.5, 0.6, 0.6, 0.5]
+
+def precip_response(start, periods):
+    times = pd.date_range(start, periods=periods, freq='2min', tz='UTC').strftime('%Y-%m-%d %H:%M:%SZ')
+    return {"data": [{"timestamp": t, "sensor_measurement_type": "Precipitation", "value": 0.2, "unit": "mm"} for t in times]}
+
+def test_killed_precip_batch_keeps_table_and_accumulator_together(tmp_path, monkeypatch):
+    from HOBOlink_parse import parse_precip
+    parse_precip(precip_response('2024-01-01', 3), 'TSP', base_path=tmp_path, append_to_single_file=True)
+    monkeypatch.setattr(HOBOlink_journal, 'apply_journal', crash)
+    with pytest.raises(Crash):
+        parse_precip(precip_response('2024-01-01 00:06', 2), 'TSP', base_path=tmp_path, append_to_single_file=True)
+    monkeypatch.undo()
+    assert load_state(site_state_path(tmp_path, 'TSP'))['precip_accumulator']['total'] == pytest.approx(0.6)
+
+    # the next run finishes the killed batch first, so its pulses are neither lost nor counted twice
+    parse_precip(precip_response('2024-01-01 00:06', 3), 'TSP', base_path=tmp_path, append_to_single_file=True)
+    table = pd.read_csv(tmp_path / 'TSP' / 'Raw' / 'TSP_MasterTable_Raw.csv')
+    assert len(table) == 6
+    assert table['accumulated_precipitation_mm'].tolist() == pytest.approx([0.2, 0.4, 0.6, 0.8, 1.0, 1.2])
+    assert len(pd.read_csv(tmp_path / 'TSP' / 'Raw' / 'TSP.csv')) == 6
+    assert load_state(site_state_path(tmp_path, 'TSP'))['precip_accumulator']['total'] == pytest.approx(1.2)
@@ -0,0 +1,20 @@
+# Tests for the pipeline metrics (HOBOlink_metrics.py)
+
+import json
+import os
+import pytest
+from HOBOlink_metrics import Metrics
+
+def test_write_replaces_both_files(tmp_path):
+    metrics = Metrics()
+    metrics.write(tmp_path)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['hobolink_metrics.json', 'hobolink_metrics.prom']
+    json.loads((tmp_path / 'hobolink_metrics.json').read_text())
+
+def test_failed_write_removes_the_temporary_file(tmp_path, monkeypatch):
+    def full_disk(*args):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(os, 'replace', full_disk)
+    with pytest.raises(OSError):
+        Metrics().write(tmp_path)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,43 @@
+# Tests for the NetCDF export (HOBOlink_netcdf.py)
+
+import numpy as np
+import pandas as pd
+import pytest
+from pathlib import Path
+from HOBOlink_parse import parse_stream
+
+netCDF4 = pytest.importorskip('netCDF4')
+from HOBOlink_netcdf import export_netcdf, tail_offset
+
+CONFIG = Path(__file__).resolve().parent.parent / 'Russian_WHT.yml'
+
+def master_table(tmp_path, response):
+    parse_stream(response, 'WHT', base_path=tmp_path)
+    return tmp_path / 'WHT' / 'Processed' / 'WHT_MasterTable_Processed.csv'
+
+def read_group(nc_path):
+    with netCDF4.Dataset(nc_path) as dataset:
+        group = dataset.groups['15_min_streamgauge']
+        return {name: np.ma.filled(group[name][:], np.nan) for name in group.variables}
+
+def test_daily_runs_match_one_export(tmp_path, make_stream_response):
+    csv_path = master_table(tmp_path, make_stream_response('2024-01-01 00:00', 300, level_m=list(np.linspace(0.2, 0.9, 300))))
+    assert export_netcdf(CONFIG, csv_path, tmp_path / 'daily.nc') == 300
+    master_table(tmp_path, make_stream_response('2024-01-04 03:00', 200))
+    assert export_netcdf(CONFIG, csv_path, tmp_path / 'daily.nc') == 200
+    assert export_netcdf(CONFIG, csv_path, tmp_path / 'daily.nc') == 0
+
+    assert export_netcdf(CONFIG, csv_path, tmp_path / 'once.nc') == 500
+    daily, once = read_group(tmp_path / 'daily.nc'), read_group(tmp_path / 'once.nc')
+    assert daily.keys() == once.keys()
+    for name in once:
+        np.testing.assert_array_equal(daily[name], once[name])
+
+def test_tail_offset_points_after_the_last_exported_row(tmp_path, make_stream_response):
+    csv_path = master_table(tmp_path, make_stream_response('2024-01-01 00:00', 2000))
+    last_time = (pd.Timestamp('2024-01-20 00:00', tz='UTC') - pd.Timestamp(0, tz='UTC')).total_seconds()
+    with open(csv_path, 'rb') as file:
+        file.readline()
+        offset = tail_offset(file, file.tell(), 0, last_time, '%Y-%m-%d %H:%M:%S%z', block_size=1024)
+        file.seek(offset)
+        assert file.readline().startswith(b'"2024-01-20 00:15:00Z"')
@@ -0,0 +1,91 @@
+# Tests for the stream processing engine and its sinks (process_stream in HOBOlink_parse.py)
+
+import json
+import pytest
+import pandas as pd
+from HOBOlink_parse import (process_stream, parse_stream, backfill_stream, AppendSink, DailySink, ShefSink, RAW_COLUMNS)
+from HOBOlink_state import site_state_path
+
+class RecordingSink:
+    def __init__(self):
+        self.batches = []
+
+    def write(self, batch):
+        self.batches.append(batch)
+
+def read_table(base_path, site, table):
+    return pd.read_csv(base_path / site / table / f"{site}_MasterTable_{table}.csv")
+
+def test_sinks_receive_each_batch_in_order(tmp_path, make_stream_response):
+    first, second = RecordingSink(), RecordingSink()
+    rows = process_stream(make_stream_response('2024-01-01', 8), 'TST', tmp_path, sinks=[first, second])
+
+    assert rows == 8
+    assert len(first.batches) == len(second.batches) == 1
+    batch = first.batches[0]
+    assert batch.site_name == 'TST'
+    assert batch.processed['timestamp_UTC'].iloc[0] == '2024-01-01 00:00:00Z'
+    assert batch.processed['water_level_ft'].iloc[0] == pytest.approx(1.64, abs=0.01)
+    # no rating curve - discharge is missing
+    assert (batch.processed['discharge_cfs'] == -9999.99).all()
+
+def test_no_sinks_called_for_empty_response(tmp_path):
+    sink = RecordingSink()
+    assert process_stream({"data": []}, 'TST', tmp_path, sinks=[sink]) == 0
+    assert sink.batches == []
+
+def test_parse_stream_appends_tables_daily_files_and_state(tmp_path, make_stream_response):
+    parse_stream(make_stream_response('2024-01-01 23:00', 4), 'TST', base_path=tmp_path)
+    parse_stream(make_stream_response('2024-01-02 00:00', 4), 'TST', base_path=tmp_path)
+
+    raw, processed = read_table(tmp_path, 'TST', 'Raw'), read_table(tmp_path, 'TST', 'Processed')
+    assert list(raw.columns) == RAW_COLUMNS
+    assert len(raw) == len(processed) == 8
+    assert raw['timestamp_UTC'].is_monotonic_increasing
+
+    daily = tmp_path / 'TST' / 'Raw' / 'Raw_Daily' / '2024' / '01'
+    assert len(pd.read_csv(daily / 'TST_20240101.csv')) == 4
+    assert len(pd.read_csv(daily / 'TST_20240102.csv')) == 4
+    assert (tmp_path / 'TST' / 'Processed' / 'Processed_Daily' / '2024' / '01' / 'TST_20240102.csv').exists()
+
+    state = json.loads(site_state_path(tmp_path, 'TST').read_text())
+    assert state['last_timestamp'] == '2024-01-02 00:45:00Z'
+    # the journal is removed once it is applied
+    assert not (tmp_path / 'TST' / 'TST_journal').exists()
+
+def test_backfill_stream_replaces_placeholder_rows(tmp_path, make_stream_response):
+    parse_stream(make_stream_response('2024-01-01', 8, level_m=[0.5, 0.5, 0, 0, 0, 0.5, 0.5, 0.5]), 'TST', base_path=tmp_path)
+    backfill_stream(make_stream_response('2024-01-01 00:30', 3, level_m=[0.6, 0.6, 0.6]), 'TST', base_path=tmp_path)
+
+    raw = read_table(tmp_path, 'TST', 'Raw')
+    assert len(raw) == 8
+    assert raw['timestamp_UTC'].is_monotonic_increasing
+    assert raw['water_level_m'].tolist() == [0.5, 0.5, 0.6, 0.6, 0.6, 0.5, 0.5, 0.5]
+    daily = pd.read_csv(tmp_path / 'TST' / 'Processed' / 'Processed_Daily' / '2024' / '01' / 'TST_20240101.csv')
+    assert daily['water_level_m'].tolist() == raw['water_level_m'].tolist()
+
+    # backfilling old rows doesn't move the resume point back
+    state = json.loads(site_state_path(tmp_path, 'TST').read_text())
+    assert state['last_timestamp'] == '2024-01-01 01:45:00Z'
+
+def test_shef_sink_writes_hourly_and_single_files(tmp_path, make_stream_response):
+    sinks = [AppendSink(), DailySink(), ShefSink('TSC', 'TSC_latest.txt')]
+    process_stream(make_stream_response('2024-01-01 08:00', 8), 'TST', tmp_path, sinks=sinks)
+
+    shef_root = tmp_path / 'TST' / 'SHEF_Output'
+    lines = (shef_root / 'TSC_latest.txt').read_text().splitlines()
+    assert len(lines) == 8
+    assert all(line.startswith('.A TSC') and '/VBI 12.80' in line for line in lines)
+    # 08:00Z is midnight Pacific time
+    assert (shef_root / '2024' / '01' / '01' / 'TSC_Streamflow_SHEF_2024010100.txt').exists()
+
+def test_archive_sink_matches_tables(tmp_path, make_stream_response):
+    pytest.importorskip('pyarrow')
+    from HOBOlink_archive import read_archive
+    parse_stream(make_stream_response('2024-01-01', 4), 'TST', base_path=tmp_path, archive_toggle=True)
+    backfill_stream(make_stream_response('2024-01-01 00:15', 2, level_m=[0.7, 0.7]), 'TST', base_path=tmp_path,
+                    archive_toggle=True)
+
+    archived = read_archive(tmp_path, 'TST', 'Raw')
+    assert len(archived) == 4
+    assert archived['water_level_m'].tolist() == read_table(tmp_path, 'TST', 'Raw')['water_level_m'].tolist()
@@ -0,0 +1,54 @@
+# Tests for the vectorized rating curve (RatingCurve and load_rating_curve in HOBOlink_parse.py)
+
+import numpy as np
+import pandas as pd
+import pytest
+from HOBOlink_parse import RatingCurve, load_rating_curve, calculate_discharge
+
+def curve_frame():
+    levels = np.linspace(0.5, 5.0, 100)
+    return pd.DataFrame({'Level.ft': levels, 'discharge.cfs': np.round(20 * levels ** 1.7, 3)})
+
+def test_matches_calculate_discharge():
+    curve = curve_frame()
+    stages = np.random.default_rng(0).uniform(0, 6, 500)
+    expected = [calculate_discharge(stage, curve) for stage in stages]
+    np.testing.assert_allclose(RatingCurve(curve['Level.ft'], curve['discharge.cfs']).discharge(stages), expected)
+
+def test_out_of_range_and_missing_stages():
+    rating_curve = RatingCurve([1.0, 2.0, 3.0], [10.0, 20.0, 40.0])
+    discharge = rating_curve.discharge([0.5, 1.0, 2.5, 3.0, 3.5, np.nan])
+    assert discharge[:5].tolist() == [-9999.99, 10.0, 30.0, 40.0, -9999.99]
+
+def test_empty_curve():
+    assert RatingCurve([], []).discharge([1.0, 2.0]).tolist() == [-9999.99, -9999.99]
+
+@pytest.mark.parametrize('levels, discharges', [
+    ([1.0, 2.0], [10.0]),
+    ([1.0, np.nan], [10.0, 20.0]),
+    ([1.0, 1.0], [10.0, 20.0]),
+    ([1.0, 2.0], [20.0, 10.0]),
+])
+def test_invalid_curves_are_rejected(levels, discharges):
+    with pytest.raises(ValueError):
+        RatingCurve(levels, discharges)
+
+def test_load_rating_curve(tmp_path):
+    path = tmp_path / 'TST.rating_curve_100_points.csv'
+    assert load_rating_curve(path) is None
+    curve_frame().to_csv(path, index=False)
+    rating_curve = load_rating_curve(path)
+    assert rating_curve.discharge([0.5])[0] == pytest.approx(20 * 0.5 ** 1.7, abs=1e-3)
+    # parsed once while the file is unchanged
+    assert load_rating_curve(path) is rating_curve
+
+def test_invalid_rating_curve_is_logged(tmp_path, caplog):
+    path = tmp_path / 'TST.rating_curve_100_points.csv'
+    pd.DataFrame({'Level.ft': [1.0, 2.0, 1.5], 'discharge.cfs': [1.0, 2.0, 3.0]}).to_csv(path, index=False)
+
+    with caplog.at_level('ERROR', logger='TST_Logger'):
+        assert load_rating_curve(path, 'TST') is None
+    assert 'could not be used' in caplog.text
+
+    with pytest.raises(ValueError):
+        load_rating_curve(path, 'TST', strict=True)
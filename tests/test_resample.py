@@ -0,0 +1,120 @@
+# Tests for the incremental resampler (HOBOlink_resample.py)
+
+import numpy as np
+import pandas as pd
+import pytest
+from HOBOlink_resample import IntervalResampler
+from HOBOlink_state import site_state_path, load_state
+from HOBOlink_parse import parse_stream
+
+def samples(start, periods, freq='5min', seed=0):
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(start, periods=periods, freq=freq, tz='UTC')
+    return pd.DataFrame({'timestamp_UTC': times, 'level': np.round(rng.uniform(1, 2, periods), 3),
+                         'rain': np.round(rng.uniform(0, 1, periods), 3)})
+
+def test_partial_bin_is_carried_not_written():
+    resampler = IntervalResampler('15min', {'rain': 'sum'})
+    bins = resampler.resample(samples('2024-01-01 00:00', 4))  # 00:00-00:15, the 00:15 bin has one sample
+
+    assert bins['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z']
+    assert resampler.carrying()
+    assert resampler.state['carry']['bin'] == '2024-01-01 00:15:00Z'
+
+def test_bin_is_complete_when_last_sample_reaches_its_end():
+    resampler = IntervalResampler('15min', interval='5min')
+    bins = resampler.resample(samples('2024-01-01 00:00', 6))  # last sample 00:25 + 5 min reaches 00:30
+    assert bins['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z', '2024-01-01 00:15:00Z']
+    assert not resampler.carrying()
+
+def test_bin_waits_for_a_later_timestamp_without_an_interval():
+    resampler = IntervalResampler('15min')
+    bins = resampler.resample(samples('2024-01-01 00:00', 6))
+    assert bins['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z']
+    assert resampler.state['carry']['bin'] == '2024-01-01 00:15:00Z'
+
+def test_gap_in_the_batch_does_not_complete_the_last_bin():
+    # 00:00-00:10 then one sample at 00:15 - the median spacing of an uneven batch doesn't decide completeness
+    df = samples('2024-01-01 00:00', 4).drop(index=[1, 2]).reset_index(drop=True)
+    resampler = IntervalResampler('15min', interval='5min')
+    assert resampler.resample(df)['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z']
+    assert resampler.state['carry']['bin'] == '2024-01-01 00:15:00Z'
+
+def test_split_batches_match_one_batch():
+    df = samples('2024-01-01 00:00', 60)
+    whole = IntervalResampler('15min', {'rain': 'sum', 'level': 'last'}).resample(df)
+
+    resampler = IntervalResampler('15min', {'rain': 'sum', 'level': 'last'})
+    parts = [resampler.resample(part) for part in (df.iloc[:7], df.iloc[7:20], df.iloc[20:21], df.iloc[21:])]
+    split = pd.concat(parts, ignore_index=True)
+    pd.testing.assert_frame_equal(split, whole)
+
+def test_carry_is_saved_to_the_state_file(tmp_path):
+    state_path = tmp_path / 'state.json'
+    df = samples('2024-01-01 00:00', 12)
+    first = IntervalResampler('15min', state_path=state_path, key='test')
+    bins = first.resample(df.iloc[:4])
+    first.commit()
+    assert load_state(state_path)['test']['carry']['bin'] == '2024-01-01 00:15:00Z'
+
+    # a new resampler (the next run) finishes the bin with the rest of its samples
+    second = IntervalResampler('15min', state_path=state_path, key='test')
+    bins = pd.concat([bins, second.resample(df.iloc[4:])], ignore_index=True)
+    expected = IntervalResampler('15min').resample(df)
+    pd.testing.assert_frame_equal(bins, expected)
+
+def test_rows_already_seen_are_ignored():
+    resampler = IntervalResampler('15min')
+    df = samples('2024-01-01 00:00', 6)
+    resampler.resample(df)
+    assert resampler.resample(df).empty
+
+def test_carry_not_continued_by_the_next_batch_is_written_on_its_own():
+    resampler = IntervalResampler('15min', interval='5min')
+    df = samples('2024-01-01 00:00', 4)
+    resampler.resample(df)
+    assert resampler.carrying()
+
+    bins = resampler.resample(samples('2024-01-02 00:00', 6))
+    # the old partial bin is written as it is, without placeholder bins for the day in between
+    assert bins['timestamp_UTC'].tolist() == ['2024-01-01 00:15:00Z', '2024-01-02 00:00:00Z', '2024-01-02 00:15:00Z']
+    assert bins.loc[0, 'level'] == round(df.loc[3, 'level'], 2)
+
+def test_empty_bins_between_completed_bins_are_missing():
+    df = pd.concat([samples('2024-01-01 00:00', 3), samples('2024-01-01 00:30', 3)], ignore_index=True)
+    bins = IntervalResampler('15min', interval='5min').resample(df)
+    assert bins['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z', '2024-01-01 00:15:00Z', '2024-01-01 00:30:00Z']
+    assert bins.loc[1, 'level'] == -9999.99
+
+def test_mean_sum_last_values():
+    df = pd.DataFrame({'timestamp_UTC': pd.date_range('2024-01-01', periods=3, freq='5min', tz='UTC'),
+                       'level': [1.0, 2.0, -9999.99], 'rain': [0.2, 0.2, 0.4], 'temp': [5.0, 6.0, 7.0]})
+    bins = IntervalResampler('15min', {'rain': 'sum', 'temp': 'last'}, interval='5min').resample(df)
+    assert bins.loc[0, 'level'] == pytest.approx(1.5)  # the missing value isn't averaged in
+    assert bins.loc[0, 'rain'] == pytest.approx(0.8)
+    assert bins.loc[0, 'temp'] == 7.0
+
+def test_only_live_pulls_use_the_site_state(tmp_path, make_stream_response):
+    parse_stream(make_stream_response('2024-01-01 00:00', 4, freq='5min'), 'TST', base_path=tmp_path, carry_bins=True,
+                 logging_interval_minutes=5)
+    assert load_state(site_state_path(tmp_path, 'TST'))['stream_resample']['carry']['bin'] == '2024-01-01 00:15:00Z'
+
+    # a historical pull resamples on its own and leaves the carried bin alone
+    parse_stream(make_stream_response('2023-06-01 00:00', 6, freq='5min'), 'TST', base_path=tmp_path)
+    assert load_state(site_state_path(tmp_path, 'TST'))['stream_resample']['carry']['bin'] == '2024-01-01 00:15:00Z'
+
+    parse_stream(make_stream_response('2024-01-01 00:20', 2, freq='5min'), 'TST', base_path=tmp_path, carry_bins=True,
+                 logging_interval_minutes=5)
+    raw = pd.read_csv(tmp_path / 'TST' / 'Raw' / 'TST_MasterTable_Raw.csv')
+    assert raw['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z', '2023-06-01 00:00:00Z', '2023-06-01 00:15:00Z',
+                                             '2024-01-01 00:15:00Z']
+
+@pytest.mark.parametrize('carry_bins', [False, True])
+def test_shef_battery_is_the_last_reading_of_each_bin(tmp_path, make_stream_response, carry_bins):
+    response = make_stream_response('2024-01-01 08:00', 6, freq='5min', battery_v=[12.0, 12.1, 12.2, 12.3, 12.4, 12.5])
+    parse_stream(response, 'TST', 'TSC', base_path=tmp_path, shef_toggle=True, carry_bins=carry_bins,
+                 logging_interval_minutes=5)
+
+    lines = (tmp_path / 'TST' / 'SHEF_Output' / 'TSC_Streamflow_SHEF_latest.txt').read_text().splitlines()
+    assert [line.split()[4] for line in lines] == ['DH0000', 'DH0015']
+    assert [line.rsplit('/VBI ', 1)[1] for line in lines] == ['12.20', '12.50']
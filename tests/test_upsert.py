@@ -0,0 +1,63 @@
+# Tests for upsert_csv and backfill_precip (HOBOlink_parse.py)
+
+import pandas as pd
+from HOBOlink_parse import upsert_csv, backfill_precip
+
+def frame(times, values):
+    return pd.DataFrame({'timestamp_UTC': times, 'water_level_ft': values})
+
+def test_upsert_creates_file(tmp_path):
+    path = tmp_path / 'table.csv'
+    assert upsert_csv(path, frame(['2024-01-01 00:15:00Z', '2024-01-01 00:00:00Z'], [2.0, 1.0])) == 2
+    assert pd.read_csv(path)['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z', '2024-01-01 00:15:00Z']
+
+def test_upsert_replaces_and_inserts_in_time_order(tmp_path):
+    path = tmp_path / 'table.csv'
+    upsert_csv(path, frame(['2024-01-01 00:00:00Z', '2024-01-01 00:15:00Z', '2024-01-01 00:45:00Z'], [1.0, -9999.99, 4.0]))
+    rows = upsert_csv(path, frame(['2024-01-01 00:30:00Z', '2024-01-01 00:15:00Z'], [3.0, 2.0]))
+
+    table = pd.read_csv(path)
+    assert rows == 4
+    assert table['timestamp_UTC'].tolist() == ['2024-01-01 00:00:00Z', '2024-01-01 00:15:00Z',
+                                               '2024-01-01 00:30:00Z', '2024-01-01 00:45:00Z']
+    assert table['water_level_ft'].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+def test_upsert_last_duplicate_wins(tmp_path):
+    path = tmp_path / 'table.csv'
+    upsert_csv(path, frame(['2024-01-01 00:00:00Z'], [1.0]))
+    upsert_csv(path, frame(['2024-01-01 00:00:00Z', '2024-01-01 00:00:00Z'], [5.0, 6.0]))
+    table = pd.read_csv(path)
+    assert table['water_level_ft'].tolist() == [6.0]
+
+def test_upsert_keeps_file_columns_and_permissions(tmp_path):
+    path = tmp_path / 'table.csv'
+    upsert_csv(path, frame(['2024-01-01 00:00:00Z'], [1.0]), permissions=0o644)
+    new_rows = frame(['2024-01-01 00:15:00Z'], [2.0]).assign(extra=1)
+    upsert_csv(path, new_rows, permissions=0o600)
+    assert list(pd.read_csv(path).columns) == ['timestamp_UTC', 'water_level_ft']
+    assert path.stat().st_mode & 0o777 == 0o644
+
+def test_upsert_nothing_to_merge(tmp_path):
+    assert upsert_csv(tmp_path / 'table.csv', frame([], [])) is None
+    assert not (tmp_path / 'table.csv').exists()
+
+def test_backfill_precip_reaccumulates_after_gap(tmp_path):
+    path = tmp_path / 'precip.csv'
+    pd.DataFrame({'timestamp_UTC': ['2024-03-01 00:00:00Z', '2024-03-01 00:06:00Z', '2024-03-01 00:08:00Z'],
+                  'precipitation_mm': [1.0, 1.0, 1.0],
+                  'accumulated_precipitation_mm': [10.0, 11.0, 12.0]}).to_csv(path, index=False)
+    data = {'data': [{'sensor_measurement_type': 'Precipitation', 'timestamp': t, 'value': 0.5, 'unit': 'mm'}
+                     for t in ('2024-03-01 00:02:00Z', '2024-03-01 00:04:00Z')]}
+
+    assert backfill_precip(data, path) == 2
+    table = pd.read_csv(path)
+    assert table['timestamp_UTC'].str[11:16].tolist() == ['00:00', '00:02', '00:04', '00:06', '00:08']
+    # the rows after the gap include the backfilled precipitation
+    assert table['accumulated_precipitation_mm'].tolist() == [10.0, 10.5, 11.0, 12.0, 13.0]
+
+def test_backfill_precip_without_pulses_leaves_the_file(tmp_path):
+    path = tmp_path / 'precip.csv'
+    assert backfill_precip({'data': []}, path) == 0
+    assert backfill_precip({'data': [{'sensor_measurement_type': 'Battery', 'timestamp': '2024-03-01 00:00:00Z',
+                                      'value': 12.8, 'unit': 'V'}]}, path) == 0
+    assert not path.exists()